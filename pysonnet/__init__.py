@@ -1,5 +1,9 @@
 from pysonnet.sonnet import configure_sonnet
 from pysonnet.projects import GeometryProject, __version__
+from pysonnet.scheduler import Scheduler
+from pysonnet.cache import ResultCache
+from pysonnet.progress import ProgressParser
+from pysonnet.monitor import RunReport
 # from pysonnet.projects import NetlistProject
 # from pysonnet.outputs import Sweep
 from pysonnet.outputs import CurrentDensity
@@ -79,6 +79,12 @@ UNITS = {'conductivity': {'microsiemens/centimeter': 'USCM', 'uS/cm': 'USCM',
                         "gigaohm": "GOH", "Gohm": "GOH", "GΩ": "GOH",
                         "teraohm": "TOH", "Tohm": "TOH", "TΩ": "TOH"}}
 
+# the size of the frequency and length units in hertz and meters
+UNIT_SCALES = {'frequency': {"HZ": 1, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9, "THZ": 1e12,
+                             "PHZ": 1e15},
+               'length': {"UM": 1e-6, "MIL": 2.54e-5, "MM": 1e-3, "CM": 1e-2,
+                          "IN": 0.0254, "FT": 0.3048, "M": 1}}
+
 # geometry block for geometry project
 GEOMETRY = """\
 GEO
@@ -174,8 +180,8 @@ END
 LAYER_TYPES = {'metal': "METAL", 'via': "VIA", 'dielectric brick': "BRICK"}
 POLYGON_TYPES = {'metal': "", 'via': "VIA POLYGON", 'dielectric brick': "BRI POL"}
 TECHLAYER_NAME_FORMAT = 'TLAYNAM "{name}" {inherit}'
-LEVEL_FORMAT = ("{level} {n_vertices} {material} {fill_type} 0 {x_min} {y_min} {x_max} "
-                "{y_max} {conformal_max} 0 0 {edge_mesh}")
+LEVEL_FORMAT = ("{level} {n_vertices} {material} {fill_type} {debug_id} {x_min} {y_min} "
+                "{x_max} {y_max} {conformal_max} 0 0 {edge_mesh}")
 TO_LEVEL_FORMAT = "TOLEVEL {to_level} {via_fill_type} {pads}"
 FILL_TYPES = {'staircase': 'N', 'diagonal': 'T', 'conformal': 'V'}
 
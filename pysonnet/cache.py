@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# lines of a Sonnet file that change every time it is written without changing
+# the simulation
+VOLATILE_KEYWORDS = ('DAT ', 'BUILT_BY')
+# stands in for the project file name in the stored output paths so that the
+# outputs can be restored for a project saved under another name
+BASENAME = '$BASENAME'
+MANIFEST = 'manifest.json'
+
+
+class ResultCache:
+    """
+    Class for reusing the outputs of Sonnet simulations. The outputs are stored in
+    a directory under a hash of the project file, the Sonnet version and the em
+    options so identical projects are only simulated once, even when they are run
+    from different scripts or by different users sharing the directory.
+
+    :param directory: the directory holding the cached outputs (str)
+    :param max_size: the largest number of bytes the cache may hold (integer)
+        The least recently used outputs are removed when it is exceeded. The cache
+        isn't limited if it isn't given.
+    """
+    def __init__(self, directory, max_size=None):
+        assert max_size is None or max_size >= 0, "'max_size' can't be negative"
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return "ResultCache({!r}, max_size={})".format(self.directory, self.max_size)
+
+    def key(self, project_file_path, version='', options='', external_frequency_file=None):
+        """
+        Returns the hash identifying a simulation. The DAT and BUILT_BY lines of the
+        project file are left out since they only record when it was written.
+
+        :param project_file_path: path to the Sonnet project file (str)
+        :param version: the Sonnet version (str)
+        :param options: the em command line options (str)
+        :param external_frequency_file: path to the frequency control file (optional)
+        :return: a hexadecimal string
+        """
+        digest = hashlib.sha256()
+        digest.update("{}\0{}\0".format(version, options).encode())
+        volatile = tuple(keyword.encode() for keyword in VOLATILE_KEYWORDS)
+        with open(project_file_path, 'rb') as file_handle:
+            for line in file_handle:
+                if not line.lstrip().startswith(volatile):
+                    digest.update(line)
+        if external_frequency_file:
+            digest.update(b"\0")
+            with open(external_frequency_file, 'rb') as file_handle:
+                for chunk in iter(lambda: file_handle.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def snapshot(self, project_file_path):
+        """
+        Records the files em may write for a project so that the ones it writes can
+        be found after it has run.
+
+        :param project_file_path: path to the Sonnet project file (str)
+        :return: a dictionary mapping each file path, relative to the project's
+            folder, to its modification time and size
+        """
+        folder = os.path.dirname(os.path.abspath(project_file_path))
+        files = {}
+        for path in _output_files(project_file_path):
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:  # removed by another run since it was listed
+                continue
+            files[os.path.relpath(path, folder)] = (status.st_mtime_ns, status.st_size)
+        return files
+
+    def store(self, key, project_file_path, snapshot):
+        """
+        Copy the files that em wrote for a project into the cache.
+
+        :param key: the hash of the simulation from key() (str)
+        :param project_file_path: path to the Sonnet project file (str)
+        :param snapshot: the files before em was run from snapshot() (dict)
+        :return: the number of files stored (integer)
+        """
+        folder = os.path.dirname(os.path.abspath(project_file_path))
+        basename = _basename(project_file_path)
+        changed = {path: status for path, status in
+                   self.snapshot(project_file_path).items()
+                   if snapshot.get(path) != status}
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return 0
+        # copy into a temporary folder first so that other processes never see a
+        # partly written entry
+        temporary = tempfile.mkdtemp(prefix='.' + key, dir=self.directory)
+        size = 0
+        names = []
+        for path in changed:
+            name = _replace_basename(path, basename, BASENAME)
+            destination = os.path.join(temporary, 'files', name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                shutil.copy2(os.path.join(folder, path), destination)
+            except FileNotFoundError:  # removed by another run since the snapshot
+                continue
+            size += os.path.getsize(destination)
+            names.append(name)
+        with open(os.path.join(temporary, MANIFEST), 'w') as file_handle:
+            json.dump({'files': names, 'size': size, 'created': time.time()},
+                      file_handle)
+        try:
+            os.rename(temporary, entry)
+        except OSError:  # another process stored the same simulation first
+            shutil.rmtree(temporary, ignore_errors=True)
+            return 0
+        self.stats['stores'] += 1
+        log.debug("stored {} file(s) for {} in the result cache".format(len(names), key))
+        self.evict(keep=key)
+        return len(names)
+
+    def restore(self, key, project_file_path):
+        """
+        Copy the cached outputs of a simulation next to a project file.
+
+        :param key: the hash of the simulation from key() (str)
+        :param project_file_path: path to the Sonnet project file (str)
+        :return: True if the outputs were in the cache (boolean)
+        """
+        entry = os.path.join(self.directory, key)
+        manifest = _read_manifest(entry)
+        if manifest is None:
+            self.stats['misses'] += 1
+            log.debug("result cache miss for {}".format(key))
+            return False
+        folder = os.path.dirname(os.path.abspath(project_file_path))
+        basename = _basename(project_file_path)
+        for name in manifest['files']:
+            destination = os.path.join(folder, _replace_basename(name, BASENAME, basename))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(os.path.join(entry, 'files', name), destination)
+        # the modification time of the manifest records when the entry was last used
+        os.utime(os.path.join(entry, MANIFEST))
+        self.stats['hits'] += 1
+        log.debug("result cache hit for {}".format(key))
+        return True
+
+    def size(self):
+        """Returns the number of bytes held by the cache."""
+        return sum(manifest['size'] for _, _, manifest in self._entries())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used outputs until the cache fits in max_size.
+
+        :param keep: the hash of an entry that shouldn't be removed (str)
+        :return: the number of entries removed (integer)
+        """
+        if self.max_size is None:
+            return 0
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum(manifest['size'] for _, _, manifest in entries)
+        removed = 0
+        for key, _, manifest in entries:
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            size -= manifest['size']
+            removed += 1
+        self.stats['evictions'] += removed
+        if removed:
+            log.debug("evicted {} result cache entries".format(removed))
+        return removed
+
+    def clear(self):
+        """Remove all of the outputs from the cache."""
+        for key, _, _ in self._entries():
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _entries(self):
+        # yield the key, last use time and manifest of each complete entry
+        for key in os.listdir(self.directory):
+            if key.startswith('.'):
+                continue
+            entry = os.path.join(self.directory, key)
+            manifest = _read_manifest(entry)
+            if manifest is not None:
+                yield key, os.path.getmtime(os.path.join(entry, MANIFEST)), manifest
+
+
+def _basename(project_file_path):
+    # the project file name without extensions like the sondata folder name
+    return os.path.basename(project_file_path).split('.')[0]
+
+
+def _replace_basename(path, old, new):
+    # replace the project name in the parts of a relative path named after it,
+    # e.g. 'project.s2p' or 'sondata/project/'
+    parts = path.split(os.sep)
+    return os.sep.join(new + part[len(old):] if part == old or
+                       part.startswith(old + '.') else part for part in parts)
+
+
+def _output_files(project_file_path):
+    # the files next to the project named after it and the files in its sondata
+    # folder, leaving out project files so that other projects sharing the folder
+    # are never cached or overwritten
+    folder = os.path.dirname(os.path.abspath(project_file_path))
+    prefix = _basename(project_file_path) + '.'
+    for name in os.listdir(folder):
+        if not name.startswith(prefix) or name.lower().endswith('.son'):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            yield path
+    sondata = os.path.join(folder, 'sondata', _basename(project_file_path))
+    for root, _, names in os.walk(sondata):
+        for name in names:
+            yield os.path.join(root, name)
+
+
+def _read_manifest(entry):
+    # the manifest of a cache entry or None if it isn't there
+    try:
+        with open(os.path.join(entry, MANIFEST)) as file_handle:
+            return json.load(file_handle)
+    except (OSError, ValueError):
+        return None
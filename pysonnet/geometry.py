@@ -0,0 +1,1315 @@
+import os
+import copy
+import itertools
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+
+import pysonnet.blocks as b
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# polygon types and fill types are stored as indices into these lists
+POLYGON_TYPE_NAMES = list(b.POLYGON_TYPES.keys())
+FILL_TYPE_CODES = list(b.FILL_TYPES.values())
+# the optional first line of a polygon which gives its type
+_POLYGON_TYPE_LINES = {'MET POL': 0, 'VIA POLYGON': 1, 'BRI POL': 2}
+# numbers for the letters in a polygon level line (see _PolygonBatch.flush)
+_LEVEL_LETTERS = str.maketrans(dict({code: str(index) for index, code
+                                     in enumerate(FILL_TYPE_CODES)}, Y='1'))
+
+
+class PolygonTable:
+    """
+    Columnar storage for the polygons in a geometry project. The vertices of every
+    polygon are kept in one N x 2 array and polygon i owns the rows
+    offsets[i]:offsets[i + 1]. Every other polygon property is stored in its own
+    array with one entry per polygon. The Sonnet text for the polygons is only made
+    when it is needed by calling to_string().
+
+    Strings that are shared by many polygons (the TOLEVEL line of a via and the
+    technology layer name) are stored as integer codes into the 'to_levels' and
+    'tech_layers' lists. A code of -1 means the polygon does not have one.
+    """
+    COLUMNS = {'polygon_type': np.int8, 'level': np.int64, 'material': np.int64,
+               'fill_type': np.int8, 'debug_id': np.int64, 'x_min': np.int64,
+               'y_min': np.int64, 'x_max': np.int64, 'y_max': np.int64,
+               'conformal_max': np.float64, 'edge_mesh': np.bool_,
+               'to_level': np.int64, 'tech_layer': np.int64, 'inherit': np.bool_}
+
+    def __init__(self):
+        self.to_levels = []
+        self.tech_layers = []
+        self.version = 0  # incremented whenever the table changes
+        self._shared = set()  # buffers that must be copied before they are changed
+        self._n_polygons = 0
+        self._n_vertices = 0
+        self._vertices = np.empty((0, 2), dtype=np.float64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._columns = {key: np.empty(0, dtype=value)
+                         for key, value in self.COLUMNS.items()}
+
+    def __len__(self):
+        return self._n_polygons
+
+    def __getitem__(self, column):
+        """Returns a view of the values of a column for every polygon."""
+        return self._columns[column][:self._n_polygons]
+
+    @property
+    def vertices(self):
+        """All of the polygon vertices as an N x 2 array."""
+        return self._vertices[:self._n_vertices]
+
+    @property
+    def offsets(self):
+        """The start of each polygon in vertices with the total number appended."""
+        return self._offsets[:self._n_polygons + 1]
+
+    @property
+    def n_vertices(self):
+        """The total number of vertices in the table."""
+        return self._n_vertices
+
+    def polygon(self, index):
+        """Returns the N x 2 vertex array of the polygon at 'index'."""
+        offsets = self.offsets
+        return self.vertices[offsets[index]:offsets[index + 1]]
+
+    def category(self, name, value):
+        """
+        Returns the integer code for a string in one of the categorical columns
+        ('to_level' or 'tech_layer'), adding the string if it is new.
+        """
+        values = self.to_levels if name == 'to_level' else self.tech_layers
+        if value is None:
+            return -1
+        if value not in values:
+            values.append(value)
+        return values.index(value)
+
+    def append(self, vertices, offsets, **columns):
+        """
+        Adds a batch of polygons to the table.
+
+        :param vertices: the closed polygons stacked into an N x 2 array
+        :param offsets: the start of each polygon in 'vertices' with N appended
+        :keyword columns: the value of each column in COLUMNS for the new polygons
+            Each value may either be a scalar applied to every new polygon or an
+            array with one entry per new polygon. Missing columns are set to zero
+            except for 'to_level' and 'tech_layer' which are set to -1.
+        """
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n_new = offsets.size - 1
+        if n_new <= 0:
+            return
+        for key in columns.keys():
+            if key not in self.COLUMNS:
+                raise ValueError("'{}' is not a polygon table column".format(key))
+        self._reserve(self._n_polygons + n_new, self._n_vertices + vertices.shape[0])
+        # add the vertices
+        start = self._n_vertices
+        self._vertices[start:start + vertices.shape[0]] = vertices
+        self._offsets[self._n_polygons + 1:self._n_polygons + n_new + 1] = (
+            offsets[1:] - offsets[0] + start)
+        # add the properties
+        for key in self.COLUMNS.keys():
+            default = -1 if key in ('to_level', 'tech_layer') else 0
+            value = columns.get(key, default)
+            self._columns[key][self._n_polygons:self._n_polygons + n_new] = value
+        self._n_vertices += vertices.shape[0]
+        self._n_polygons += n_new
+        self.version += 1
+
+    def set(self, column, index, value):
+        """Sets the value of a column for the polygons selected by 'index'."""
+        if column in self._shared:
+            self._columns[column] = self._columns[column].copy()
+            self._shared.discard(column)
+        self._columns[column][:self._n_polygons][index] = value
+        self.version += 1
+
+    def share(self):
+        """
+        Returns a copy of the table that uses the same buffers as this one. A buffer
+        is only copied when one of the tables that use it is changed, so a shared
+        copy costs almost no memory until it is modified.
+        """
+        table = PolygonTable.__new__(PolygonTable)
+        table.__dict__.update(self.__dict__)
+        table.to_levels = list(self.to_levels)
+        table.tech_layers = list(self.tech_layers)
+        table._columns = dict(self._columns)
+        names = {'vertices', 'offsets'} | set(self.COLUMNS.keys())
+        self._shared = set(names)
+        table._shared = set(names)
+        return table
+
+    def copy(self):
+        """Returns an independent copy of the table."""
+        table = PolygonTable()
+        table.to_levels = list(self.to_levels)
+        table.tech_layers = list(self.tech_layers)
+        table.append(self.vertices, self.offsets,
+                     **{key: self[key] for key in self.COLUMNS.keys()})
+        return table
+
+    def take(self, indices):
+        """
+        Returns a new table with the polygons at 'indices' in the order given.
+
+        :param indices: the polygon indices (array of integers)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        offsets = self.offsets
+        lengths = offsets[indices + 1] - offsets[indices]
+        new_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        rows = (np.repeat(offsets[indices] - new_offsets[:-1], lengths) +
+                np.arange(new_offsets[-1]))
+        table = PolygonTable()
+        table.to_levels = list(self.to_levels)
+        table.tech_layers = list(self.tech_layers)
+        table.append(self.vertices[rows], new_offsets,
+                     **{key: self[key][indices] for key in self.COLUMNS.keys()})
+        return table
+
+    def _reserve(self, n_polygons, n_vertices):
+        # grow the buffers geometrically so that appending is amortized O(1) and
+        # copy any buffers shared with another table before they are written to
+        size = self._vertices.shape[0]
+        if n_vertices > size or 'vertices' in self._shared:
+            if n_vertices > size:
+                size = max(n_vertices, 2 * size, 64)
+            vertices = np.empty((size, 2), dtype=np.float64)
+            vertices[:self._n_vertices] = self.vertices
+            self._vertices = vertices
+        size = self._offsets.size
+        if n_polygons + 1 > size or self._shared:
+            if n_polygons + 1 > size:
+                size = max(n_polygons + 1, 2 * size, 16)
+            offsets = np.zeros(size, dtype=np.int64)
+            offsets[:self._n_polygons + 1] = self.offsets
+            self._offsets = offsets
+            for key, column in self._columns.items():
+                new_column = np.zeros(size, dtype=column.dtype)
+                new_column[:self._n_polygons] = column[:self._n_polygons]
+                self._columns[key] = new_column
+        self._shared = set()
+
+    def iter_strings(self, chunk_size=10000):
+        """
+        Yields the Sonnet text for the polygons in the table in chunks.
+
+        :param chunk_size: the number of polygons in each chunk (integer)
+        """
+        for start in range(0, self._n_polygons, chunk_size):
+            yield self._render(start, min(start + chunk_size, self._n_polygons))
+
+    def _render(self, start, stop):
+        # format all of the vertices at once and then slice out each polygon
+        offsets = self.offsets[start:stop + 1]
+        text, line_ends = format_vertices(self.vertices[offsets[0]:offsets[-1]])
+        bounds = np.concatenate([[0], line_ends])[offsets - offsets[0]].tolist()
+        # polygons that only differ by their vertices and debug id share a header so
+        # only make one for each run of polygons with the same properties
+        keys = [self._columns[key][start:stop] for key in self.COLUMNS.keys()
+                if key != 'debug_id']
+        changed = np.zeros(stop - start, dtype=bool)
+        changed[0] = True
+        for column in keys:
+            changed[1:] |= column[1:] != column[:-1]
+        cache = {}
+        headers = []
+        for index in np.flatnonzero(changed).tolist():
+            key = tuple(column[index] for column in keys)
+            if key not in cache:
+                cache[key] = self._header(start + index)
+            headers.append(cache[key])
+        runs = (np.cumsum(changed) - 1).tolist()
+        n_vertices = np.diff(offsets).tolist()
+        debug_ids = self._columns['debug_id'][start:stop].tolist()
+        tail = b.POLYGON_FORMAT.split("{polygon}")[1]
+        parts = []
+        for index, run in enumerate(runs):
+            head, middle, end = headers[run]
+            parts += [head, str(n_vertices[index]), middle, str(debug_ids[index]), end,
+                      text[bounds[index]:bounds[index + 1]], tail]
+        return "".join(parts)
+
+    def _header(self, index):
+        # the text before the vertices of a polygon split around the number of
+        # vertices and the debug id
+        columns = self._columns
+        to_level = columns['to_level'][index]
+        tech_layer = columns['tech_layer'][index]
+        if tech_layer >= 0:
+            inherit = "INH" if columns['inherit'][index] else "NOH"
+            tech_layer = b.TECHLAYER_NAME_FORMAT.format(name=self.tech_layers[tech_layer],
+                                                        inherit=inherit)
+        else:
+            tech_layer = ''
+        level = b.LEVEL_FORMAT.format(
+            level=columns['level'][index], n_vertices="{n_vertices}",
+            material=columns['material'][index],
+            fill_type=FILL_TYPE_CODES[columns['fill_type'][index]],
+            debug_id="{debug_id}", x_min=columns['x_min'][index],
+            y_min=columns['y_min'][index], x_max=columns['x_max'][index],
+            y_max=columns['y_max'][index],
+            conformal_max=_format_number(columns['conformal_max'][index]),
+            edge_mesh="Y" if columns['edge_mesh'][index] else "N")
+        header = b.POLYGON_FORMAT.split("{polygon}")[0].format(
+            polygon_type=b.POLYGON_TYPES[POLYGON_TYPE_NAMES[columns['polygon_type'][index]]],
+            level=level, to_level=self.to_levels[to_level] if to_level >= 0 else '',
+            tech_layer=tech_layer)
+        head, rest = header.split("{n_vertices}")
+        middle, end = rest.split("{debug_id}")
+        return head, middle, end
+
+    def to_string(self):
+        """Returns the Sonnet text for all of the polygons in the table."""
+        return "".join(self.iter_strings())
+
+    def placed(self, shifts, transform=None):
+        """
+        Returns a new table with a copy of every polygon for each shift.
+
+        :param shifts: the translation of each copy (N x 2 array)
+        :param transform: a function applied to the vertices before they are
+            shifted (optional)
+        """
+        shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 2)
+        vertices = self.vertices if transform is None else transform(self.vertices)
+        vertices, offsets = _repeat(vertices, self.offsets, shifts)
+        table = PolygonTable()
+        table.to_levels = list(self.to_levels)
+        table.tech_layers = list(self.tech_layers)
+        table.append(vertices, offsets, **{key: np.tile(self[key], shifts.shape[0])
+                                           for key in self.COLUMNS.keys()})
+        return table
+
+    def to_arrays(self, prefix='polygon_'):
+        """
+        Returns the table as a dictionary of arrays which can be saved with
+        numpy.savez() and loaded again with from_arrays(). Integer columns are
+        stored with the smallest integer type that holds their values.
+
+        :param prefix: the start of each array name (string)
+        """
+        arrays = {'vertices': self.vertices, 'offsets': _smallest_integers(self.offsets),
+                  'to_levels': np.array(self.to_levels, dtype=str),
+                  'tech_layers': np.array(self.tech_layers, dtype=str)}
+        for key in self.COLUMNS.keys():
+            arrays[key] = _smallest_integers(self[key])
+        return {prefix + key: value for key, value in arrays.items()}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='polygon_'):
+        """
+        Creates a table from the arrays returned by to_arrays().
+
+        :param arrays: the arrays (dictionary)
+        :param prefix: the start of each array name (string)
+        """
+        table = cls()
+        table.to_levels = arrays[prefix + 'to_levels'].tolist()
+        table.tech_layers = arrays[prefix + 'tech_layers'].tolist()
+        table.append(arrays[prefix + 'vertices'], arrays[prefix + 'offsets'],
+                     **{key: arrays[prefix + key] for key in cls.COLUMNS.keys()})
+        return table
+
+    @classmethod
+    def from_string(cls, polygons):
+        """
+        Creates a table from the Sonnet text for a list of polygons (the lines
+        following the NUM statement in the GEO block).
+
+        :param polygons: the polygon text (string)
+        """
+        table = cls()
+        table.extend_from_lines(polygons.splitlines())
+        return table
+
+    def extend_from_lines(self, lines, stop=None):
+        """
+        Parses the Sonnet text for a list of polygons and adds them to the table.
+        The level and vertex lines are collected as text and converted into arrays
+        in large batches rather than one polygon at a time.
+
+        :param lines: an iterable of the polygon lines (strings)
+        :param stop: a line which ends the list of polygons (string)
+            If given, lines are only read up to and including this line so that
+            the polygons can be read from the middle of an open file.
+        """
+        lines = iter(lines)
+        batch = _PolygonBatch()
+        vertex_lines = batch.vertex_lines
+        polygon_type = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line == stop:
+                break
+            if line in _POLYGON_TYPE_LINES:
+                polygon_type = _POLYGON_TYPE_LINES[line]
+                continue
+            if line == 'END' or not line[0].isdigit() and line[0] != '-':
+                raise ValueError("polygon is missing its level line")
+            level_line = line
+            # the TOLEVEL and TLAYNAM lines come between the level line and vertices
+            to_level, tech_layer, inherit = -1, -1, False
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('TOLEVEL'):
+                    to_level = self.category('to_level', line)
+                elif line.startswith('TLAYNAM'):
+                    name, inherit = line.split(None, 1)[1].rsplit(None, 1)
+                    tech_layer = self.category('tech_layer', name.strip('"'))
+                    inherit = inherit == "INH"
+                else:
+                    break
+            # the level line gives the number of vertices so read them all at once
+            start = len(vertex_lines)
+            vertex_lines.append(line)
+            n_vertices = int(level_line.split(None, 2)[1])
+            vertex_lines.extend(itertools.islice(lines, max(n_vertices - 1, 0)))
+            for line in lines:
+                line = line.strip()
+                if line == 'END':
+                    break
+                if line:
+                    vertex_lines.append(line)
+            else:
+                raise ValueError("polygon is missing its END statement")
+            batch.add(level_line, len(vertex_lines) - start, polygon_type, to_level,
+                      tech_layer, inherit)
+            polygon_type = 0
+            if len(vertex_lines) > 2 ** 20:
+                batch.flush(self)
+        batch.flush(self)
+
+
+class EdgeIndex:
+    """
+    Spatial index of the polygon edges in a PolygonTable used to find the edge
+    with the closest midpoint to a point. The edges are grouped by level and by
+    technology layer so that a search can be restricted to either one.
+
+    New polygons in the table are picked up the next time the index is queried.
+    Each group keeps a k-d tree of its edges and a second, small tree of the edges
+    added since the first was built. The large tree is only rebuilt once the
+    small one holds a sizable fraction of the group.
+
+    :param table: the polygon table to index (PolygonTable)
+    """
+    def __init__(self, table):
+        self.table = table
+        self._n_indexed = 0
+        self._groups = {}
+
+    def copy(self, table):
+        """
+        Returns an index of 'table' that starts from the edges indexed so far. Use
+        this for a table made with PolygonTable.share() to avoid indexing it again.
+        """
+        # build the trees now so that they are shared instead of built by each copy
+        self.update()
+        for group in self._groups.values():
+            group.build()
+        index = EdgeIndex(table)
+        index._n_indexed = self._n_indexed
+        index._groups = {key: copy.copy(group) for key, group in self._groups.items()}
+        return index
+
+    def reset(self):
+        """Forget all indexed edges. Call this if polygons are changed in place."""
+        self._n_indexed = 0
+        self._groups = {}
+
+    def update(self):
+        """Add the edges of any polygons added to the table since the last update."""
+        table = self.table
+        if len(table) < self._n_indexed:
+            self.reset()
+        if len(table) == self._n_indexed:
+            return
+        start = self._n_indexed
+        offsets = table.offsets[start:]
+        vertices = table.vertices
+        # an edge joins vertex i to i + 1 unless i is the last vertex of a polygon
+        edges = np.arange(offsets[0], offsets[-1] - 1)
+        edges = edges[~np.isin(edges, offsets[1:] - 1)]
+        polygon_ids = np.searchsorted(table.offsets, edges, side='right') - 1
+        mid_points = (vertices[edges] + vertices[edges + 1]) / 2
+        keys = {None: slice(None)}
+        for name in ('level', 'tech_layer'):
+            values = table[name][polygon_ids]
+            for value in np.unique(values).tolist():
+                if name == 'tech_layer' and value < 0:
+                    continue
+                keys[(name, value)] = values == value
+        for key, selection in keys.items():
+            if key not in self._groups:
+                self._groups[key] = _EdgeGroup()
+            self._groups[key].add(mid_points[selection], edges[selection])
+        self._n_indexed = len(table)
+
+    def query(self, points, level=None):
+        """
+        Find the polygon edge with the closest midpoint to each point. Ties are
+        broken in favor of the polygon and edge that were added first.
+
+        :param points: the points to search from (N x 2 array)
+        :param level: only search this level (integer) or technology layer (string)
+            If None, all polygons are searched.
+        :return: a tuple of the polygon indices, edge indices within each polygon,
+            and edge midpoints (N x 2 array) for each point. The polygon index is -1
+            if there are no matching edges.
+        """
+        self.update()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if isinstance(level, str):
+            if level in self.table.tech_layers:
+                key = ('tech_layer', self.table.tech_layers.index(level))
+            else:
+                key = ('tech_layer', -1)
+        elif level is None:
+            key = None
+        else:
+            key = ('level', level)
+        group = self._groups.get(key)
+        if group is None or group.size == 0:
+            n = points.shape[0]
+            return np.full(n, -1), np.full(n, -1), np.full((n, 2), np.nan)
+        nearest = group.nearest(points)  # builds the group before its edges are read
+        edges = group.edges[nearest]
+        polygon_ids = np.searchsorted(self.table.offsets, edges, side='right') - 1
+        vertices = self.table.vertices
+        mid_points = (vertices[edges] + vertices[edges + 1]) / 2
+        return polygon_ids, edges - self.table.offsets[polygon_ids], mid_points
+
+
+class _EdgeGroup:
+    # the edge midpoints for one level or technology layer
+    def __init__(self):
+        self.mid_points = np.empty((0, 2), dtype=np.float64)
+        self.edges = np.empty(0, dtype=np.int64)
+        self.tree = None
+        self.n_tree = 0
+        self.pending_tree = None  # the edges added since the main tree was built
+        self._added = []  # arrays added since the last build
+        self._n_added = 0
+
+    def __copy__(self):
+        group = _EdgeGroup.__new__(_EdgeGroup)
+        group.__dict__.update(self.__dict__)
+        group._added = list(self._added)
+        return group
+
+    @property
+    def size(self):
+        return self.edges.size + self._n_added
+
+    def add(self, mid_points, edges):
+        # the arrays are joined in build() so that adding is linear in the edges
+        self._added.append((mid_points, edges))
+        self._n_added += edges.size
+
+    def build(self):
+        if self._added:
+            self.mid_points = np.concatenate([self.mid_points] +
+                                             [mid_points for mid_points, _ in self._added])
+            self.edges = np.concatenate([self.edges] + [edges for _, edges in self._added])
+            self._added = []
+            self._n_added = 0
+            self.pending_tree = None
+        # rebuild the tree if too many edges have been added since it was built
+        n_pending = self.size - self.n_tree
+        if self.tree is None or n_pending > max(256, self.n_tree // 4):
+            self.tree = cKDTree(self.mid_points)
+            self.n_tree = self.size
+            self.pending_tree = None
+        elif n_pending and self.pending_tree is None:
+            self.pending_tree = cKDTree(self.mid_points[self.n_tree:])
+
+    def nearest(self, points):
+        # returns the local index of the closest midpoint to each point
+        self.build()
+        best, best_distance = _nearest_in_tree(self.tree, self.mid_points[:self.n_tree],
+                                               points)
+        if self.pending_tree is not None:
+            # the edges added after the tree was built only win if they are closer
+            pending, pending_distance = _nearest_in_tree(
+                self.pending_tree, self.mid_points[self.n_tree:], points)
+            closer = pending_distance < best_distance
+            best[closer] = self.n_tree + pending[closer]
+        return best
+
+
+def _nearest_in_tree(tree, mid_points, points):
+    # the index of and distance to the closest midpoint in a tree to each point
+    # using the same distance calculation for every candidate so that ties are exact
+    rows = np.arange(points.shape[0])
+    k = min(8, mid_points.shape[0])
+    tree_distance, index = tree.query(points, k=k)
+    tree_distance = tree_distance.reshape(-1, k)
+    index = np.sort(index.reshape(-1, k), axis=1)
+    distance = np.linalg.norm(mid_points[index] - points[:, np.newaxis], axis=2)
+    # the midpoints are stored in the order they were added so argmin picks the
+    # earliest edge when there is a tie
+    choice = np.argmin(distance, axis=1)
+    best = index[rows, choice]
+    best_distance = distance[rows, choice]
+    # there may be more tied edges than the k neighbors that were returned
+    tied = tree_distance[:, -1] <= best_distance * (1 + 1e-12)
+    for row in np.flatnonzero(tied & (k < mid_points.shape[0])).tolist():
+        near = np.sort(tree.query_ball_point(points[row],
+                                             best_distance[row] * (1 + 1e-12)))
+        near_distance = np.linalg.norm(mid_points[near] - points[row], axis=1)
+        best[row] = near[np.argmin(near_distance)]
+        best_distance[row] = near_distance.min()
+    return best, best_distance
+
+
+class Instance:
+    """
+    A placement of a cell of polygons, or of an array of copies of the cell, in the
+    same form as a gdstk reference. The cell is reflected across the x axis if
+    'x_reflection' is True, rotated by 'rotation' radians, and then moved to
+    'origin'. The copies in an array are 'spacing' apart in x (columns) and y
+    (rows).
+    """
+    def __init__(self, cell, origin=(0, 0), rotation=0, x_reflection=False,
+                 columns=1, rows=1, spacing=(0, 0)):
+        self.cell = cell
+        self.origin = tuple(float(value) for value in origin)
+        self.rotation = float(rotation)
+        self.x_reflection = bool(x_reflection)
+        self.magnification = 1.0
+        self.columns = int(columns)
+        self.rows = int(rows)
+        self.spacing = tuple(float(value) for value in spacing)
+
+    @property
+    def size(self):
+        """The number of copies of the cell."""
+        return self.columns * self.rows
+
+    def transform(self, vertices):
+        """Returns the vertices of a cell transformed for the first copy."""
+        return _reference_transform(self)(vertices)
+
+    def shifts(self):
+        """Returns the shift of each copy from the first as an N x 2 array."""
+        columns, rows = np.meshgrid(np.arange(self.columns), np.arange(self.rows),
+                                    indexing='ij')
+        return np.column_stack([columns.ravel() * self.spacing[0],
+                                rows.ravel() * self.spacing[1]])
+
+    def parameters(self):
+        """Returns the placement as a tuple of eight numbers."""
+        return self.origin + (self.rotation, self.x_reflection, self.columns,
+                              self.rows) + self.spacing
+
+    @classmethod
+    def from_parameters(cls, cell, parameters):
+        """Creates an instance from the numbers returned by parameters()."""
+        x, y, rotation, x_reflection, columns, rows, dx, dy = parameters
+        return cls(cell, (x, y), rotation, x_reflection, columns, rows, (dx, dy))
+
+
+def stack_polygons(polygons):
+    """
+    Stacks a list of N x 2 vertex arrays into one array.
+
+    :param polygons: a list of N x 2 arrays (or nested lists)
+    :return: a tuple of the stacked vertices and the start of each polygon in them
+        with the total number of vertices appended
+    """
+    polygons = [np.asarray(polygon, dtype=np.float64) for polygon in polygons]
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    if not polygons:
+        return np.empty((0, 2), dtype=np.float64), offsets
+    offsets[1:] = np.cumsum([polygon.shape[0] for polygon in polygons])
+    for polygon in polygons:
+        if polygon.ndim != 2 or polygon.shape[1] != 2:
+            raise ValueError("each polygon must be an N x 2 array of vertices")
+    return np.concatenate(polygons), offsets
+
+
+def close_polygons(vertices, offsets):
+    """
+    Adds the first vertex to the end of every polygon that isn't already closed.
+
+    :param vertices: the stacked polygon vertices (N x 2 array)
+    :param offsets: the start of each polygon in vertices with N appended
+    :return: a tuple of the closed vertices and offsets
+    """
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    is_open = np.any(vertices[first] != vertices[last], axis=1)
+    if not is_open.any():
+        return vertices, offsets
+    vertices = np.insert(vertices, offsets[1:][is_open], vertices[first[is_open]],
+                         axis=0)
+    offsets = offsets + np.concatenate([[0], np.cumsum(is_open)])
+    return vertices, offsets
+
+
+def concatenate_polygons(arrays):
+    """
+    Joins groups of stacked polygons.
+
+    :param arrays: a list of (vertices, offsets) tuples
+    :return: a tuple of the joined vertices and offsets
+    """
+    sizes = np.cumsum([0] + [vertices.shape[0] for vertices, _ in arrays])
+    vertices = np.concatenate([vertices for vertices, _ in arrays])
+    offsets = np.concatenate([offsets[:-1] + size for size, (_, offsets)
+                              in zip(sizes, arrays)] + [sizes[-1:]])
+    return vertices, offsets
+
+
+def merge_polygons(table, keep=None, precision=1e-3):
+    """
+    Returns a new table where the overlapping and touching polygons that share
+    every property except their debug id are joined into as few polygons as
+    possible with gdstk.boolean(). The joined polygons have a debug id of 0 and
+    come after the polygons that weren't changed. A group is left as it is if
+    joining its polygons doesn't reduce their number.
+
+    :param table: the polygons to merge (PolygonTable)
+    :param keep: polygons that are copied without being merged (boolean array)
+    :param precision: the precision of the boolean operation (float)
+    :return: the merged polygons (PolygonTable)
+    """
+    try:
+        import gdstk
+    except ImportError:
+        raise ImportError("gdstk is needed to merge polygons: pip install gdstk")
+    keep = (np.zeros(len(table), dtype=bool) if keep is None
+            else np.asarray(keep, dtype=bool))
+    names = [key for key in table.COLUMNS.keys() if key != 'debug_id']
+    candidates = np.flatnonzero(~keep)
+    keys = np.column_stack([table[key][candidates].astype(np.float64)
+                            for key in names]).reshape(candidates.size, len(names))
+    _, groups = np.unique(keys, axis=0, return_inverse=True)
+    polygons = np.split(table.vertices, table.offsets[1:-1])
+    unchanged = keep.copy()
+    merged = []
+    for group in range(groups.max() + 1 if groups.size else 0):
+        members = candidates[groups.ravel() == group]
+        result = []
+        if members.size > 1:
+            result = gdstk.boolean([polygons[index] for index in members], [],
+                                   'or', precision=precision)
+        if members.size < 2 or len(result) >= members.size:
+            unchanged[members] = True
+            continue
+        if result:
+            vertices, offsets = close_polygons(*stack_polygons(
+                [polygon.points for polygon in result]))
+            merged.append((members[0], vertices, offsets))
+    new_table = table.take(np.flatnonzero(unchanged))
+    for index, vertices, offsets in sorted(merged, key=lambda item: item[0]):
+        new_table.append(vertices, offsets, debug_id=0,
+                         **{key: table[key][index] for key in names})
+    log.debug("{} polygon(s) merged into {}".format(
+        len(table) - int(unchanged.sum()), len(new_table) - int(unchanged.sum())))
+    return new_table
+
+
+def condition_polygons(table, cell_size, keep=None):
+    """
+    Returns a new table with every vertex snapped to the cell grid, the duplicate
+    and collinear vertices of each polygon removed, and the sliver polygons that
+    have no area after snapping removed. Each polygon is handled with array
+    operations on all of the vertices at once.
+
+    :param table: the polygons to condition (PolygonTable)
+    :param cell_size: the x and y size of a cell (tuple of floats)
+    :param keep: polygons that are copied without being changed (boolean array)
+    :return: a tuple of the new table and a dictionary with the number of
+        vertices that were moved ('snapped') and the number of vertices, edges and
+        polygons that were removed
+    """
+    cell_size = np.asarray(cell_size, dtype=np.float64)
+    keep = (np.zeros(len(table), dtype=bool) if keep is None
+            else np.asarray(keep, dtype=bool))
+    selected = np.flatnonzero(~keep)
+    source = table.take(selected)
+    vertices, offsets = source.vertices, source.offsets
+    # work with open polygons in units of cells so that the tests are exact
+    lengths = np.diff(offsets)
+    closed = np.zeros(lengths.size, dtype=bool)
+    non_empty = lengths > 0
+    closed[non_empty] = np.all(vertices[offsets[:-1][non_empty]] ==
+                               vertices[offsets[1:][non_empty] - 1], axis=1)
+    is_last = np.zeros(vertices.shape[0], dtype=bool)
+    is_last[offsets[1:][closed] - 1] = True
+    grid = np.round(vertices[~is_last] / cell_size)
+    snapped = int(np.any(grid * cell_size != vertices[~is_last], axis=1).sum())
+    lengths = lengths - closed
+    edges = int(lengths.sum())
+    ids = np.repeat(np.arange(lengths.size), lengths)
+    for test in itertools.cycle(("duplicate", "collinear")):
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[ids]
+        position = np.arange(ids.size)
+        local = position - starts
+        next_ = np.where(local + 1 == lengths[ids], starts, position + 1)
+        if test == "duplicate":
+            remove = np.all(grid == grid[next_], axis=1)
+        else:
+            prev = np.where(local == 0, starts + lengths[ids] - 1, position - 1)
+            d1 = grid - grid[prev]
+            d2 = grid[next_] - grid
+            remove = d1[:, 0] * d2[:, 1] - d1[:, 1] * d2[:, 0] == 0
+        if not remove.any():
+            if test == "collinear":
+                break
+            continue
+        grid, ids = grid[~remove], ids[~remove]
+        lengths = np.bincount(ids, minlength=lengths.size)
+    # remove the polygons without any area
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    area = np.zeros(lengths.size)
+    if ids.size:
+        next_ = np.arange(1, ids.size + 1)
+        next_[np.cumsum(lengths)[lengths > 0] - 1] = starts[lengths > 0]
+        cross = grid[:, 0] * grid[next_, 1] - grid[next_, 0] * grid[:, 1]
+        area[lengths > 0] = np.add.reduceat(cross, starts[lengths > 0])
+    survive = (lengths >= 3) & (area != 0)
+    vertices = (grid * cell_size)[survive[ids]]
+    offsets = np.concatenate([[0], np.cumsum(lengths[survive])])
+    conditioned = PolygonTable()
+    conditioned.to_levels = list(table.to_levels)
+    conditioned.tech_layers = list(table.tech_layers)
+    conditioned.append(*close_polygons(vertices, offsets),
+                       **{key: source[key][survive] for key in table.COLUMNS.keys()})
+    # put the unchanged polygons back in their original positions
+    unchanged = table.take(np.flatnonzero(keep))
+    conditioned.append(unchanged.vertices, unchanged.offsets,
+                       **{key: unchanged[key] for key in table.COLUMNS.keys()})
+    order = np.concatenate([selected[survive], np.flatnonzero(keep)])
+    new_table = conditioned.take(np.argsort(order, kind='stable'))
+    removed = {'snapped': snapped,
+               'vertices': source.n_vertices - (conditioned.n_vertices -
+                                                unchanged.n_vertices),
+               'edges': edges - int(lengths[survive].sum()),
+               'polygons': int((~survive).sum())}
+    log.debug("{snapped} vertices snapped to the grid and {vertices} vertices, "
+              "{edges} edges and {polygons} polygons removed".format(**removed))
+    return new_table, removed
+
+
+def grid_candidates(coordinates, box_width, resolution=1e-8):
+    """
+    Finds the cell sizes along one axis that evenly divide the box and are
+    multiples of the greatest common divisor of the coordinates, and measures how
+    far the coordinates would be from each grid.
+
+    :param coordinates: the coordinates along the axis (array of floats)
+    :param box_width: the width of the box along the axis (float)
+    :param resolution: coordinates are rounded to multiples of this (float)
+    :return: a tuple of the smallest distance between two different coordinates
+        and a list of (cell size, number of cells, largest distance to the grid,
+        number of coordinates off the grid) tuples from the finest to the coarsest
+        grid
+    """
+    values = np.append(np.asarray(coordinates, dtype=np.float64).ravel(), [0, box_width])
+    values, counts = np.unique(np.round(values / resolution).astype(np.int64),
+                               return_counts=True)
+    gcd = int(np.gcd.reduce(values))
+    n_gcd = int(round(box_width / resolution)) // gcd
+    factors = np.arange(1, int(np.sqrt(n_gcd)) + 1)
+    factors = factors[n_gcd % factors == 0]
+    factors = np.unique(np.concatenate([factors, n_gcd // factors]))
+    candidates = []
+    for cell in (gcd * factors).tolist():
+        remainder = values % cell
+        error = np.minimum(remainder, cell - remainder)
+        candidates.append((cell * resolution, n_gcd * gcd // cell,
+                           int(error.max()) * resolution, int(counts[error > 0].sum())))
+    return int(np.diff(values).min()) * resolution, candidates
+
+
+def count_subsections(table, cell_size, max_cells=(np.inf, np.inf), speed=0,
+                      n_levels=1):
+    """
+    Estimates the number of subsections that Sonnet makes for each polygon. Metal
+    polygons get interior subsections up to the maximum subsection size and a
+    row of edge subsections along their edges when edge meshing is on. Staircase
+    and diagonal fills add a subsection for each step along a diagonal edge while
+    conformal fill follows the edges with subsections up to 'conformal_max' long.
+    Vias are counted from their meshing fill for each level that they span and
+    dielectric bricks from their area. The estimate is only meant for comparing
+    projects and judging their cost before they are run.
+
+    :param table: the polygons (PolygonTable)
+    :param cell_size: the x and y size of a cell (tuple of floats)
+    :param max_cells: the largest subsection size in cells allowed by the
+        wavelength along x and y (tuple of floats)
+    :param speed: the Sonnet speed setting where 1 halves the edge subsections and
+        2 removes them (integer)
+    :param n_levels: the number of metal levels used for vias to ground (integer)
+    :return: the number of subsections for each polygon (array of integers)
+    """
+    n = len(table)
+    cell_size = np.asarray(cell_size, dtype=np.float64)
+    vertices = table.vertices
+    ids = np.repeat(np.arange(n), np.diff(table.offsets))
+    valid = ids[:-1] == ids[1:]
+    edge_ids = ids[:-1][valid]
+    start, stop = vertices[:-1][valid], vertices[1:][valid]
+    delta = np.abs(stop - start) / cell_size
+    diagonal = np.min(delta, axis=1) * np.all(delta > 0, axis=1)
+    cross = start[:, 0] * stop[:, 1] - stop[:, 0] * start[:, 1]
+
+    def per_polygon(weights):
+        return np.bincount(edge_ids, weights=weights, minlength=n)
+    along_x, along_y = per_polygon(delta[:, 0]), per_polygon(delta[:, 1])
+    area = np.abs(per_polygon(cross)) / 2 / cell_size.prod()
+    length = per_polygon(np.hypot(*(stop - start).T))
+    size_x = np.maximum(np.minimum(table['x_max'], max_cells[0]), table['x_min'])
+    size_y = np.maximum(np.minimum(table['y_max'], max_cells[1]), table['y_min'])
+    # metal polygons
+    conformal = np.where(table['conformal_max'] > 0, table['conformal_max'],
+                         size_x * cell_size[0])
+    edges = np.where(table['fill_type'] == FILL_TYPE_CODES.index('V'),
+                     length / conformal,
+                     along_x / size_x + along_y / size_y + per_polygon(diagonal))
+    edges *= table['edge_mesh'] * {0: 1, 1: 0.5}.get(speed, 0)
+    edges[table['polygon_type'] == POLYGON_TYPE_NAMES.index('dielectric brick')] = 0
+    counts = area / (size_x * size_y) + edges
+    # vias
+    vias = table['polygon_type'] == POLYGON_TYPE_NAMES.index('via')
+    for code, to_level in enumerate(table.to_levels):
+        selected = vias & (table['to_level'] == code)
+        _, level, fill, _ = to_level.split()
+        level = {'GND': n_levels, 'TOP': 0}.get(level, level)
+        fill = {'RING': along_x + along_y, 'BAR': (along_x + along_y) / 2,
+                'SOLID': area, 'CENTER': np.ones(n),
+                'VERTICES': np.diff(table.offsets) - 1}[fill]
+        span = np.maximum(np.abs(int(level) - table['level']), 1)
+        counts[selected] = (fill * span)[selected]
+    return np.maximum(np.ceil(counts), 1).astype(np.int64)
+
+
+def crossing_intervals(table, axis, position):
+    """
+    Finds where the polygons cross a line perpendicular to 'axis' at 'position'.
+
+    :param table: the polygons (PolygonTable)
+    :param axis: 0 for a vertical line at x = position and 1 for a horizontal line
+        at y = position (integer)
+    :param position: the position of the line (float)
+    :return: a tuple of the polygon index of each interval where a polygon
+        covers the line (array of integers), the intervals along the line (N x 2
+        array), and whether every crossed edge is perpendicular to the line
+        (boolean)
+    """
+    vertices = table.vertices
+    ids = np.repeat(np.arange(len(table)), np.diff(table.offsets))
+    valid = ids[:-1] == ids[1:]
+    start, stop = vertices[:-1][valid], vertices[1:][valid]
+    low = np.minimum(start[:, axis], stop[:, axis])
+    high = np.maximum(start[:, axis], stop[:, axis])
+    crossed = (low < position) & (position < high)
+    start, stop, ids = start[crossed], stop[crossed], ids[:-1][valid][crossed]
+    other = 1 - axis
+    perpendicular = bool(np.all(start[:, other] == stop[:, other]))
+    fraction = (position - start[:, axis]) / (stop[:, axis] - start[:, axis])
+    values = start[:, other] + fraction * (stop[:, other] - start[:, other])
+    # each polygon covers the line between pairs of its sorted crossings
+    order = np.lexsort((values, ids))
+    return ids[order][::2], values[order].reshape(-1, 2), perpendicular
+
+
+def crossing_ranges(table, axis, positions):
+    """
+    Finds which of many lines perpendicular to 'axis' each polygon edge crosses.
+    The edges are compared to the sorted positions with one search instead of
+    one pass over the table per position.
+
+    :param table: the polygons (PolygonTable)
+    :param axis: 0 for vertical lines at x = position and 1 for horizontal lines
+        at y = position (integer)
+    :param positions: the sorted positions of the lines (array of floats)
+    :return: a tuple of the polygon index of each edge (array of integers), the
+        start and stop vertices of each edge (M x 2 arrays), and the first and one
+        past the last index of the positions that each edge crosses (arrays of
+        integers)
+    """
+    vertices = table.vertices
+    ids = np.repeat(np.arange(len(table)), np.diff(table.offsets))
+    valid = ids[:-1] == ids[1:]
+    start, stop, ids = vertices[:-1][valid], vertices[1:][valid], ids[:-1][valid]
+    low = np.minimum(start[:, axis], stop[:, axis])
+    high = np.maximum(start[:, axis], stop[:, axis])
+    # an edge crosses a line if low < position < high like in crossing_intervals()
+    first = np.searchsorted(positions, low, side='right')
+    last = np.maximum(np.searchsorted(positions, high, side='left'), first)
+    return ids, start, stop, first, last
+
+
+def cumulative_counts(table, counts, axis, positions):
+    """
+    Spreads the subsection count of each polygon evenly over its extent along
+    'axis' and returns the total count before each position.
+
+    :param table: the polygons (PolygonTable)
+    :param counts: the number of subsections of each polygon (array)
+    :param axis: 0 to count along x and 1 to count along y (integer)
+    :param positions: where to find the totals (array of floats)
+    :return: the total number of subsections before each position (array)
+    """
+    starts = table.offsets[:-1]
+    stops = table.offsets[1:]
+    non_empty = stops > starts
+    coordinates = table.vertices[:, axis]
+    low = np.minimum.reduceat(coordinates, starts[non_empty])
+    high = np.maximum.reduceat(coordinates, starts[non_empty])
+    counts = np.asarray(counts, dtype=np.float64)[non_empty]
+    # the total is piecewise linear with a slope that changes at each polygon edge
+    width = np.maximum(high - low, 1e-12)
+    breakpoints = np.concatenate([low, high + (high == low) * 1e-12])
+    slopes = np.concatenate([counts / width, -counts / width])
+    order = np.argsort(breakpoints, kind='stable')
+    breakpoints, slopes = breakpoints[order], np.cumsum(slopes[order])
+    totals = np.concatenate([[0], np.cumsum(slopes[:-1] * np.diff(breakpoints))])
+    return np.interp(positions, breakpoints, totals, left=0, right=counts.sum())
+
+
+def polygon_areas(table):
+    """Returns the signed area of each polygon from the shoelace formula."""
+    vertices = table.vertices
+    ids = np.repeat(np.arange(len(table)), np.diff(table.offsets))
+    valid = ids[:-1] == ids[1:]
+    start, stop = vertices[:-1][valid], vertices[1:][valid]
+    cross = start[:, 0] * stop[:, 1] - stop[:, 0] * start[:, 1]
+    return np.bincount(ids[:-1][valid], weights=cross, minlength=len(table)) / 2
+
+
+def self_intersections(table):
+    """
+    Finds the polygons with two edges that cross each other. Only the edges that
+    share a cell of a small grid laid over each polygon are compared, so the time
+    grows with the number of edges instead of its square. Edges that only touch,
+    like the cut of a polygon with a hole, are not counted as crossing.
+
+    :param table: the polygons (PolygonTable)
+    :return: the indices of the self-intersecting polygons (array of integers)
+    """
+    vertices = table.vertices
+    lengths = np.diff(table.offsets)
+    ids = np.repeat(np.arange(len(table)), lengths)
+    valid = ids[:-1] == ids[1:]
+    start, stop, ids = vertices[:-1][valid], vertices[1:][valid], ids[:-1][valid]
+    if not ids.size:
+        return np.zeros(0, dtype=np.int64)
+    # a grid of about n x n cells over a polygon with n^2 edges
+    n_edges = np.bincount(ids, minlength=len(table))
+    n_cells = np.ceil(np.sqrt(n_edges)).astype(np.int64)
+    # the edges of each polygon are next to each other
+    low = np.full((len(table), 2), np.inf)
+    high = np.full((len(table), 2), -np.inf)
+    firsts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+    low[ids[firsts]] = np.minimum.reduceat(np.minimum(start, stop), firsts)
+    high[ids[firsts]] = np.maximum.reduceat(np.maximum(start, stop), firsts)
+    size = np.maximum((high - low) / np.maximum(n_cells, 1)[:, np.newaxis], 1e-300)
+    first = np.floor((np.minimum(start, stop) - low[ids]) / size[ids]).astype(np.int64)
+    last = np.floor((np.maximum(start, stop) - low[ids]) / size[ids]).astype(np.int64)
+    first = np.minimum(first, n_cells[ids, np.newaxis] - 1)
+    last = np.minimum(last, n_cells[ids, np.newaxis] - 1)
+    # list every (cell, edge) pair
+    span = last - first + 1
+    counts = span[:, 0] * span[:, 1]
+    edge = np.repeat(np.arange(ids.size), counts)
+    local = np.arange(edge.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    cx = first[edge, 0] + local % span[edge, 0]
+    cy = first[edge, 1] + local // span[edge, 0]
+    cell_offsets = np.concatenate([[0], np.cumsum(n_cells ** 2)])
+    cell = cell_offsets[ids[edge]] + cy * n_cells[ids[edge]] + cx
+    order = np.argsort(cell, kind='stable')
+    cell, edge = cell[order], edge[order]
+    # pair each edge with the ones after it in the same cell
+    group_start = np.flatnonzero(np.concatenate([[True], cell[1:] != cell[:-1]]))
+    group_size = np.diff(np.append(group_start, cell.size))
+    group_end = np.repeat(group_start + group_size, group_size)
+    n_pairs = group_end - np.arange(cell.size) - 1
+    first = np.repeat(np.arange(cell.size), n_pairs)
+    second = first + 1 + np.arange(first.size) - \
+        np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    first, second = edge[first], edge[second]
+    if not first.size:
+        return np.zeros(0, dtype=np.int64)
+
+    def orientation(p, q, r):
+        return np.sign((q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) -
+                       (q[:, 1] - p[:, 1]) * (r[:, 0] - p[:, 0]))
+    p1, p2, q1, q2 = start[first], stop[first], start[second], stop[second]
+    crossed = ((orientation(p1, p2, q1) * orientation(p1, p2, q2) < 0) &
+               (orientation(q1, q2, p1) * orientation(q1, q2, p2) < 0))
+    return np.unique(ids[first[crossed]])
+
+
+def polygon_signatures(table, resolution, mirror_y=None):
+    """
+    Returns a 64 bit hash for each polygon from its set of vertices and all of its
+    properties except the debug id. Two polygons with the same vertices, to within
+    the resolution, and properties have the same signature however their vertices
+    are ordered.
+
+    :param table: the polygons (PolygonTable)
+    :param resolution: the vertices are rounded to multiples of this (float)
+    :param mirror_y: the y coordinate of a horizontal line to mirror the
+        polygons across before they are hashed (optional, float)
+    :return: the signatures (array of unsigned 64 bit integers)
+    """
+    grid = np.round(table.vertices / resolution).astype(np.int64)
+    if mirror_y is not None:
+        grid[:, 1] = int(round(2 * mirror_y / resolution)) - grid[:, 1]
+    grid = grid.astype(np.uint64)
+    hashes = _mix(_mix(grid[:, 0]) ^ grid[:, 1])
+    starts = table.offsets[:-1]
+    signatures = np.zeros(len(table), dtype=np.uint64)
+    non_empty = np.diff(table.offsets) > 0
+    # the closing vertex repeats whichever vertex is first so it isn't included
+    last = table.offsets[1:][non_empty] - 1
+    closed = np.all(grid[starts[non_empty]] == grid[last], axis=1)
+    hashes[last[closed]] = 0
+    if non_empty.any():
+        signatures[non_empty] = np.add.reduceat(hashes, starts[non_empty])
+    # the categorical columns are hashed by name since the codes depend on the table
+    names = {'to_level': table.to_levels, 'tech_layer': table.tech_layers}
+    for key in table.COLUMNS.keys():
+        if key == 'debug_id':
+            continue
+        values = table[key]
+        if key in names:
+            lookup = np.array([hash(name) for name in names[key]] + [-1], dtype=np.int64)
+            values = lookup[values]
+        elif values.dtype == np.float64:
+            values = values.view(np.int64)
+        signatures = _mix(signatures ^ values.astype(np.int64).astype(np.uint64))
+    return signatures
+
+
+def _mix(values):
+    # the splitmix64 finalizer which scrambles the bits of 64 bit integers
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def flatten_gdstk_cell(cell):
+    """
+    Returns the polygons of a gdstk cell and of all of the cells that it references
+    as stacked vertex arrays. Paths are converted to polygons. Each referenced cell
+    is only converted into arrays once and is then transformed and repeated for
+    every reference to it with array operations, so the time taken scales with
+    the unique geometry instead of the number of placed polygons.
+
+    :param cell: a gdstk cell (object)
+    :return: a dictionary mapping each (layer, datatype) to a tuple of the stacked
+        vertices (N x 2 array) and offsets of its polygons
+    """
+    return _flatten_gdstk_cell(cell, {})
+
+
+def _flatten_gdstk_cell(cell, cache):
+    if id(cell) in cache:
+        return cache[id(cell)][1]
+    groups = {}
+
+    def add(key, vertices, offsets, shifts=None):
+        if shifts is not None and len(shifts):
+            vertices, offsets = _repeat(vertices, offsets, shifts)
+        groups.setdefault(key, []).append((vertices, offsets))
+
+    polygons = list(cell.polygons)
+    for path in cell.paths:
+        polygons.extend(path.to_polygons())
+    # group the cell's own polygons and only loop over the ones that are repeated
+    keys = {}
+    for polygon in polygons:
+        if polygon.repetition.size:
+            add((polygon.layer, polygon.datatype),
+                *stack_polygons([polygon.points]), polygon.repetition.get_offsets())
+        else:
+            keys.setdefault((polygon.layer, polygon.datatype), []).append(polygon.points)
+    for key, points in keys.items():
+        add(key, *stack_polygons(points))
+    for reference in cell.references:
+        if not hasattr(reference.cell, 'references'):
+            log.debug("skipping the reference to '{}' which is not a gdstk Cell"
+                      .format(reference.cell_name))
+            continue
+        transform = _reference_transform(reference)
+        shifts = reference.repetition.get_offsets() if reference.repetition.size else None
+        for key, (vertices, offsets) in _flatten_gdstk_cell(reference.cell, cache).items():
+            add(key, transform(vertices), offsets, shifts)
+    result = {key: concatenate_polygons(arrays) for key, arrays in groups.items()}
+    # keep the cell so that its id isn't reused while the cache exists
+    cache[id(cell)] = (cell, result)
+    return result
+
+
+def _reference_transform(reference):
+    # returns a function applying the reflection, magnification, rotation and
+    # translation of a gdstk reference to an N x 2 array of vertices
+    scale = np.array([1, -1 if reference.x_reflection else 1]) * reference.magnification
+    cos, sin = np.cos(reference.rotation), np.sin(reference.rotation)
+    matrix = (np.array([[cos, sin], [-sin, cos]]) * scale[:, np.newaxis])
+    origin = np.array(reference.origin, dtype=np.float64)
+    return lambda vertices: vertices @ matrix + origin
+
+
+def _repeat(vertices, offsets, shifts):
+    # copies stacked polygons to each of the N x 2 shifts
+    shifts = np.asarray(shifts, dtype=np.float64)
+    vertices = (vertices[np.newaxis] + shifts[:, np.newaxis]).reshape(-1, 2)
+    starts = offsets[:-1] + offsets[-1] * np.arange(shifts.shape[0])[:, np.newaxis]
+    return vertices, np.append(starts.ravel(), vertices.shape[0])
+
+
+# the text for every integer from 0 to 9999 as four zero padded ASCII digits
+_DIGITS = np.frombuffer("".join(["{:04d}".format(i) for i in range(10000)]).encode(),
+                        dtype=np.uint8).reshape(10000, 4)
+
+
+def format_vertices(vertices, linesep=os.linesep):
+    """
+    Formats vertices as "{:.8f} {:.8f}" lines without a Python call per vertex.
+    Each number is split into integer and fractional digits with integer
+    arithmetic and the characters are assembled in a single byte array. Numbers
+    that are too close to a rounding tie for the scaled float to decide it are
+    rounded by Python so that the text is always the same as with format().
+
+    :param vertices: the vertices to format (N x 2 array)
+    :param linesep: the line separator to use after each vertex (string)
+    :return: a tuple of the text and the end index of each line in the text
+    """
+    flat = np.asarray(vertices, dtype=np.float64).ravel()
+    n = flat.size
+    if n == 0:
+        return '', np.zeros(0, dtype=np.int64)
+    magnitude = np.abs(flat)
+    if not np.all(magnitude < 1e10):  # too large for the integer path or not finite
+        lines = [("{:.8f} {:.8f}" + linesep).format(*vertex) for vertex in
+                 flat.reshape(-1, 2).tolist()]
+        return "".join(lines), np.cumsum([len(line) for line in lines])
+    scaled = magnitude * 1e8
+    digits = np.rint(scaled).astype(np.int64)
+    # the product is only correct to half a unit in the last place
+    tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 4 * np.spacing(scaled)
+    if np.any(tie):
+        digits[tie] = [int("{:.8f}".format(value).replace('.', ''))
+                       for value in magnitude[tie].tolist()]
+    integer, fraction = np.divmod(digits, 100000000)
+    n_groups = -(-len(str(int(integer.max()))) // 4)  # groups of four digits
+    n_integer = 4 * n_groups
+    separator = np.frombuffer(linesep.encode(), dtype=np.uint8)
+    width = n_integer + 10 + separator.size  # sign, integer, point, fraction, end
+    chars = np.empty((n, width), dtype=np.uint8)
+    chars[:, 0] = ord('-')
+    remainder = integer
+    for group in range(n_groups - 1, -1, -1):
+        remainder, digits = np.divmod(remainder, 10000)
+        chars[:, 1 + 4 * group:5 + 4 * group] = _DIGITS[digits]
+    chars[:, 1 + n_integer] = ord('.')
+    high, low = np.divmod(fraction, 10000)
+    chars[:, 2 + n_integer:6 + n_integer] = _DIGITS[high]
+    chars[:, 6 + n_integer:10 + n_integer] = _DIGITS[low]
+    chars[0::2, 10 + n_integer:] = ord(' ')
+    chars[1::2, 10 + n_integer:] = separator
+    # keep the sign of negative numbers, the significant integer digits, and
+    # only one space between the x and y values
+    keep = np.ones((n, width), dtype=bool)
+    keep[:, 0] = np.signbit(flat)
+    n_digits = np.searchsorted(10 ** np.arange(1, 19, dtype=np.int64), integer,
+                               side='right') + 1
+    keep[:, 1:1 + n_integer] = np.arange(n_integer)[::-1] < n_digits[:, np.newaxis]
+    keep[0::2, 11 + n_integer:] = False
+    line_ends = np.cumsum(keep.reshape(-1, 2 * width).sum(axis=1))
+    return chars[keep].tobytes().decode(), line_ends
+
+
+class _PolygonBatch:
+    # polygon text waiting to be converted into arrays and added to a table
+    def __init__(self):
+        self.level_lines = []
+        self.vertex_lines = []
+        self.n_lines = []
+        self.properties = []
+
+    def add(self, level_line, n_lines, polygon_type, to_level, tech_layer, inherit):
+        # the vertex lines are added to 'vertex_lines' directly by the caller
+        self.level_lines.append(level_line)
+        self.n_lines.append(n_lines)
+        self.properties.append((polygon_type, to_level, tech_layer, inherit))
+
+    def flush(self, table):
+        if not self.level_lines:
+            return
+        offsets = np.zeros(len(self.n_lines) + 1, dtype=np.int64)
+        np.cumsum(self.n_lines, out=offsets[1:])
+        vertices = np.fromstring(" ".join(self.vertex_lines), sep=" ")
+        if vertices.size == 2 * offsets[-1]:
+            vertices = vertices.reshape(-1, 2)
+        else:  # some vertex lines have extra values or are blank
+            vertices = np.array([line.split()[:2] for line in self.vertex_lines],
+                                dtype=np.float64)
+        columns = dict(zip(('polygon_type', 'to_level', 'tech_layer', 'inherit'),
+                           np.array(self.properties).T))
+        # the fill type and edge mesh letters are replaced by numbers so that the
+        # level lines can be read as numbers in one go. 'N' is both the first fill
+        # type and the edge mesh value for False so it is replaced by 0 in both.
+        text = " ".join(self.level_lines).translate(_LEVEL_LETTERS)
+        values = np.fromstring(text, sep=" ")
+        if values.size == 13 * len(self.level_lines):
+            values = values.reshape(-1, 13)
+            for key, index in (('level', 0), ('material', 2), ('fill_type', 3),
+                               ('debug_id', 4), ('x_min', 5), ('y_min', 6),
+                               ('x_max', 7), ('y_max', 8)):
+                columns[key] = values[:, index].astype(np.int64)
+            columns['conformal_max'] = values[:, 9]
+            columns['edge_mesh'] = values[:, 12] == 1
+        else:  # some level lines are not in the usual format
+            levels = [_parse_level(line) for line in self.level_lines]
+            for key in levels[0].keys():
+                columns[key] = np.array([level[key] for level in levels])
+        table.append(vertices, offsets, **columns)
+        for values in (self.level_lines, self.vertex_lines, self.n_lines, self.properties):
+            values.clear()
+
+
+def _smallest_integers(values):
+    # returns integer values with the smallest type that holds them all
+    if values.dtype.kind != 'i' or values.size == 0:
+        return values
+    dtype = np.result_type(np.min_scalar_type(values.min()),
+                           np.min_scalar_type(values.max()))
+    return values.astype(dtype)
+
+
+def _parse_level(line):
+    # the level line of a polygon as it is formatted by blocks.LEVEL_FORMAT
+    values = line.split()
+    return {'level': int(values[0]), 'material': int(values[2]),
+            'fill_type': FILL_TYPE_CODES.index(values[3]),
+            'debug_id': int(values[4]), 'x_min': int(values[5]),
+            'y_min': int(values[6]), 'x_max': int(values[7]),
+            'y_max': int(values[8]), 'conformal_max': float(values[9]),
+            'edge_mesh': values[12] == "Y"}
+
+
+def _format_number(value):
+    # write whole numbers without a decimal point like the user supplied ints
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
@@ -0,0 +1,185 @@
+import time
+import psutil
+import logging
+import threading
+import numpy as np
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# the values recorded in each sample
+SAMPLE_FIELDS = ('time', 'cpu_percent', 'rss', 'peak_rss', 'threads', 'processes',
+                 'read_bytes', 'write_bytes')
+
+
+class ResourceSampler:
+    """
+    Class for recording the resources used by a process and its children from a
+    background thread. Each sample holds the time since sampling started (s), the
+    total CPU percent (100 per busy core), resident memory (bytes), the largest
+    resident memory so far (bytes), thread count, process count and the bytes read
+    and written.
+
+    :param pid: the process ID of the parent process (integer)
+    :param interval: the time between samples in seconds (float)
+    """
+    def __init__(self, pid, interval=1.):
+        assert interval > 0, "'interval' must be positive"
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.samples = []
+        self.peak_rss = 0
+        self._processes = {}  # kept so cpu_percent() has a reference
+        self._start = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self._start = time.monotonic()
+        self._add(self.process)
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True,
+                                        name="pysonnet-sampler-{}".format(self.process.pid))
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and wait for the background thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sample(self):
+        """
+        Record the resources used by the process tree now.
+
+        :return: the sample (dict) or None if the process has finished
+        """
+        try:
+            children = self.process.children(recursive=True)
+        except psutil.Error:
+            return None
+        found = set()
+        for process in [self.process] + children:
+            if process.pid not in self._processes:
+                self._add(process)
+                found.add(process.pid)
+        sample = dict.fromkeys(SAMPLE_FIELDS[1:], 0)
+        for pid in [self.process.pid] + [child.pid for child in children]:
+            process = self._processes[pid]
+            try:
+                with process.oneshot():
+                    if pid in found:  # use the mean since it started until it's measured
+                        times = process.cpu_times()
+                        elapsed = time.time() - process.create_time()
+                        if elapsed > 0:
+                            sample['cpu_percent'] += \
+                                100 * (times.user + times.system) / elapsed
+                    else:
+                        sample['cpu_percent'] += process.cpu_percent()
+                    sample['rss'] += process.memory_info().rss
+                    sample['threads'] += process.num_threads()
+                    sample['processes'] += 1
+                    if hasattr(process, 'io_counters'):  # not available on macOS
+                        counters = process.io_counters()
+                        sample['read_bytes'] += counters.read_bytes
+                        sample['write_bytes'] += counters.write_bytes
+            except psutil.Error:  # the process finished while it was sampled
+                continue
+        if not sample['processes']:
+            return None
+        self.peak_rss = max(self.peak_rss, sample['rss'])
+        sample['peak_rss'] = self.peak_rss
+        sample['time'] = time.monotonic() - (self._start or time.monotonic())
+        self.samples.append(sample)
+        return sample
+
+    def _add(self, process):
+        # cpu_percent() returns 0 the first time it is called for a process, so it
+        # is called once when the process is found to start the measurement
+        self._processes[process.pid] = process
+        try:
+            process.cpu_percent()
+        except psutil.Error:
+            pass
+
+    def _sample_loop(self):
+        # sample until stopped or the process finishes
+        while True:
+            if self.sample() is None:
+                break
+            if self._stop.wait(self.interval):
+                break
+
+
+class RunReport:
+    """
+    Class for recording what happened during an em run. The last report of a
+    project is kept in project.report.
+
+    :param command: the command that runs em (list of str)
+    :param interval: the time between resource samples in seconds (float)
+        Resources aren't sampled if it isn't given.
+    """
+    def __init__(self, command, interval=None):
+        self.command = command
+        self.interval = interval
+        self.started = datetime.now()
+        self.finished = None
+        self.return_code = None
+        self.cached = False
+        self.subsections = None  # found in the em output if progress was parsed
+        self.samples = []
+        self.peak_rss = None
+        self._sampler = None
+
+    def __repr__(self):
+        return ("RunReport(return_code={}, duration={}, cached={}, samples={}, "
+                "peak_rss={})".format(self.return_code, self.duration, self.cached,
+                                      len(self.samples), self.peak_rss))
+
+    @property
+    def duration(self):
+        """The number of seconds em ran for or None if it hasn't finished."""
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def start(self, pid):
+        """
+        Start sampling the em process tree if there is a sampling interval.
+
+        :param pid: the em process ID (integer)
+        """
+        if self.interval is not None:
+            self._sampler = ResourceSampler(pid, self.interval).start()
+
+    def finish(self, return_code, progress=None):
+        """
+        Stop sampling and record the result of the run.
+
+        :param return_code: the em return code (integer or None)
+        :param progress: the ProgressParser used for the run (optional)
+        """
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.samples = self._sampler.samples
+            self.peak_rss = self._sampler.peak_rss
+            self._sampler = None
+        if progress is not None:
+            counts = [event['count'] for event in progress.events
+                      if event.kind == 'subsections']
+            if counts:
+                self.subsections = max(counts)
+        self.return_code = return_code
+        self.finished = datetime.now()
+        log.debug("{!r}".format(self))
+
+    def to_arrays(self):
+        """
+        Returns the samples as a dictionary of arrays, one for each recorded value,
+        e.g. for plotting report.to_arrays()['rss'] against ['time'].
+        """
+        return {field: np.array([sample[field] for sample in self.samples])
+                for field in SAMPLE_FIELDS}
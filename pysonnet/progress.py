@@ -0,0 +1,217 @@
+import re
+import time
+import queue
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+FREQUENCY_SCALES = {'hz': 1., 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9, 'thz': 1e12}
+MEMORY_SCALES = {'b': 1, 'kb': 2**10, 'mb': 2**20, 'gb': 2**30, 'tb': 2**40}
+_NUMBER = r"\d+(?:\.\d*)?(?:[eE][-+]?\d+)?"
+# the em verbose output lines that make events, e.g.
+#   Processing frequency 2 of 11: 5.000000 GHz
+#   Number of subsections: 2345
+#   Matrix fill time: 0:00:01.5
+#   Matrix solve time: 2.5 s
+#   Memory used: 12.3 MB
+#   ABS iteration 3
+#   EM Simulation Completed
+# every pattern is tried on each line in this order, so a frequency that starts on
+# a line is finished before the other values on the line are reported
+PATTERNS = [
+    ('frequency', re.compile(r"frequency\b\D*?(?:(?P<index>\d+)\s+of\s+(?P<total>\d+)"
+                             r"\D*?)?(?P<value>" + _NUMBER + r")\s*(?P<unit>[kmgt]?hz)\b",
+                             re.IGNORECASE)),
+    ('subsections', re.compile(r"(?:total\s+)?(?:number\s+of\s+)?subsections\s*[:=]?\s*"
+                               r"(?P<count>\d+)", re.IGNORECASE)),
+    ('matrix', re.compile(r"matrix\s+(?P<step>fill|solve)\w*\s+time\s*[:=]?\s*"
+                          r"(?P<time>.+)$", re.IGNORECASE)),
+    ('memory', re.compile(r"memory\D*?(?P<value>" + _NUMBER + r")\s*(?P<unit>[kmgt]?b)\b",
+                          re.IGNORECASE)),
+    ('abs_iteration', re.compile(r"\b(?:abs|adaptive\s+band\s+synthesis)\b.*?"
+                                 r"iteration\s*[:=#]?\s*(?P<iteration>\d+)",
+                                 re.IGNORECASE)),
+    ('completed', re.compile(r"em\s+simulation\s+completed", re.IGNORECASE))]
+
+
+class ProgressEvent:
+    """
+    Class for one step of an em run found in its verbose output.
+
+    :param kind: the type of event (str). One of 'frequency_started',
+        'frequency_finished', 'subsections', 'matrix_fill', 'matrix_solve',
+        'memory', 'abs_iteration' or 'completed'.
+    :param line: the line of em output that made the event (str)
+    :param data: the values of the event
+        frequency_started: frequency (Hz), index and total (integers or None)
+        frequency_finished: frequency (Hz), index, total, duration (s) and eta (s or
+            None if the number of frequencies isn't known)
+        subsections: count
+        matrix_fill and matrix_solve: seconds
+        memory: bytes
+        abs_iteration: iteration
+        completed: duration (s) since the first event
+    """
+    def __init__(self, kind, line, **data):
+        self.kind = kind
+        self.line = line
+        self.time = time.time()
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __repr__(self):
+        return "ProgressEvent('{}', {})".format(self.kind, self.data)
+
+
+class ProgressParser:
+    """
+    Class for turning the verbose output of em into ProgressEvents. Pass it to
+    Project.run() with the 'progress' argument or feed it lines directly. The
+    events are passed to the subscribed callbacks as they are found and can also
+    be read by iterating over the parser, e.g. from another thread, until the run
+    is finished.
+
+    :param callbacks: functions called with each ProgressEvent
+    """
+    def __init__(self, *callbacks):
+        self.callbacks = list(callbacks)
+        self.events = []
+        self.frequency_times = []  # (frequency, duration) for each finished point
+        self.closed = False
+        self._queue = queue.Queue()  # read by __iter__()
+        self._frequency = None  # the frequency being solved and when it started
+        self._start = None
+
+    def __iter__(self):
+        """Yields the events as they are found until close() is called."""
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+            yield event
+
+    def subscribe(self, callback):
+        """
+        Add a function to be called with each ProgressEvent.
+
+        :param callback: a function taking one ProgressEvent
+        """
+        self.callbacks.append(callback)
+
+    @property
+    def eta(self):
+        """
+        The estimated number of seconds left in the run from the mean time of the
+        finished frequencies or None if it can't be estimated.
+        """
+        if not self.frequency_times or self._frequency is None:
+            return None
+        _, index, total, _ = self._frequency
+        if total is None or index is None:
+            return None
+        mean = sum(duration for _, duration in self.frequency_times) / \
+            len(self.frequency_times)
+        return mean * (total - index + 1)
+
+    def feed(self, line):
+        """
+        Parse a line of em output. A line that reports several values, like a
+        frequency and its number of subsections, makes an event for each.
+
+        :param line: the line (str)
+        :return: a list of the events found in the line
+        """
+        events = []
+        for kind, pattern in PATTERNS:
+            match = pattern.search(line)
+            if match is not None:
+                events.extend(getattr(self, '_on_' + kind)(line, match.groupdict()))
+        for event in events:
+            self._emit(event)
+        return events
+
+    def close(self):
+        """Stop the iterators once they have read all of the events."""
+        if not self.closed:
+            self.closed = True
+            self._queue.put(None)
+
+    def _emit(self, event):
+        # record an event and send it to the subscribers
+        if self._start is None:
+            self._start = event.time
+        self.events.append(event)
+        self._queue.put(event)
+        for callback in self.callbacks:
+            callback(event)
+
+    def _finish_frequency(self, line):
+        # the event for the end of the frequency being solved if there is one
+        if self._frequency is None:
+            return []
+        frequency, index, total, start = self._frequency
+        duration = time.monotonic() - start
+        self.frequency_times.append((frequency, duration))
+        eta = None
+        if total is not None and index is not None:
+            mean = sum(value for _, value in self.frequency_times) / \
+                len(self.frequency_times)
+            eta = mean * (total - index)
+        self._frequency = None
+        return [ProgressEvent('frequency_finished', line, frequency=frequency,
+                              index=index, total=total, duration=duration, eta=eta)]
+
+    def _on_frequency(self, line, groups):
+        frequency = float(groups['value']) * FREQUENCY_SCALES[groups['unit'].lower()]
+        index = int(groups['index']) if groups['index'] else None
+        total = int(groups['total']) if groups['total'] else None
+        if self._frequency is not None and self._frequency[0] == frequency:
+            return []  # the same frequency mentioned again
+        events = self._finish_frequency(line)
+        self._frequency = (frequency, index, total, time.monotonic())
+        events.append(ProgressEvent('frequency_started', line, frequency=frequency,
+                                    index=index, total=total))
+        return events
+
+    def _on_subsections(self, line, groups):
+        return [ProgressEvent('subsections', line, count=int(groups['count']))]
+
+    def _on_matrix(self, line, groups):
+        seconds = _seconds(groups['time'])
+        if seconds is None:
+            return []
+        return [ProgressEvent('matrix_' + groups['step'].lower(), line, seconds=seconds)]
+
+    def _on_memory(self, line, groups):
+        size = float(groups['value']) * MEMORY_SCALES[groups['unit'].lower()]
+        return [ProgressEvent('memory', line, bytes=int(size))]
+
+    def _on_abs_iteration(self, line, groups):
+        return [ProgressEvent('abs_iteration', line, iteration=int(groups['iteration']))]
+
+    def _on_completed(self, line, groups):
+        events = self._finish_frequency(line)
+        duration = time.time() - self._start if self._start is not None else 0.
+        events.append(ProgressEvent('completed', line, duration=duration))
+        return events
+
+
+def _seconds(text):
+    # the number of seconds in a time like '0:01:02.5', '62.5 s' or '1.2 minutes'
+    text = text.strip().lower()
+    match = re.match(r"(\d+(?::\d+){1,2}(?:\.\d*)?)", text)
+    if match:
+        seconds = 0.
+        for part in match.group(1).split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    match = re.match(r"(" + _NUMBER + r")\s*(ms|s|sec|seconds?|m|min|minutes?|h|hours?)?\b",
+                     text)
+    if match is None:
+        return None
+    scale = {'ms': 1e-3, 'm': 60., 'min': 60., 'minute': 60., 'minutes': 60.,
+             'h': 3600., 'hour': 3600., 'hours': 3600.}.get(match.group(2), 1.)
+    return float(match.group(1)) * scale
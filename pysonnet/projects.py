@@ -1,21 +1,143 @@
 import os
+import json
+import asyncio
 import yaml
 import shlex
 import shutil
 import psutil
 import logging
 import pathlib
+import threading
 import subprocess
 import numpy as np
 from datetime import datetime
+from matplotlib import colors
+from matplotlib import pyplot as plt
+from matplotlib.patches import Rectangle
+from matplotlib.collections import PolyCollection
 
 import pysonnet.blocks as b
+from pysonnet.cache import ResultCache
 from pysonnet.sonnet import test_sonnet
+from pysonnet.monitor import RunReport
+from pysonnet.progress import ProgressParser
+from pysonnet.reader import read_sonnet_file
+from pysonnet.geometry import (PolygonTable, EdgeIndex, POLYGON_TYPE_NAMES,
+                               FILL_TYPE_CODES, stack_polygons, close_polygons,
+                               concatenate_polygons, flatten_gdstk_cell, merge_polygons,
+                               condition_polygons, grid_candidates,
+                               polygon_signatures, count_subsections,
+                               crossing_ranges, cumulative_counts, polygon_areas,
+                               self_intersections, Instance)
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 __version__ = '0.0.4'
+# increment if the binary project format changes in a way that older versions of
+# pysonnet can't read
+BINARY_FORMAT_VERSION = 1
+
+
+def _is_binary(file_path):
+    # projects are saved in the binary format if the file name ends with '.npz'
+    return pathlib.Path(file_path).suffix.lower() == '.npz'
+
+
+def _configuration_path():
+    # the user configuration if it exists and otherwise the default configuration
+    directory = os.path.dirname(__file__)
+    load_path = os.path.join(directory, 'user_configuration.yaml')
+    if not os.path.isfile(load_path):
+        load_path = os.path.join(directory, 'default_configuration.yaml')
+    return load_path
+
+
+def _read_lines(stream, callback):
+    # pass each non-empty line of a byte stream to the callback until it closes
+    for line in iter(stream.readline, b''):
+        message = line.decode('utf-8', errors='replace').strip()
+        if message:
+            callback(message)
+
+
+def _progress_parser(progress):
+    # a ProgressParser from a parser, a function taking events or None
+    if progress is None or isinstance(progress, ProgressParser):
+        return progress
+    return ProgressParser(progress)
+
+
+def _with_progress(callback, progress):
+    # a function passing each line to both the callback and the progress parser
+    if progress is None:
+        return callback
+
+    def read(line):
+        callback(line)
+        progress.feed(line)
+    return read
+
+
+async def _read_lines_async(stream, callback):
+    # pass each non-empty line of an asyncio stream to the callback until it closes
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        message = line.decode('utf-8', errors='replace').strip()
+        if message:
+            callback(message)
+
+
+class Section(dict):
+    """
+    Dictionary holding one section of a project. It remembers the Sonnet text
+    rendered from it so that the text is only made again after the section has
+    changed. Any change to the section sets 'dirty' and clears the rendered text.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = True
+        self.rendered = {}
+
+    def _changed(self):
+        self.dirty = True
+        self.rendered.clear()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def pop(self, *args):
+        self._changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._changed()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return super().setdefault(key, default)
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def copy(self):
+        section = Section(self)
+        section.dirty = self.dirty
+        section.rendered = dict(self.rendered)
+        return section
 
 
 class Project(dict):
@@ -25,23 +147,25 @@ class Project(dict):
 
     :param load_path: path to the yaml file for this project if it was saved (optional)
     """
+    # the (block template, project section) pairs in the order they are written
+    blocks = []
+    # the size of the write buffer used by make_sonnet_file()
+    buffer_size = 2 ** 20
+
     def __init__(self, load_path=None):
         super().__init__()
         self.project_file_path = None
+        # counts of the blocks that were reused or formatted by make_sonnet_file()
+        self.render_stats = {'hits': 0, 'misses': 0}
+        # the RunReport of the last run()
+        self.report = None
         self.sections = ['sonnet', 'dimensions', 'frequency', 'geometry', 'control',
                          'optimization', 'parameter_sweep', 'output_file',
                          'parameter_netlist', 'circuit', 'subdivider',
                          'quick_start_guide', 'component_data_files', 'translators']
-        if load_path is not None:
-            self.load(load_path)
-        else:
-            directory = os.path.dirname(__file__)
-            load_path = os.path.join(directory, 'user_configuration.yaml')
-            if not os.path.isfile(load_path):
-                load_path = os.path.join(directory, 'default_configuration.yaml')
-            self.load(load_path)
         self.object_ids = []
         self.port_numbers = []
+        self.load(load_path if load_path is not None else _configuration_path())
 
     def make_sonnet_file(self, file_path):
         """
@@ -51,12 +175,87 @@ class Project(dict):
         """
         raise NotImplementedError
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value if isinstance(value, Section) else Section(value))
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def variant(self):
+        """
+        Returns a copy of the project which can be changed without changing this
+        one. The sections are copied shallowly so the strings in them, which may be
+        large, are shared by both projects until one of them replaces a value. Use
+        this instead of copy.deepcopy() when making many versions of a project.
+        """
+        project = self.__class__.__new__(self.__class__)
+        dict.__init__(project)
+        project.__dict__.update(self.__dict__)
+        for key, section in self.items():
+            project[key] = section.copy()
+        project.object_ids = list(self.object_ids)
+        project.port_numbers = list(self.port_numbers)
+        project.render_stats = {'hits': 0, 'misses': 0}
+        project.report = None
+        return project
+
+    def write_sonnet_file(self, stream):
+        """
+        Write the current state of this project in the Sonnet file format to a
+        stream. Each block is written as soon as it is formatted so the whole file
+        never has to be held in memory.
+
+        :param stream: a writable text stream, e.g. an open file or io.StringIO
+        """
+        for template, section in self.blocks:
+            self._write_block(stream, template, section)
+
+    def _write_block(self, stream, template, section):
+        stream.write(self._render(template, section))
+
+    def _render(self, template, section, **values):
+        # format a block template with a section reusing the last result if the
+        # section hasn't changed
+        section = self[section]
+        key = (template,) + tuple(sorted(values.items()))
+        if key in section.rendered:
+            self.render_stats['hits'] += 1
+            return section.rendered[key]
+        self.render_stats['misses'] += 1
+        text = template.format(**dict(section, **values))
+        section.rendered[key] = text
+        section.dirty = False
+        return text
+
+    def _make_sonnet_file(self, file_path, clean):
+        # write the project to a file or stream and set up the sondata folder
+        if hasattr(file_path, 'write'):
+            log.debug("writing project to a stream")
+            self.write_sonnet_file(file_path)
+            return
+        log.debug("saving project to '{}'".format(file_path))
+        with open(file_path, "w", buffering=self.buffer_size) as file_handle:
+            self.write_sonnet_file(file_handle)
+        self.project_file_path = file_path
+        folder = os.path.join(os.path.dirname(self.project_file_path), 'sondata')
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        subfolder = os.path.join(folder, os.path.basename(file_path).split('.')[0])
+        if clean and os.path.isdir(subfolder):
+            shutil.rmtree(subfolder)
+        if not os.path.isdir(subfolder):
+            os.mkdir(subfolder)
+
     def load(self, load_path):
         log.debug("loading configuration from '{}'".format(load_path))
         self.clear()
         # load configuration
-        with open(load_path, "r") as file_handle:
-            configuration = yaml.load(file_handle, Loader=yaml.FullLoader)
+        if _is_binary(load_path):
+            configuration = self._load_binary(load_path)
+        else:
+            with open(load_path, "r") as file_handle:
+                configuration = yaml.load(file_handle, Loader=yaml.FullLoader)
         for block in configuration.keys():
             if block not in self.sections:
                 message = "{} is an unrecognized configuration section"
@@ -72,12 +271,65 @@ class Project(dict):
         log.debug("configuration loaded")
 
     def save(self, save_path):
+        """
+        Save the project so that it can be loaded again with load().
+
+        :param save_path: path where the file will be saved (str)
+            If the path ends with '.npz' the project is saved in a binary format
+            which is much smaller and faster to save and load for projects with
+            many polygons. Otherwise the project is saved as a yaml file.
+        """
         log.debug("saving current configuration to '{}'".format(save_path))
         self['sonnet']['date'] = datetime.now().strftime('%m/%d/%Y %H:%M:%S')
-        with open(save_path) as file_handle:
-            yaml.dump(dict(self), file_handle, default_flow_style=False)
+        if _is_binary(save_path):
+            self._save_binary(save_path)
+        else:
+            with open(save_path, "w") as file_handle:
+                yaml.dump(self._configuration(), file_handle, default_flow_style=False)
         log.debug("configuration saved")
 
+    def _configuration(self):
+        # the project state as it is written to the yaml file
+        return {key: dict(section) for key, section in self.items()}
+
+    def _save_binary(self, save_path):
+        # the sections and lists are stored as json next to the arrays
+        metadata = {'project_type': self.__class__.__name__,
+                    'configuration': {key: dict(section)
+                                      for key, section in self.items()},
+                    'object_ids': self.object_ids, 'port_numbers': self.port_numbers}
+        metadata = np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)
+        np.savez(save_path, format_version=BINARY_FORMAT_VERSION, metadata=metadata,
+                 **self._arrays())
+
+    def _load_binary(self, load_path):
+        # returns the configuration and loads everything else into the project
+        with np.load(load_path) as data:
+            version = int(data['format_version'])
+            if version > BINARY_FORMAT_VERSION:
+                message = ("'{}' uses binary format version {} but only versions up "
+                           "to {} can be loaded. Update pysonnet to load it.")
+                raise ValueError(message.format(load_path, version,
+                                                BINARY_FORMAT_VERSION))
+            metadata = json.loads(data['metadata'].tobytes().decode())
+            if metadata['project_type'] != self.__class__.__name__:
+                message = "'{}' holds a {} not a {}"
+                raise ValueError(message.format(load_path, metadata['project_type'],
+                                                self.__class__.__name__))
+            self._load_arrays({key: data[key] for key in data.files
+                               if key not in ('format_version', 'metadata')})
+        self.object_ids = metadata['object_ids']
+        self.port_numbers = metadata['port_numbers']
+        return metadata['configuration']
+
+    def _arrays(self):
+        # the arrays saved in the binary format by _save_binary()
+        return {}
+
+    def _load_arrays(self, arrays):
+        # load the arrays returned by _arrays() from the binary format
+        pass
+
     def set_analysis(self, analysis_type):
         """
         Set what kind of analysis to run.
@@ -129,8 +381,18 @@ class Project(dict):
         self['control']['speed'] = b.SPEED_TYPES[memory]
         log.debug("q factor accuracy {}".format("on" if q_accuracy else "off"))
 
+    def validate(self):
+        """
+        Checks the project for problems that would make Sonnet fail.
+
+        :return: a dictionary mapping the name of each check that failed to the
+            items that failed it
+        """
+        return {}
+
     def run(self, analysis_type=None, file_path=None, options='-v',
-            external_frequency_file=None):
+            external_frequency_file=None, validate=True, stdout=None, stderr=None,
+            cache=None, progress=None, monitor=None):
         """
         Run the project simulation.
 
@@ -147,7 +409,124 @@ class Project(dict):
             Valid options are given on page 414 of the sonnet_users_guide.pdf. Verbose
             is turned on by default and the output is sent to the program log.
         :param external_frequency_file: path to the frequency control file (optional)
+        :param validate: check the project with validate() before running it
+            and raise a ValueError if there are any problems (boolean)
+        :param stdout: function called with each line em writes to its standard
+            output (optional). The lines are logged at the info level by default.
+        :param stderr: function called with each line em writes to its standard
+            error (optional). The lines are logged at the error level by default.
+        :param cache: a ResultCache or the directory of one (optional)
+            If the cache holds the outputs of an identical simulation they are
+            copied next to the project file instead of running em. Otherwise the
+            outputs are added to the cache when em finishes without an error.
+        :param progress: a ProgressParser or a function called with each
+            ProgressEvent found in the em output (optional). The events need the
+            verbose '-v' option. The parser is closed when em finishes.
+        :param monitor: the time in seconds between samples of the CPU, memory,
+            thread and I/O use of the em process tree (float, optional). The
+            samples and the timing of the run are kept in the RunReport at
+            project.report.
+        :return: the em return code (integer)
         """
+        command = self._em_command(analysis_type, file_path, options,
+                                   external_frequency_file, validate)
+        progress = _progress_parser(progress)
+        self.report = RunReport(command, interval=monitor)
+        cache, key, snapshot = self._look_up(cache, options, external_frequency_file)
+        if cache is not None and snapshot is None:
+            self.report.cached = True
+            return self._finish_run(0, progress)
+        stdout = _with_progress(stdout or log.info, progress)
+        # run the command reading standard error in a second thread so that em
+        # can't block on a full pipe that isn't being read
+        return_code = None
+        try:
+            with psutil.Popen(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE) as process:
+                self.report.start(process.pid)
+                thread = threading.Thread(target=_read_lines,
+                                          args=(process.stderr, stderr or log.error))
+                thread.start()
+                _read_lines(process.stdout, stdout)
+                thread.join()
+                return_code = process.wait()
+        finally:
+            self._finish_run(return_code, progress)
+        log.debug("em finished with return code {}".format(return_code))
+        if cache is not None and return_code == 0:
+            cache.store(key, self.project_file_path, snapshot)
+        return return_code
+
+    async def run_async(self, analysis_type=None, file_path=None, options='-v',
+                        external_frequency_file=None, validate=True, stdout=None,
+                        stderr=None, cache=None, progress=None, monitor=None):
+        """
+        Run the project simulation as a coroutine so that the calling thread is free
+        while em runs. Many projects can be run at the same time from one event
+        loop, e.g. with asyncio.gather(). The standard output and error of em are
+        read at the same time as it writes them. The arguments are the same as for
+        run() and the report of the run is also kept at project.report.
+
+        :return: the em return code (integer)
+        """
+        command = self._em_command(analysis_type, file_path, options,
+                                   external_frequency_file, validate)
+        progress = _progress_parser(progress)
+        self.report = RunReport(command, interval=monitor)
+        cache, key, snapshot = self._look_up(cache, options, external_frequency_file)
+        if cache is not None and snapshot is None:
+            self.report.cached = True
+            return self._finish_run(0, progress)
+        stdout = _with_progress(stdout or log.info, progress)
+        return_code = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            self.report.start(process.pid)
+            try:
+                await asyncio.gather(_read_lines_async(process.stdout, stdout),
+                                     _read_lines_async(process.stderr,
+                                                       stderr or log.error))
+                return_code = await process.wait()
+            except asyncio.CancelledError:
+                # don't leave em running when the task is cancelled
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        finally:
+            self._finish_run(return_code, progress)
+        log.debug("em finished with return code {}".format(return_code))
+        if cache is not None and return_code == 0:
+            cache.store(key, self.project_file_path, snapshot)
+        return return_code
+
+    def _finish_run(self, return_code, progress):
+        # close the progress parser and the report of a run
+        if progress is not None:
+            progress.close()
+        self.report.finish(return_code, progress)
+        return return_code
+
+    def _look_up(self, cache, options, external_frequency_file):
+        # return the cache, the key of the run and a snapshot of the output files
+        # or None for the snapshot if the outputs were restored from the cache
+        if cache is None:
+            return None, None, None
+        if not isinstance(cache, ResultCache):
+            cache = ResultCache(cache)
+        key = cache.key(self.project_file_path, self['sonnet']['version'], options,
+                        external_frequency_file)
+        if cache.restore(key, self.project_file_path):
+            log.info("outputs for '{}' restored from the result cache"
+                     .format(self.project_file_path))
+            return cache, key, None
+        return cache, key, cache.snapshot(self.project_file_path)
+
+    def _em_command(self, analysis_type, file_path, options, external_frequency_file,
+                    validate):
+        # check the project and return the command that runs it with em
         # check analysis_type
         if analysis_type is not None:
             self.set_analysis(analysis_type)
@@ -159,6 +538,12 @@ class Project(dict):
                 self['parameter_sweeps']['parameter_sweep'] != '' or
                 self['optimization']['optimization_goals'] != ''), message
 
+        if validate:
+            problems = self.validate()
+            if problems:
+                raise ValueError("the project is not valid: {}".format(
+                    ", ".join("{} {}".format(key, list(value))
+                              for key, value in problems.items())))
         # check to make sure there is a project file to run
         if file_path is not None:
             self.make_sonnet_file(file_path)
@@ -177,23 +562,7 @@ class Project(dict):
         if external_frequency_file:
             command.append(external_frequency_file)
         log.debug("running a(n) {}".format(analysis_type))
-        # run the command
-        with psutil.Popen(command, stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE) as process:
-            while True:
-                output = process.stdout.readline()
-                if not output and process.poll() is not None:
-                    break
-                message = output.decode('utf-8').strip()
-                if message:
-                    log.info(message)
-            while True:
-                error = process.stderr.readline()
-                if not error and process.poll() is not None:
-                    break
-                message = error.decode('utf-8').strip()
-                if message:
-                    log.error(message)
+        return command
 
     def locate_sonnet(self, sonnet_path=None):
         """
@@ -336,6 +705,45 @@ class Project(dict):
         self['frequency']['sweeps'] = ''
         log.debug("all frequency sweeps removed")
 
+    def frequency_points(self, abs_points=10):
+        """
+        Counts the frequencies computed by the frequency sweeps in the project.
+
+        :param abs_points: the number of frequencies to count for each adaptive
+            band synthesis sweep since Sonnet picks them while it runs (integer)
+        :return: a tuple of the number of frequencies and the highest frequency in
+            the project frequency units (0 if there are no sweeps)
+        """
+        n_points, f_max = 0, 0
+        for sweep in self['frequency']['sweeps'].splitlines():
+            values = sweep.split()
+            keyword = values[0] if values else ''
+            if keyword == 'SWEEP':
+                f1, f2, f_step = map(float, values[1:4])
+                n_points += int(np.floor((f2 - f1) / f_step + 1e-9)) + 1
+                frequencies = [f1, f2]
+            elif keyword in ('LSWEEP', 'ESWEEP'):
+                n_points += int(values[3])
+                frequencies = values[1:3]
+            elif keyword == 'LIST':
+                n_points += len(values) - 1
+                frequencies = values[1:]
+            elif keyword == 'STEP':
+                n_points += 1
+                frequencies = values[1:2]
+            elif keyword == 'DC_FREQ':
+                n_points += 1
+                frequencies = []
+            elif keyword in ('ABS_ENTRY', 'ABS_FMIN', 'ABS_FMAX'):
+                n_points += abs_points
+                frequencies = values[-2:]
+            else:
+                if keyword:
+                    log.debug("'{}' is not counted as a frequency sweep".format(sweep))
+                continue
+            f_max = max([f_max] + [float(frequency) for frequency in frequencies])
+        return n_points, f_max
+
     def add_parameter_sweep(self):
         """Add a parameter sweep to the analysis for the project."""
         raise NotImplementedError
@@ -388,37 +796,180 @@ class Project(dict):
 class GeometryProject(Project):
     """
     Class for creating and manipulating a Sonnet geometry project.
+
+    The polygons are stored in the 'polygons' attribute as a PolygonTable and are
+    only converted to the Sonnet file format when the project is written. Their
+    edges are indexed in the 'edge_index' attribute for placing ports.
     """
+    blocks = [(b.GEOMETRY_PROJECT, 'sonnet'), (b.HEADER, 'sonnet'),
+              (b.DIMENSIONS, 'dimensions'), (b.GEOMETRY, 'geometry'),
+              (b.FREQUENCY, 'frequency'), (b.CONTROL, 'control'),
+              (b.OPTIMIZATION, 'optimization'), (b.PARAMETER_SWEEP, 'parameter_sweep'),
+              (b.OUTPUT_FILE, 'output_file'), (b.SUBDIVIDER, 'subdivider'),
+              (b.QUICK_START_GUIDE, 'quick_start_guide'),
+              (b.COMPONENT_DATA_FILES, 'component_data_files'),
+              (b.TRANSLATORS, 'translators')]
+    # keep the rendered polygon text between calls to make_sonnet_file()
+    cache_polygons = True
+
+    def load(self, load_path):
+        """
+        Load the project from a pysonnet configuration file or from a Sonnet
+        project file if the file name ends with '.son'.
+
+        :param load_path: path to the file (str)
+        """
+        sonnet_file = pathlib.Path(load_path).suffix.lower() == '.son'
+        # replaced when loading a binary file
+        self.polygons = PolygonTable()
+        self.cells = {}
+        self.instances = []
+        super().load(_configuration_path() if sonnet_file else load_path)
+        self._polygon_cache = None
+        # move any polygon text from the configuration into the polygon table
+        self.polygons.extend_from_lines(self['geometry']['polygons'].splitlines())
+        self['geometry']['polygons'] = ''
+        if sonnet_file:
+            read_sonnet_file(self, load_path)
+            self.port_numbers = [int(port.splitlines()[-1].split()[0]) for port
+                                 in self['geometry']['ports'].split('POR1')[1:]]
+        self.edge_index = EdgeIndex(self.polygons)
+        self._index_materials()
+        self['geometry']['n_polygons'] = self._count_polygons()
+
+    def _arrays(self):
+        arrays = self.polygons.to_arrays()
+        names = list(self.cells.keys())
+        for index, name in enumerate(names):
+            arrays.update(self.cells[name].to_arrays(prefix="cell{}_".format(index)))
+        arrays['cell_names'] = np.array(names, dtype=str)
+        arrays['instances'] = np.array(
+            [(names.index(instance.cell),) + instance.parameters()
+             for instance in self.instances], dtype=np.float64).reshape(-1, 9)
+        return arrays
+
+    def _load_arrays(self, arrays):
+        self.polygons = PolygonTable.from_arrays(arrays)
+        names = arrays['cell_names'].tolist()
+        self.cells = {name: PolygonTable.from_arrays(arrays, prefix="cell{}_".format(index))
+                      for index, name in enumerate(names)}
+        self.instances = [Instance.from_parameters(names[int(values[0])], values[1:])
+                          for values in arrays['instances']]
+
+    def variant(self):
+        """
+        Returns a copy of the project which can be changed without changing this
+        one. The sections and the polygon arrays are shared by both projects and are
+        only copied when one of them is changed, so a variant costs little more
+        memory than the changes made to it.
+        """
+        project = super().variant()
+        project.polygons = self.polygons.share()
+        project.cells = {name: table.share() for name, table in self.cells.items()}
+        project.instances = list(self.instances)
+        project.edge_index = self.edge_index.copy(project.polygons)
+        project.metal_registry = dict(self.metal_registry)
+        project.brick_registry = dict(self.brick_registry)
+        cache = self._polygon_cache
+        if cache is not None and cache[0] is self.polygons and \
+                cache[1] == self.polygons.version:
+            project._polygon_cache = (project.polygons, project.polygons.version,
+                                      cache[2])
+        else:
+            project._polygon_cache = None
+        return project
+
+    def _index_materials(self):
+        # parse the metal and dielectric brick definitions once into the name
+        # registries that are kept up to date by define_metal() and
+        # define_dielectric_brick()
+        self.metal_registry = {}
+        for index, metal in enumerate(self['geometry']['metals'].splitlines()[2:]):
+            metal = shlex.split(metal)
+            self.metal_registry[metal[1]] = (index, metal[3])
+        self.brick_registry = {}
+        for index, brick in enumerate(self['geometry']['dielectrics'].splitlines()):
+            # plus 1 because air is included as a default even if it's not defined
+            self.brick_registry[shlex.split(brick)[1]] = index + 1
+
+    def _material_index(self, polygon_type, name):
+        # look up the index used in the polygon level line for a material name
+        if polygon_type == 'metal' or polygon_type == 'via':
+            if name == 'lossless':
+                return -1
+            message = "'{}' is not a defined metal".format(name)
+            assert name in self.metal_registry, message
+            material_index, material_value = self.metal_registry[name]
+            # check that we have a valid material
+            message = ("for a '{}' the 'material' parameter must be one of these "
+                       "types from define_metal() {}")
+            if polygon_type == 'metal':
+                assert material_value in b.METAL_TYPES.values(), \
+                    message.format('metal', list(b.METAL_TYPES.keys()))
+            else:
+                assert material_value in b.VIA_TYPES.values(), \
+                    message.format('via', list(b.VIA_TYPES.keys()))
+            return material_index
+        if name == 'air':
+            return 0
+        message = "'{}' is not a defined dielectric brick".format(name)
+        assert name in self.brick_registry, message
+        return self.brick_registry[name]
+
+    def _configuration(self):
+        configuration = super()._configuration()
+        # the yaml file holds every polygon with the cell instances expanded
+        polygons = [self.polygons.to_string()] + [table.to_string() for table
+                                                  in self._instance_tables()]
+        configuration['geometry'] = dict(configuration['geometry'],
+                                         polygons="".join(polygons),
+                                         n_polygons=self._count_polygons())
+        return configuration
+
     def make_sonnet_file(self, file_path, clean=True):
-        # convert the project format to the file format
-        file_string = (b.GEOMETRY_PROJECT.format(**self['sonnet']) +
-                       b.HEADER.format(**self['sonnet']) +
-                       b.DIMENSIONS.format(**self['dimensions']) +
-                       b.GEOMETRY.format(**self['geometry']) +
-                       b.FREQUENCY.format(**self['frequency']) +
-                       b.CONTROL.format(**self['control']) +
-                       b.OPTIMIZATION.format(**self['optimization']) +
-                       b.PARAMETER_SWEEP.format(**self['parameter_sweep']) +
-                       b.OUTPUT_FILE.format(**self['output_file']) +
-                       b.SUBDIVIDER.format(**self['subdivider']) +
-                       b.QUICK_START_GUIDE.format(**self['quick_start_guide']) +
-                       b.COMPONENT_DATA_FILES.format(**self['component_data_files']) +
-                       b.TRANSLATORS.format(**self['translators']))
-
-        log.debug("saving geometry project to '{}'".format(file_path))
-        with open(file_path, "w") as file_handle:
-            file_handle.write(file_string)
-        self.project_file_path = file_path
-        folder = os.path.join(os.path.dirname(self.project_file_path), 'sondata')
-        if not os.path.isdir(folder):
-            os.mkdir(folder)
-        subfolder = os.path.join(folder,  os.path.basename(file_path).split('.')[0])
-        if clean and os.path.isdir(subfolder):
-            shutil.rmtree(subfolder)
-        if not os.path.isdir(subfolder):
-            os.mkdir(subfolder)
+        """
+        Convert the current state of this project into a Sonnet file.
+
+        :param file_path: path where the file will be saved or a writable text stream
+            If a stream is given (e.g. io.StringIO) the project is only written to it
+            and no sondata folder is made.
+        :param clean: remove old results for this file from the sondata folder
+        """
+        self._make_sonnet_file(file_path, clean)
         log.debug("geometry project saved")
 
+    def _write_block(self, stream, template, section):
+        if section != 'geometry':
+            super()._write_block(stream, template, section)
+            return
+        # stream the polygons instead of formatting them into the block
+        head, tail = template.split("{polygons}")
+        stream.write(self._render(head, 'geometry', n_polygons=self._count_polygons()))
+        for polygons in self._polygon_strings():
+            stream.write(polygons)
+        for table in self._instance_tables():
+            for polygons in table.iter_strings():
+                stream.write(polygons)
+        stream.write(tail)
+
+    def _polygon_strings(self):
+        # yield the polygon text reusing the last result if the table hasn't changed
+        cache = self._polygon_cache
+        if cache is not None and cache[0] is self.polygons and \
+                cache[1] == self.polygons.version:
+            self.render_stats['hits'] += 1
+            yield from cache[2]
+            return
+        self.render_stats['misses'] += 1
+        self._polygon_cache = None
+        chunks = []
+        for chunk in self.polygons.iter_strings():
+            if self.cache_polygons:
+                chunks.append(chunk)
+            yield chunk
+        if self.cache_polygons:
+            self._polygon_cache = (self.polygons, self.polygons.version, chunks)
+
     def add_reference_plane(self, position, plane_type='fixed', length=None):
         """
         Adds a reference plane to one side of the box.
@@ -484,8 +1035,11 @@ class GeometryProject(Project):
         message = "the name 'lossless' is reserved for the default Sonnet lossless metal"
         assert name != 'lossless', message
         # determine the pattern id and set the location string
-        metals = self['geometry']['metals'].splitlines()
-        pattern_id = len(metals) - 1
+        if name in self.metal_registry:
+            metal_index = self.metal_registry[name][0]
+        else:
+            metal_index = len(self.metal_registry)
+        pattern_id = metal_index + 1
         location = "MET"
         # format the new metal
         if metal_type == 'normal':
@@ -521,18 +1075,13 @@ class GeometryProject(Project):
             message = "'metal_type' must be one of {}".format(metal_types)
             raise ValueError(message)
         # add the new metal to the metals list replacing if needed
-        defined_metals = metals[2:]
-        defined_names = []
-        for defined_metal in defined_metals:
-            defined_names.append(shlex.split(defined_metal)[1])
-        if name in defined_names:
-            metal_index = np.where(name == np.array(defined_names))[0][0]
-            metals[metal_index] = metal
+        if name in self.metal_registry:
+            metals = self['geometry']['metals'].splitlines()
+            metals[metal_index + 2] = metal  # skip the top and bottom covers
+            self['geometry']['metals'] = os.linesep.join(metals)
         else:
-            metals.append(metal)
-        # add the metal definitions to the geometry
-        metals = os.linesep.join(metals)
-        self['geometry']['metals'] = metals
+            self['geometry']['metals'] += os.linesep + metal
+        self.metal_registry[name] = (metal_index, shlex.split(metal)[3])
         log.debug("{} {} metal defined".format(metal_type, name))
 
     def set_box_cover(self, cover_type, top=False, bottom=False, **kwargs):
@@ -572,15 +1121,11 @@ class GeometryProject(Project):
             message = "'name' keyword must be defined for a custom metal"
             name = kwargs.pop('name', None)
             assert name is not None, message
-            defined_metals = metals[2:]
-            defined_names = []
-            for defined_metal in defined_metals:
-                defined_names.append(shlex.split(defined_metal)[1])
             message = "'{}' is not a defined metal".format(name)
-            assert name in defined_names, message
+            assert name in self.metal_registry, message
             # reformat metal string
-            metal_index = np.where(name == np.array(defined_names))[0][0]
-            metal = shlex.split(defined_metals[metal_index])
+            metal_index = self.metal_registry[name][0]
+            metal = shlex.split(metals[metal_index + 2])
             # check type
             message = "'{}' must be one of these metal types to put on the cover {}"
             assert metal[3] in b.COVER_TYPES.values(), \
@@ -723,11 +1268,19 @@ class GeometryProject(Project):
         :param loss_tangent: the loss tangent of the material
         :param conductivity: the conductivity of the material
         """
-        dielectrics = self['geometry']['dielectrics'].splitlines()
-        pattern_id = len(dielectrics) + 1  # first pattern is air which always exists
-        self['geometry']['dielectrics'] += b.ISOTROPIC_DIELECTRIC_BRICK_FORMAT.format(
+        # first pattern is air which always exists
+        pattern_id = self.brick_registry.get(name, len(self.brick_registry) + 1)
+        brick = b.ISOTROPIC_DIELECTRIC_BRICK_FORMAT.format(
             name=name, pattern_id=pattern_id, epsilon=epsilon, loss_tangent=loss_tangent, conductivity=conductivity
-        ) + os.linesep
+        )
+        # add the new brick to the dielectrics replacing if needed
+        if name in self.brick_registry:
+            dielectrics = self['geometry']['dielectrics'].splitlines()
+            dielectrics[pattern_id - 1] = brick
+            self['geometry']['dielectrics'] = os.linesep.join(dielectrics) + os.linesep
+        else:
+            self['geometry']['dielectrics'] += brick + os.linesep
+        self.brick_registry[name] = pattern_id
 
     def define_technology_layer(self, layer_type, name, level, material,
                                 fill_type='staircase', edge_mesh=True, **kwargs):
@@ -779,40 +1332,11 @@ class GeometryProject(Project):
         message = "'fill_type' parameter must be one of {}"
         assert fill_type in b.FILL_TYPES.keys(), message.format(list(b.FILL_TYPES.keys()))
         # determine the material index
-        if layer_type == 'metal' or layer_type == 'via':
-            if material == "lossless":
-                material_index = -1
-            else:
-                metals = self['geometry']['metals'].splitlines()
-                defined_metals = metals[2:]
-                defined_names = []
-                for defined_metal in defined_metals:
-                    defined_names.append(shlex.split(defined_metal)[1])
-                material_index = np.where(material == np.array(defined_names))[0][0]
-                # check that we have a valid material
-                material_value = shlex.split(defined_metals[material_index])[3]
-                message = ("for a '{}' the 'material' parameter must be one of these "
-                           "types from define_metal() {}")
-                if layer_type == 'metal':
-                    assert material_value in b.METAL_TYPES.values(), \
-                        message.format('metal', list(b.METAL_TYPES.keys()))
-                else:
-                    assert material_value in b.VIA_TYPES.values(), \
-                        message.format('via', list(b.VIA_TYPES.keys()))
-        else:
-            if material == 'air':
-                material_index = 0
-            else:
-                defined_dielectrics = self['geometry']['dielectrics'].splitlines()
-                defined_names = []
-                for defined_dielectric in defined_dielectrics:
-                    defined_names.append(shlex.split(defined_dielectric)[1])
-                # plus 1 because air is included as a default even if it's not defined
-                material_index = np.where(material == np.array(defined_names))[0][0] + 1
+        material_index = self._material_index(layer_type, material)
 
         # set the level format
         level_format = {"level": level, "n_vertices": 0, "material": material_index,
-                        "fill_type": b.FILL_TYPES[fill_type],
+                        "fill_type": b.FILL_TYPES[fill_type], "debug_id": 0,
                         "x_min": kwargs.pop("x_min", 1), "y_min": kwargs.pop("y_min", 1),
                         "x_max": kwargs.pop("x_max", 100),
                         "y_max": kwargs.pop("y_max", 100),
@@ -882,6 +1406,180 @@ class GeometryProject(Project):
                 length=length,
             )
 
+    def plan_subdividers(self, direction='vertical', n_lines=None, clearance=None,
+                         min_gap=None, min_savings=0.05, apply=True):
+        """
+        Finds subdivider positions that only cross simple transmission lines and
+        adds the ones that save the most time. A position is allowed if every
+        polygon that it crosses is straight and perpendicular to the subdivider
+        for at least 'clearance' on both sides (no bends, steps, ends, ports or
+        vias nearby) and the crossed metal on each level is separated by at least
+        'min_gap' (no coupled lines). The positions are chosen one at a time by
+        the estimated reduction in the matrix solve time, which grows with the
+        cube of the number of subsections in each section.
+
+        :param direction: the orientation of the subdividers, either 'vertical' or
+            'horizontal' (string)
+        :param n_lines: the largest number of subdividers to add (optional, integer)
+        :param clearance: the smallest distance from a position to a discontinuity
+            (optional, float) The default is twice the width of the widest line
+            that is crossed.
+        :param min_gap: the smallest distance between two crossed lines on the
+            same level (optional, float) The default is twice the width of the
+            widest line that is crossed.
+        :param min_savings: stop adding subdividers when the next one reduces the
+            solve time by less than this fraction of the original time (float)
+        :param apply: add the chosen subdividers to the project with
+            add_subdivider() (boolean)
+        :return: a dictionary with the chosen 'lines', the 'candidates' as
+            (position, savings) tuples ranked by the fraction of the solve time that
+            each one saves on its own, and the total fractional 'savings' of the
+            chosen lines
+        """
+        message = "'direction' must be one of {}".format(list(b.SUB_DIRECTION_TYPES.keys()))
+        assert direction in b.SUB_DIRECTION_TYPES.keys(), message
+        axis = 0 if direction == 'vertical' else 1
+        geometry = self['geometry']
+        width = geometry['box_width_x' if axis == 0 else 'box_width_y']
+        cell_size, settings, _ = self._subsection_settings(self.frequency_points()[1])
+        # gather every polygon that is written to the Sonnet file
+        table = PolygonTable()
+        counts = []
+        for polygons in [self.polygons] + list(self._instance_tables()):
+            table.append(polygons.vertices, polygons.offsets, level=polygons['level'],
+                         polygon_type=polygons['polygon_type'])
+            counts.append(count_subsections(polygons, cell_size, **settings))
+        counts = np.concatenate(counts + [np.zeros(0, dtype=np.int64)])
+        # existing subdividers must have the same orientation and are kept
+        existing = []
+        for line in self['subdivider']['subdivider_locations'].splitlines():
+            values = line.split()
+            if values:
+                message = "all subdividers must have the same orientation"
+                assert values[3] == b.SUB_DIRECTION_TYPES[direction], message
+                existing.append(float(values[2]))
+        # discontinuities are at polygon vertices and ports
+        ports = [float(port.splitlines()[-1].split()[5 + axis])
+                 for port in geometry['ports'].split('POR1')[1:]]
+        breakpoints = np.unique(np.concatenate([table.vertices[:, axis],
+                                                ports, existing, [0, width]]))
+        breakpoints = breakpoints[(breakpoints >= 0) & (breakpoints <= width)]
+        # find the edges crossing the middle of every gap between breakpoints at once
+        middles = (breakpoints[:-1] + breakpoints[1:]) / 2
+        ids, start, stop, first, last = crossing_ranges(table, axis, middles)
+        other = 1 - axis
+        via = table['polygon_type'] == POLYGON_TYPE_NAMES.index('via')
+
+        def n_crossed(selected):
+            # the number of selected edges crossing each gap
+            change = np.bincount(first[selected], minlength=middles.size + 1) - \
+                np.bincount(last[selected], minlength=middles.size + 1)
+            return np.cumsum(change)[:-1]
+        allowed = (n_crossed(np.ones(ids.size, dtype=bool)) > 0) & \
+            (n_crossed(start[:, other] != stop[:, other]) == 0) & \
+            (n_crossed(via[ids]) == 0)
+        # every crossing is at least as wide as the closest two coordinates of its
+        # polygon, so gaps too short for any position can be skipped before their
+        # crossings are found
+        polygon = np.repeat(np.arange(len(table)), np.diff(table.offsets))
+        order = np.lexsort((table.vertices[:, other], polygon))
+        spacing = np.diff(table.vertices[order, other])
+        spacing = spacing[(np.diff(polygon[order]) == 0) & (spacing > 0) &
+                          ~via[polygon[order][1:]]]
+        if clearance is not None:
+            distance = clearance
+        else:
+            distance = 2 * spacing.min() if spacing.size else 0
+        size = cell_size[axis]
+        allowed &= np.ceil((breakpoints[:-1] + distance) / size) <= \
+            np.floor((breakpoints[1:] - distance) / size)
+        gaps = np.flatnonzero(allowed)
+        # list the crossings of the remaining gaps, which are all perpendicular
+        # edges, in the order of their gap, level, polygon and position
+        values, rank = np.unique(start[:, other], return_inverse=True)
+        rank = rank.ravel()
+        edges = np.lexsort((values[rank], ids, table['level'][ids]))
+        begin = np.searchsorted(gaps, first[edges])
+        spans = np.searchsorted(gaps, last[edges]) - begin
+        edge = np.repeat(edges, spans)
+        gap = np.arange(edge.size) - np.repeat(np.cumsum(spans) - spans, spans) + \
+            np.repeat(begin, spans)
+        order = np.argsort(gap, kind='stable')
+        edge, gap = edge[order], gap[order]
+        # each polygon covers a gap between pairs of its sorted crossings
+        low, high = rank[edge[::2]], rank[edge[1::2]]
+        gap, level = gap[::2], table['level'][ids[edge[::2]]]
+        widest = np.zeros(gaps.size)
+        if gap.size:
+            group = np.flatnonzero(np.diff(gap, prepend=-1))
+            widest[gap[group]] = np.maximum.reduceat(values[high] - values[low], group)
+        # crossed lines on the same level that are closer than the gap are coupled
+        group = np.cumsum((np.diff(gap, prepend=-1) != 0) |
+                          (np.diff(level, prepend=-1) != 0)).astype(np.int64)
+        offset = group * max(values.size, 1)
+        order = np.argsort(offset + low, kind='stable')
+        low, high, gap, group, offset = (low[order], high[order], gap[order],
+                                         group[order], offset[order])
+        # the running maximum of the ends in each group
+        ends = np.maximum.accumulate(high + offset) - offset
+        separation = values[low[1:]] - values[ends[:-1]]
+        threshold = 2 * widest if min_gap is None else np.full(gaps.size, min_gap)
+        close = (group[1:] == group[:-1]) & (separation > 0) & \
+            (separation < threshold[gap[1:]])
+        coupled = np.zeros(gaps.size, dtype=bool)
+        coupled[gap[1:][close]] = True
+        distances = 2 * widest if clearance is None else np.full(gaps.size, clearance)
+        candidates = []
+        for lower, upper, distance in zip(breakpoints[gaps][~coupled],
+                                          breakpoints[gaps + 1][~coupled],
+                                          distances[~coupled]):
+            positions = np.arange(np.ceil((lower + distance) / size),
+                                  np.floor((upper - distance) / size) + 1) * size
+            if positions.size > 64:
+                positions = positions[np.linspace(0, positions.size - 1, 64).astype(int)]
+            candidates.append(positions)
+        positions = np.concatenate(candidates + [np.zeros(0)])
+        # choose the positions that most reduce the sum of the cubed section sizes
+        totals = cumulative_counts(table, counts, axis, positions)
+        lines = sorted(existing)
+        line_totals = list(cumulative_counts(table, counts, axis, lines)) \
+            if lines else []
+        n_total = float(counts.sum())
+        original = cost = sum(np.diff([0] + line_totals + [n_total]) ** 3)
+
+        def savings(line_totals):
+            # the reduction in cost from adding each candidate to the lines
+            edges = np.array([0] + line_totals + [n_total])
+            section = np.clip(np.searchsorted(edges, totals, side='right') - 1,
+                              0, edges.size - 2)
+            before, after = totals - edges[section], edges[section + 1] - totals
+            return (edges[section + 1] - edges[section]) ** 3 - before ** 3 - after ** 3
+        ranked = []
+        if positions.size and original > 0:
+            single = savings(line_totals) / original
+            order = np.argsort(-single, kind='stable')
+            ranked = list(zip(positions[order].tolist(), single[order].tolist()))
+        chosen = []
+        while positions.size and original > 0 and \
+                (n_lines is None or len(chosen) < n_lines):
+            gain = savings(line_totals)
+            gain[np.isin(positions, lines)] = 0
+            best = int(np.argmax(gain))
+            if gain[best] <= 0 or gain[best] < min_savings * original:
+                break
+            chosen.append(float(positions[best]))
+            cost -= gain[best]
+            index = int(np.searchsorted(lines, positions[best]))
+            lines.insert(index, float(positions[best]))
+            line_totals.insert(index, float(totals[best]))
+        if apply:
+            for position in sorted(chosen):
+                self.add_subdivider(position, direction=direction)
+        log.debug("{} subdivider(s) chosen from {} candidate positions"
+                  .format(len(chosen), positions.size))
+        return {'lines': sorted(chosen), 'candidates': ranked,
+                'savings': 1 - cost / original if original > 0 else 0}
+
     def set_origin(self, dx, dy, locked=True):
         """
         Sets the origin for the project.
@@ -932,113 +1630,134 @@ class GeometryProject(Project):
         :param level: level of the layer to add the port to. The layer can be an integer or a
             tech layer name. If None, all layers are searched for the correct polygon (integer, str)
         """
+        self.add_ports(port_type, [number], [x], [y], resistance=resistance,
+                       reactance=reactance, inductance=inductance,
+                       capacitance=capacitance, level=level, **kwargs)
+
+    def add_ports(self, port_types, numbers, x, y, resistance=0, reactance=0,
+                  inductance=0, capacitance=0, level=None, **kwargs):
+        """
+        Adds many ports to the project at once. The ports are placed on the polygons
+        in a single search and the result is the same as calling add_port() for
+        each port in order.
+
+        Every parameter and keyword argument of add_port() is accepted. Each one can
+        either be a single value used for all of the ports or a list with one value
+        per port.
+
+        :param port_types: type of each port (string or list of strings)
+        :param numbers: port numbers (list of non-zero integers)
+        :param x: x positions of the ports (list of floats)
+        :param y: y positions of the ports (list of floats)
+        """
+        n = len(numbers)
+        values = {'port_type': port_types, 'x': x, 'y': y, 'resistance': resistance,
+                  'reactance': reactance, 'inductance': inductance,
+                  'capacitance': capacitance, 'level': level}
+        values.update(kwargs)
+        ports = [{} for _ in range(n)]
+        for key, value in values.items():
+            if isinstance(value, (list, tuple, np.ndarray)):
+                message = "'{}' must have one value for each port".format(key)
+                assert len(value) == n, message
+                value = value.tolist() if isinstance(value, np.ndarray) else value
+            else:
+                value = [value] * n
+            for port, port_value in zip(ports, value):
+                if port_value is not None or key == 'level':
+                    port[key] = port_value
         # check inputs
-        message = "'port_type' parameter must be one of {}"
-        assert port_type in b.PORT_TYPES.keys(), message.format(list(b.PORT_TYPES.keys()))
-        message = "'number' parameter can not be 0 and must be an integer"
-        assert isinstance(number, int) and number != 0, message
-        if port_type == "standard":
-            independent = kwargs.pop("independent", False)
-            on_wall = (x == 0 or y == 0 or x == self["geometry"]["box_width_x"] or
-                       y == self["geometry"]["box_width_y"])
-            message = "a standard port must be on the box wall to be independent"
-            assert (independent and on_wall) or not independent, message
-        elif port_type == "auto-grounded":
-            independent = kwargs.pop("independent", True)
-            message = "auto-grounded ports are always independent"
-            assert independent, message
-        else:  # co-calibrated
-            independent = kwargs.pop("independent", False)
-            message = "co-calibrated ports are always never independent"
-            assert not independent, message
-        # count the number of ports already made
-        ports = ['POR1' + c for c in self['geometry']['ports'].split('POR1') if c]
-        n_ports = len(ports)
-        # get all the file_ids from the ports
-        file_ids = []
-        for port in ports:
-            file_ids.append(port.split("POLY")[1].split()[0])
-        # find the right polygon and vertex
-        polygons = [c + "END" for c in self['geometry']['polygons'].split("END\n")
-                    if c.strip()]
-        min_value = np.inf
-        min_index = 0
-        polygon_index = 0
-        position = np.array([x, y])
-        new_position = position
-        for index, polygon in enumerate(polygons):
-            # Check polygon if in right level
-            if isinstance(level, int):
-                if int(polygon.splitlines()[1].split(" ")[0]) != level:
-                    continue
-            elif isinstance(level, str):
-                identifier = b.TECHLAYER_NAME_FORMAT.split(" ")[0]
-                line = None
-                for polygon_line in polygon.splitlines():
-                    if identifier in polygon_line:
-                        line = polygon_line
-                if line is None or line.split(" ")[1].strip('"') != level:
-                    continue
+        numbers = [number.item() if isinstance(number, np.integer) else number
+                   for number in numbers]
+        for number, port in zip(numbers, ports):
+            port_type = port['port_type']
+            message = "'port_type' parameter must be one of {}"
+            assert port_type in b.PORT_TYPES.keys(), \
+                message.format(list(b.PORT_TYPES.keys()))
+            message = "'number' parameter can not be 0 and must be an integer"
+            assert isinstance(number, int) and number != 0, message
+            if port_type == "standard":
+                independent = port.pop("independent", False)
+                on_wall = (port['x'] == 0 or port['y'] == 0 or
+                           port['x'] == self["geometry"]["box_width_x"] or
+                           port['y'] == self["geometry"]["box_width_y"])
+                message = "a standard port must be on the box wall to be independent"
+                assert (independent and on_wall) or not independent, message
+            elif port_type == "auto-grounded":
+                independent = port.pop("independent", True)
+                message = "auto-grounded ports are always independent"
+                assert independent, message
+            else:  # co-calibrated
+                independent = port.pop("independent", False)
+                message = "co-calibrated ports are always never independent"
+                assert not independent, message
+            port['independent'] = independent
+            level = port['level']
+            if not (level is None or isinstance(level, (int, str))):
+                raise ValueError("'level' keyword argument must be an integer or string.")
+        # find the polygon edge with the closest midpoint among the allowed polygons
+        # with one search for each level that is used
+        polygon_ids = np.zeros(n, dtype=np.int64)
+        vertex_ids = np.zeros(n, dtype=np.int64)
+        positions = np.zeros((n, 2))
+        levels = [port['level'] for port in ports]
+        for level in set(levels):
+            selection = [index for index in range(n) if levels[index] == level]
+            points = [[ports[index]['x'], ports[index]['y']] for index in selection]
+            result = self.edge_index.query(points, level=level)
+            polygon_ids[selection], vertex_ids[selection], positions[selection] = result
+        if np.any(polygon_ids < 0):
+            raise ValueError("there are no polygons on which to place the port")
+        # count the number of ports already made and get all of their file_ids
+        ports_string = self['geometry']['ports']
+        n_ports = ports_string.count('POR1')
+        file_ids = set(port.split("POLY")[1].split()[0]
+                       for port in ports_string.split('POR1') if port)
+        # set the debug_id of each polygon equal to the id of its first port
+        debug_ids = {}
+        port_strings = []
+        for index, (number, port) in enumerate(zip(numbers, ports)):
+            polygon_index = polygon_ids[index]
+            if polygon_index not in debug_ids:
+                debug_ids[polygon_index] = str(self.polygons['debug_id'][polygon_index])
+            if debug_ids[polygon_index] not in file_ids:
+                debug_ids[polygon_index] = str(n_ports + index + 10 * len(self.polygons))
+                file_ids.add(debug_ids[polygon_index])
+            # set the port format string
+            diagonal = port.pop("diagonal", None)
+            diagonal_string = b.DIAGONAL_FORMAT.format(allowed="Y" if diagonal else "N")
+            if port['independent']:
+                fixed_reference_plane = port.pop("fixed_reference_plane", False)
+                reference_type = "NONE" if not fixed_reference_plane else "FIX"
+                length = port.pop("length", None)
+                length_string = 0 if length is None else length
             else:
-                if level is not None:
-                    raise ValueError("'level' keyword argument must be an integer or string.")
-
-            # Filter out Techlayer, End, Brick and Via lines
-            generator = (r for r in polygon.splitlines() if r and not r[0] in ('T', 'E', 'B', 'V'))
-            polygon = np.genfromtxt(generator, skip_header=1)
-            mid_points = (polygon[1:] + polygon[:-1]) / 2
-            distance = np.linalg.norm(mid_points - position, axis=1)
-            trial_index = np.argmin(np.abs(distance))
-            trial_value = np.abs(distance[trial_index])
-            if trial_value < min_value:
-                min_value = trial_value
-                min_index = trial_index
-                polygon_index = index
-                new_position = mid_points[min_index, :]
-
-        # set the debug_id equal to the port id
-        polygon = polygons[polygon_index].splitlines()
-        condition = (not polygon[0] or polygon[0][:3] == 'MET' or
-                     polygon[0][:3] == 'BRI' or polygon[0][:3] == 'VIA')
-        index = 1 if condition else 0
-        level = polygon[index]
-        level = level.split()
-        if level[4] not in file_ids:
-            file_id = str(n_ports + 10 * len(polygons))
-            level[4] = file_id
-            level = " ".join(level)
-            polygon[index] = level
-            polygon = os.linesep.join(polygon)
-            polygons[polygon_index] = polygon
-            polygons = os.linesep.join(polygons)
-            self['geometry']['polygons'] = polygons
-        else:
-            file_id = level[4]
-        # set the port format string
-        diagonal = kwargs.pop("diagonal", None)
-        diagonal_string = b.DIAGONAL_FORMAT.format(allowed="Y" if diagonal else "N")
-        if independent:
-            fixed_reference_plane = kwargs.pop("fixed_reference_plane", False)
-            reference_type = "NONE" if not fixed_reference_plane else "FIX"
-            length = kwargs.pop("length", None)
-            length_string = 0 if length is None else length
-        else:
-            reference_type = ""
-            length_string = ""
-        port_format = {"port_type": b.PORT_TYPES[port_type],
-                       "group_id": "" if port_type != 'co-calibrated'
-                       else kwargs.pop("group_id", "Auto"),
-                       "diagonal": diagonal_string if diagonal is not None else "",
-                       "number": number, "resistance": resistance, "reactance": reactance,
-                       "inductance": inductance, "capacitance": capacitance,
-                       "ref_type": reference_type, "length": length_string,
-                       "file_id": file_id, "polygon_index": min_index,
-                       "x": new_position[0], "y": new_position[1]}
-        self['geometry']['ports'] += b.PORT_FORMAT.format(**port_format)
-        self.port_numbers.append(number)
-        log.debug("{} port {} added at ({}, {}) with parameters ({}, {}, {}, {})"
-                  .format(port_type, number, new_position[0], new_position[1], resistance,
-                          reactance, inductance, capacitance))
+                reference_type = ""
+                length_string = ""
+            port_type = port['port_type']
+            port_format = {"port_type": b.PORT_TYPES[port_type],
+                           "group_id": "" if port_type != 'co-calibrated'
+                           else port.pop("group_id", "Auto"),
+                           "diagonal": diagonal_string if diagonal is not None else "",
+                           "number": number, "resistance": port['resistance'],
+                           "reactance": port['reactance'],
+                           "inductance": port['inductance'],
+                           "capacitance": port['capacitance'],
+                           "ref_type": reference_type, "length": length_string,
+                           "file_id": debug_ids[polygon_index],
+                           "polygon_index": vertex_ids[index],
+                           "x": positions[index, 0], "y": positions[index, 1]}
+            port_strings.append(b.PORT_FORMAT.format(**port_format))
+            log.debug("{} port {} added at ({}, {}) with parameters ({}, {}, {}, {})"
+                      .format(port_type, number, positions[index, 0],
+                              positions[index, 1], port['resistance'],
+                              port['reactance'], port['inductance'],
+                              port['capacitance']))
+        polygon_indices = np.array(list(debug_ids.keys()), dtype=np.int64)
+        self.polygons.set('debug_id', polygon_indices,
+                          np.array(list(debug_ids.values()), dtype=np.int64))
+        self['geometry']['ports'] += "".join(port_strings)
+        self.port_numbers += numbers
 
     def add_calibration_group(self, group_id, ground='box cover', terminal_width='feedline'):
         """Adds a calibration group to the project.
@@ -1134,7 +1853,8 @@ class GeometryProject(Project):
     def add_gdstk_cell(self, polygon_type, cell, layer=None, datatype=None,
                        **kwargs):
         """
-        Adds a GDSTK Cell to the project.
+        Adds a GDSTK Cell to the project. Cells referenced by the cell are included
+        with their transformations and repetitions.
 
         :param polygon_type: type of polygon to add (string)
             Valid options are listed below with the additional keyword arguments that may
@@ -1154,27 +1874,42 @@ class GeometryProject(Project):
             The default is None and all datatypes are used.
 
         Keywords to add_polygons are also included.
-
-        Note: Flatten the cell if references are used.
         """
-        points = []
-        for polygon in cell.polygons:
-            p_layer = polygon.layer if layer is not None else None
-            p_datatype = polygon.datatype if datatype is not None else None
-            if p_layer == layer and p_datatype == datatype:
-                points.append(polygon.points)
-
-        for path in cell.paths:
-            polygons = path.to_polygons()
-            for i in range(path.num_paths):
-                p_layer = path.layers[i] if layer is not None else None
-                p_datatype = path.datatype[i] if datatype is not None else None
-                if p_layer == layer and p_datatype == datatype:
-                    points.append(polygons[i].points)
+        self.add_gdstk_layers(cell, {(layer, datatype): dict(kwargs,
+                                                            polygon_type=polygon_type)})
 
-        self.add_polygons(polygon_type, points, **kwargs)
+    def add_gdstk_layers(self, cell, layer_map):
+        """
+        Adds the layers of a GDSTK Cell to the project. The cell hierarchy is
+        flattened with array operations and each entry in the layer map is added
+        with a single call to add_polygons().
 
-    def add_polygons(self, polygon_type, polygons, tech_layer=None, **kwargs):
+        :param cell: a gdstk cell (object)
+        :param layer_map: a dictionary mapping GDS layers to polygon properties
+            Each key is a (layer, datatype) tuple where either number may be None to
+            match any value. A plain layer number matches every datatype. Each value
+            is a dictionary with the 'polygon_type' and keyword arguments for
+            add_polygons() (e.g. 'level', 'material' or 'tech_layer'). A GDS layer
+            matched by more than one key is added once for each key.
+            e.g. {(1, 0): {'polygon_type': 'metal', 'level': 0, 'material': 'Al'},
+                  2: {'polygon_type': 'metal', 'tech_layer': 'M1'}}
+        """
+        groups = flatten_gdstk_cell(cell)
+        for key, properties in layer_map.items():
+            layer, datatype = key if isinstance(key, tuple) else (key, None)
+            selected = [groups[(g_layer, g_datatype)] for g_layer, g_datatype in groups
+                        if (layer is None or g_layer == layer) and
+                        (datatype is None or g_datatype == datatype)]
+            if not selected:
+                log.debug("no polygons match the GDS layer {}".format(key))
+                continue
+            vertices, offsets = concatenate_polygons(selected)
+            properties = dict(properties)
+            self.add_polygons(properties.pop('polygon_type'), vertices, offsets=offsets,
+                              **properties)
+
+    def add_polygons(self, polygon_type, polygons, tech_layer=None, offsets=None,
+                     cell=None, **kwargs):
         """
         Adds polygons to the project.
 
@@ -1190,6 +1925,8 @@ class GeometryProject(Project):
                 :keyword pads: metal pads over the via, default is False (boolean)
             'dielectric brick': a dielectric brick polygon
         :param polygons: a list of N x 2 numpy arrays that define the polygons
+            All of the polygons can also be given as one M x 2 array of stacked
+            vertices if the 'offsets' parameter is used.
         :param tech_layer: the technology layer name (string)
             The name must correspond to a name used in define_technology_layer(). The
             following keywords can be used with the tech_layer keyword.
@@ -1221,6 +1958,12 @@ class GeometryProject(Project):
                     :keyword conformal_max: maximum length for a conformal mesh subsection
                         If it is 0 or not specified, the length is computed by Sonnet.
             :keyword edge_mesh: use edge meshing (boolean)
+        :param offsets: the index of the first vertex of each polygon in 'polygons'
+            followed by the total number of vertices (optional, array of integers)
+            Open polygons are closed by adding their first vertex to the end.
+        :param cell: add the polygons to this cell instead of the project (string)
+            The cell is created if it doesn't exist. The polygons in a cell are only
+            written to the Sonnet file where the cell is placed with add_instance().
         """
         # check inputs
         message = "'polygon type' parameter must be one of {}"
@@ -1240,39 +1983,7 @@ class GeometryProject(Project):
                         "conformal_max": kwargs.pop("conformal_max", 0),
                         "edge_mesh": "Y" if kwargs.pop("edge_mesh", True) else "N"}
         name = kwargs.pop("material", "lossless" if polygon_type == 'metal' or polygon_type == 'via' else 'air')
-        condition = (name == 'lossless' and (polygon_type == 'metal' or
-                                             polygon_type == 'via') or
-                     name == 'air' and polygon_type == 'dielectric brick')
-        if polygon_type == 'metal' or polygon_type == 'via':
-            if condition:
-                material_index = -1
-            else:
-                defined_metals = self['geometry']['metals'].splitlines()[2:]
-                defined_names = []
-                for defined_metal in defined_metals:
-                    defined_names.append(shlex.split(defined_metal)[1])
-                material_index = np.where(name == np.array(defined_names))[0][0]
-                # check that we have a valid material
-                material_value = shlex.split(defined_metals[material_index])[3]
-                message = ("for a '{}' the 'material' parameter must be one of these "
-                           "types from define_metal() {}")
-                if polygon_type == 'metal':
-                    assert material_value in b.METAL_TYPES.values(), \
-                        message.format('metal', list(b.METAL_TYPES.keys()))
-                else:
-                    assert material_value in b.VIA_TYPES.values(), \
-                        message.format('via', list(b.VIA_TYPES.keys()))
-        else:
-            if condition:
-                material_index = 0
-            else:
-                defined_dielectrics = self['geometry']['dielectrics'].splitlines()
-                defined_names = []
-                for defined_dielectric in defined_dielectrics:
-                    defined_names.append(shlex.split(defined_dielectric)[1])
-                # plus 1 because air is included as a default even if it's not defined
-                print(defined_names, defined_dielectrics, name)
-                material_index = np.where(name == np.array(defined_names))[0][0] + 1
+        material_index = self._material_index(polygon_type, name)
         level_format['material'] = material_index
         # set up the to_level format for the new polygons
         if polygon_type == 'via':
@@ -1285,33 +1996,523 @@ class GeometryProject(Project):
                 pads="COVERS" if pads else "NOCOVERS")
         else:
             to_level_string = ""
-        # get the technology layer format for the new polygons
+        # get the technology layer for the new polygons
         if tech_layer is not None:
             inherit = kwargs.pop("inherit", True)
-            tech_layer_string = b.TECHLAYER_NAME_FORMAT.format(name=tech_layer,
-                                                               inherit="INH"
-                                                               if inherit else "NOH")
         else:
-            tech_layer_string = ''
-        # add each polygon to the project
-        for index, polygon in enumerate(polygons):
-            # add the last vertex to the end of each polygon if it isn't there
-            if np.any(polygon[0, :] != polygon[-1, :]):
-                polygon = np.vstack([polygon, polygon[0, :]])
-            # update the level format
-            level_format['n_vertices'] = polygon.shape[0]
-            # add the polygon to the project
-            level_string = b.LEVEL_FORMAT.format(**level_format)
-            polygon_string = ''
-            for vertex in polygon:
-                polygon_string += "{:.8f} {:.8f}".format(*vertex) + os.linesep
-            polygons_string = b.POLYGON_FORMAT.format(
-                polygon_type=b.POLYGON_TYPES[polygon_type], level=level_string,
-                to_level=to_level_string, tech_layer=tech_layer_string,
-                polygon=polygon_string)
-            self['geometry']['polygons'] += polygons_string
-            self['geometry']['n_polygons'] += 1
-            log.debug("polygon added")
+            inherit = False
+        # stack the polygons and close any that are open in a few array operations
+        if offsets is None:
+            vertices, offsets = stack_polygons(polygons)
+        else:
+            vertices = np.asarray(polygons, dtype=np.float64).reshape(-1, 2)
+            offsets = np.asarray(offsets, dtype=np.int64)
+            message = "'offsets' must start at 0 and end at the number of vertices"
+            assert (offsets.size and offsets[0] == 0 and
+                    offsets[-1] == vertices.shape[0]), message
+        if offsets.size == 1:
+            return
+        vertices, offsets = close_polygons(vertices, offsets)
+        message = "each polygon must have at least three vertices"
+        assert np.all(np.diff(offsets) >= 4), message
+        message = "polygon vertices must be finite"
+        assert np.all(np.isfinite(vertices)), message
+        # vertices are written with 8 decimals so store them that way too
+        vertices = np.round(vertices, 8)
+        # add the polygons to the project
+        table = self.polygons if cell is None else self.cells.setdefault(cell,
+                                                                          PolygonTable())
+        table.append(vertices, offsets, polygon_type=POLYGON_TYPE_NAMES.index(polygon_type),
+                     material=material_index,
+                     fill_type=FILL_TYPE_CODES.index(level_format['fill_type']),
+                     level=level_format['level'], x_min=level_format['x_min'],
+                     y_min=level_format['y_min'], x_max=level_format['x_max'],
+                     y_max=level_format['y_max'],
+                     conformal_max=level_format['conformal_max'],
+                     edge_mesh=level_format['edge_mesh'] == "Y",
+                     to_level=table.category('to_level', to_level_string or None),
+                     tech_layer=table.category('tech_layer', tech_layer),
+                     inherit=inherit)
+        self['geometry']['n_polygons'] = self._count_polygons()
+        log.debug("{} polygon(s) added".format(offsets.size - 1))
+
+    def add_instance(self, cell, origin=(0, 0), rotation=0, x_reflection=False,
+                     columns=1, rows=1, spacing=(0, 0)):
+        """
+        Places a cell of polygons made with add_polygons(..., cell=name) in the
+        project. Only the placement is stored, and the polygons of the cell are
+        copied when the Sonnet file is written, so placing a cell many times
+        takes little time or memory. Ports can't be attached to the polygons of a
+        cell.
+
+        :param cell: the name of the cell (string)
+        :param origin: the position of the cell's (0, 0) point (tuple of floats)
+        :param rotation: the counterclockwise rotation of the cell in radians (float)
+        :param x_reflection: reflect the cell across the x axis before it is
+            rotated (boolean)
+        :param columns: the number of columns in an array of copies (integer)
+        :param rows: the number of rows in an array of copies (integer)
+        :param spacing: the distance between the columns and rows (tuple of floats)
+        """
+        message = "'{}' is not a cell made with add_polygons()".format(cell)
+        assert cell in self.cells, message
+        message = "'columns' and 'rows' must be positive integers"
+        assert int(columns) == columns > 0 and int(rows) == rows > 0, message
+        self.instances.append(Instance(cell, origin=origin, rotation=rotation,
+                                       x_reflection=x_reflection, columns=int(columns),
+                                       rows=int(rows), spacing=spacing))
+        self['geometry']['n_polygons'] = self._count_polygons()
+
+    def merge_polygons(self, precision=1e-3):
+        """
+        Joins the overlapping and touching polygons on each level that have the
+        same material, fill type, technology layer and other properties into as
+        few polygons as possible. This reduces the number of polygons that Sonnet
+        has to subsection and should be done after all of the polygons have been
+        added and before the Sonnet file is made. Polygons with ports are left
+        unchanged so that the ports still refer to them. The polygons in cells are
+        merged within each cell. The gdstk package is required.
+
+        :param precision: the precision of the polygon union (float)
+        :return: a dictionary with the number of polygons and vertices written to
+            the Sonnet file as (before, after) tuples
+        """
+        before = (self._count_polygons(), self._count_vertices())
+        file_ids = [int(port.split("POLY")[1].split()[0])
+                    for port in self['geometry']['ports'].split('POR1')[1:]]
+        keep = np.isin(self.polygons['debug_id'], file_ids)
+        self.polygons = merge_polygons(self.polygons, keep=keep, precision=precision)
+        self.cells = {name: merge_polygons(table, precision=precision)
+                      for name, table in self.cells.items()}
+        self.edge_index = EdgeIndex(self.polygons)
+        self['geometry']['n_polygons'] = self._count_polygons()
+        after = (self._count_polygons(), self._count_vertices())
+        log.debug("polygons merged from {} to {} polygons and {} to {} vertices"
+                  .format(before[0], after[0], before[1], after[1]))
+        return {'polygons': (before[0], after[0]), 'vertices': (before[1], after[1])}
+
+    def validate(self, tolerance=1e-6):
+        """
+        Checks the project for problems that would make Sonnet fail after it has
+        started. Every polygon written to the Sonnet file is checked at once with
+        array operations and the polygon indices are in the order that they are
+        written. The checks are:
+            'outside_box': polygons with a vertex outside of the box
+            'zero_area': polygons with less than three vertices or no area
+            'self_intersecting': polygons with edges that cross each other
+            'invalid_level': polygons on a level that doesn't exist
+            'invalid_to_level': vias without a to_level, going to a level that
+                doesn't exist, or starting and ending on the same level
+            'invalid_material': polygons with a material that isn't defined
+            'ports_off_edge': the numbers of the ports that aren't on an edge of
+                the polygon that they refer to
+
+        :param tolerance: the distance that a vertex may be outside of the box or a
+            port may be off of its edge (float)
+        :return: a dictionary mapping the name of each check that failed to the
+            polygon indices or port numbers that failed it
+        """
+        geometry = self['geometry']
+        tables = [self.polygons] + list(self._instance_tables())
+        n_levels = geometry['n_metal_levels']
+        problems = {}
+        checks = {'outside_box': [], 'zero_area': [], 'self_intersecting': [],
+                  'invalid_level': [], 'invalid_to_level': [],
+                  'invalid_material': []}
+        via = POLYGON_TYPE_NAMES.index('via')
+        brick = POLYGON_TYPE_NAMES.index('dielectric brick')
+        start = 0
+        for table in tables:
+            vertices = table.vertices
+            ids = np.repeat(np.arange(len(table)), np.diff(table.offsets))
+            box = np.array([geometry['box_width_x'], geometry['box_width_y']])
+            outside = np.any((vertices < -tolerance) | (vertices > box + tolerance),
+                             axis=1)
+            checks['outside_box'].append(np.unique(ids[outside]))
+            distinct = np.any(vertices[1:] != vertices[:-1], axis=1) & \
+                (ids[1:] == ids[:-1])
+            n_distinct = np.bincount(ids[1:][distinct], minlength=len(table))
+            checks['zero_area'].append(np.flatnonzero(
+                (n_distinct < 3) | (np.abs(polygon_areas(table)) <= tolerance ** 2)))
+            checks['self_intersecting'].append(self_intersections(table))
+            levels = table['level']
+            checks['invalid_level'].append(np.flatnonzero((levels < 0) |
+                                                          (levels >= n_levels)))
+            # the to_level of each code as an integer with -1 for the ones not allowed
+            to_levels = []
+            for to_level in table.to_levels:
+                value = to_level.split()[1]
+                value = {'GND': n_levels, 'TOP': -2}.get(value, value)
+                valid = str(value).lstrip('-').isdigit() and \
+                    (int(value) in (n_levels, -2) or 0 <= int(value) < n_levels)
+                to_levels.append(int(value) if valid else -1)
+            to_level = np.array(to_levels + [-1], dtype=np.int64)[table['to_level']]
+            checks['invalid_to_level'].append(np.flatnonzero(
+                (table['polygon_type'] == via) & ((to_level == -1) | (to_level == levels))))
+            materials = table['material']
+            is_brick = table['polygon_type'] == brick
+            checks['invalid_material'].append(np.flatnonzero(np.where(
+                is_brick, (materials < 0) | (materials > len(self.brick_registry)),
+                (materials < -1) | (materials >= len(self.metal_registry)))))
+            for key in checks.keys():
+                checks[key][-1] = checks[key][-1] + start
+            start += len(table)
+        for key, indices in checks.items():
+            indices = np.concatenate(indices)
+            if indices.size:
+                problems[key] = indices
+        # ports must be on an edge of the polygon with their file id
+        off_edge = []
+        debug_ids = self.polygons['debug_id']
+        for port in geometry['ports'].split('POR1')[1:]:
+            lines = port.splitlines()
+            file_id = int(lines[[line.split()[0] if line.split() else ''
+                                 for line in lines].index('POLY')].split()[1])
+            values = lines[-1].split()
+            vertex = int(lines[-2].split()[0])
+            point = np.array([float(values[5]), float(values[6])])
+            polygons = np.flatnonzero(debug_ids == file_id)
+            on_edge = False
+            if polygons.size:
+                polygon = self.polygons.polygon(polygons[0])
+                if 0 <= vertex < polygon.shape[0] - 1:
+                    a, b_ = polygon[vertex], polygon[vertex + 1]
+                    t = np.clip(np.dot(point - a, b_ - a) /
+                                max(np.dot(b_ - a, b_ - a), 1e-300), 0, 1)
+                    on_edge = np.linalg.norm(a + t * (b_ - a) - point) <= tolerance
+            if not on_edge:
+                off_edge.append(int(values[0]))
+        if off_edge:
+            problems['ports_off_edge'] = off_edge
+        log.debug("validation found {} problem(s)".format(len(problems)))
+        return problems
+
+    def plot_geometry(self, axis=None, levels=None, max_polygons=20000, resolution=1000,
+                      block=False):
+        """
+        Plots the polygons and ports that will be written to the Sonnet file with
+        the y axis pointing down like in the Sonnet project editor. The metal on
+        each level is drawn with one PolyCollection made directly from the stored
+        vertices. Vias are outlined in black and dielectric bricks are drawn in
+        gray. If there are more than 'max_polygons' polygons, the ones smaller than
+        a pixel are drawn as an image of their area on each level and the rest are
+        rasterized so that large layouts can still be viewed interactively.
+
+        :param axis: An axis object on which to plot. If none is given, a new figure
+            will be created.
+        :param levels: the levels to plot (optional, list of integers)
+        :param max_polygons: the number of polygons above which small polygons are
+            drawn as an image (integer)
+        :param resolution: the number of pixels across the image used for the small
+            polygons (integer)
+        :param block: block kwarg passed to pyplot.show()
+        :return: the axis object
+        """
+        if axis is None:
+            _, axis = plt.subplots()
+        geometry = self['geometry']
+        width, height = geometry['box_width_x'], geometry['box_width_y']
+        tables = [self.polygons] + list(self._instance_tables())
+        table = PolygonTable()
+        for polygons in tables:
+            table.append(polygons.vertices, polygons.offsets, level=polygons['level'],
+                         polygon_type=polygons['polygon_type'])
+        vertices, offsets = table.vertices, table.offsets
+        selected = np.ones(len(table), dtype=bool)
+        if levels is not None:
+            selected = np.isin(table['level'], levels)
+        # find the polygons that are smaller than a pixel
+        pixel = max(width, height) / resolution
+        small = np.zeros(len(table), dtype=bool)
+        rasterized = selected.sum() > max_polygons
+        if rasterized and len(table):
+            starts = offsets[:-1]
+            size = (np.maximum.reduceat(vertices, starts) -
+                    np.minimum.reduceat(vertices, starts))
+            small = np.all(size < pixel, axis=1)
+        polygons = np.split(vertices, offsets[1:-1]) if len(table) else []
+        via = POLYGON_TYPE_NAMES.index('via')
+        brick = POLYGON_TYPE_NAMES.index('dielectric brick')
+        bins = (np.linspace(0, width, int(np.ceil(width / pixel)) + 1),
+                np.linspace(0, height, int(np.ceil(height / pixel)) + 1))
+        for level in np.unique(table['level'][selected]):
+            color = "C{}".format(level % 10)
+            on_level = selected & (table['level'] == level)
+            for polygon_type, style in [(POLYGON_TYPE_NAMES.index('metal'),
+                                         dict(facecolor=color, edgecolor=color, alpha=0.6,
+                                              label="level {}".format(level))),
+                                        (via, dict(facecolor=color, edgecolor='k',
+                                                   alpha=0.8, linewidth=1.5)),
+                                        (brick, dict(facecolor='0.6', edgecolor='0.4',
+                                                     alpha=0.3))]:
+                indices = np.flatnonzero(on_level & ~small &
+                                         (table['polygon_type'] == polygon_type))
+                if indices.size:
+                    collection = PolyCollection([polygons[index] for index in indices],
+                                                rasterized=rasterized, **style)
+                    axis.add_collection(collection)
+            # draw the small polygons as an image of the area that they cover
+            indices = np.flatnonzero(on_level & small)
+            if indices.size:
+                area = np.abs(polygon_areas(table.take(indices)))
+                centers = np.add.reduceat(vertices, offsets[:-1])[indices] / \
+                    np.diff(offsets)[indices, np.newaxis]
+                image, _, _ = np.histogram2d(centers[:, 0], centers[:, 1], bins=bins,
+                                             weights=area)
+                image = np.ma.masked_equal(image.T, 0)
+                color_map = colors.LinearSegmentedColormap.from_list(
+                    "level {}".format(level), [colors.to_rgba(color, 0.2),
+                                               colors.to_rgba(color, 1)])
+                axis.imshow(image, extent=(0, width, 0, height), origin='lower',
+                            cmap=color_map, vmin=0, vmax=pixel ** 2,
+                            interpolation='nearest')
+        # draw the ports and the box
+        for port in geometry['ports'].split('POR1')[1:]:
+            values = port.splitlines()[-1].split()
+            x, y = float(values[5]), float(values[6])
+            axis.plot(x, y, marker='s', color='r', markersize=6)
+            axis.annotate(values[0], (x, y), textcoords='offset points', xytext=(4, 4),
+                          color='r')
+        axis.add_patch(Rectangle((0, 0), width, height, fill=False, edgecolor='k'))
+        axis.set_xlim(0, width)
+        axis.set_ylim(height, 0)
+        axis.set_aspect('equal')
+        unit = self['dimensions']['length'].lower()
+        axis.set_xlabel("position [{}]".format(unit))
+        axis.set_ylabel("position [{}]".format(unit))
+        if len(axis.collections):
+            axis.legend(loc='upper right')
+        plt.show(block=block)
+        return axis
+
+    def estimate(self, bytes_per_entry=16, flops=1e10, abs_points=10):
+        """
+        Estimates the cost of running the project before it is sent to Sonnet. The
+        number of subsections is estimated from the polygons, cell size, fill
+        types, subsection size limits of each polygon, the speed setting and the
+        largest subsection allowed by the subsections per wavelength at the highest
+        frequency. Sonnet solves a dense complex matrix with one row for each
+        subsection at each frequency, so the memory grows with the square and the
+        time with the cube of the number of subsections. The results are only
+        approximate and 'flops' should be calibrated to the computer running em.
+
+        :param bytes_per_entry: the size of a matrix entry (integer)
+        :param flops: the floating point operations per second of the solver (float)
+        :param abs_points: the number of frequencies to count for each adaptive
+            band synthesis sweep (integer)
+        :return: a dictionary with the estimated number of 'subsections', the
+            'matrix_memory' in bytes, the 'time_per_frequency' and total 'time' in
+            seconds, the number of 'frequency_points', the 'max_frequency' in the
+            project units, the largest subsection size along x and y in cells
+            ('max_subsection_size'), and whether the matrix fits in the memory
+            that is currently available ('fits_in_memory')
+        """
+        n_points, f_max = self.frequency_points(abs_points=abs_points)
+        cell_size, settings, f_max = self._subsection_settings(f_max)
+        n = int(count_subsections(self.polygons, cell_size, **settings).sum())
+        for instance in self.instances:
+            n += instance.size * int(count_subsections(self.cells[instance.cell],
+                                                       cell_size, **settings).sum())
+        memory = bytes_per_entry * float(n) ** 2
+        # a complex LU decomposition takes about 8 n^3 / 3 floating point operations
+        time = 8 * float(n) ** 3 / 3 / flops
+        result = {'subsections': n, 'matrix_memory': memory, 'time_per_frequency': time,
+                  'time': time * n_points, 'frequency_points': n_points,
+                  'max_frequency': f_max, 'max_subsection_size': settings['max_cells'],
+                  'fits_in_memory': memory < psutil.virtual_memory().available}
+        log.debug("{subsections} subsections estimated needing {matrix_memory:.3g} "
+                  "bytes and {time:.3g} s".format(**result))
+        return result
+
+    def _subsection_settings(self, f_max):
+        # the cell size, the count_subsections() keyword arguments and the frequency
+        # used to find the largest subsection size
+        geometry, control = self['geometry'], self['control']
+        cell_size = (2 * geometry['box_width_x'] / geometry['x_cells2'],
+                     2 * geometry['box_width_y'] / geometry['y_cells2'])
+        # the frequency used for subsectioning may be fixed with CFMAX
+        values = control['subsectioning_frequency'].split()
+        if len(values) == 3 and values[1] == 'Y':
+            f_max = float(values[2])
+        # use the estimated epsilon effective or the largest dielectric constant
+        values = control['estimated_epsilon'].split()
+        if len(values) == 3 and values[1] == 'Y':
+            epsilon = float(values[2])
+        else:
+            epsilon = max([float(layer.split()[1]) for layer
+                           in geometry['layers'].splitlines() if layer.strip()] + [1])
+        if f_max > 0:
+            wavelength = (299792458 / np.sqrt(epsilon) /
+                          (f_max * b.UNIT_SCALES['frequency'][self['dimensions']['frequency']]) /
+                          b.UNIT_SCALES['length'][self['dimensions']['length']])
+            size = wavelength / control['subsections_per_wavelength']
+            max_cells = (float(size / cell_size[0]), float(size / cell_size[1]))
+        else:
+            max_cells = (np.inf, np.inf)
+        settings = dict(max_cells=max_cells, speed=control['speed'],
+                        n_levels=geometry['n_metal_levels'])
+        return cell_size, settings, f_max
+
+    def detect_symmetry(self, tolerance=1e-6, apply=False):
+        """
+        Checks if the polygons (including vias and dielectric bricks) and ports are
+        mirror symmetric about the center line of the box that is parallel to the x
+        axis, which is the symmetry that Sonnet can use to reduce the simulation
+        time. Each polygon must have a mirror image with the same properties and
+        each port must have a mirror image with the same number and parameters.
+
+        :param tolerance: the vertices and port positions are compared after
+            rounding them to multiples of this (float)
+        :param apply: turn symmetry on in the project if it is symmetric and off
+            otherwise (boolean)
+        :return: a dictionary with whether or not the project is 'symmetric', the
+            indices of the 'polygons' that break the symmetry in the order that
+            they are written to the Sonnet file, and the numbers of the 'ports'
+            that break the symmetry
+        """
+        geometry = self['geometry']
+        center = geometry['box_width_y'] / 2
+        tables = [self.polygons] + list(self._instance_tables())
+        signatures = np.concatenate([polygon_signatures(table, tolerance)
+                                     for table in tables])
+        mirrored = np.concatenate([polygon_signatures(table, tolerance, mirror_y=center)
+                                   for table in tables])
+        polygons = np.flatnonzero(~np.isin(mirrored, signatures))
+        # compare every port parameter with the y position mirrored
+        ports = {}
+        for port in geometry['ports'].split('POR1')[1:]:
+            values = port.splitlines()[-1].split()
+            key = (port.split(None, 1)[0],) + tuple(values[:5]) + (
+                int(round(float(values[5]) / tolerance)),)
+            y = float(values[6])
+            ports.setdefault(key + (int(round(y / tolerance)),), []).append(
+                (int(values[0]), key + (int(round((2 * center - y) / tolerance)),)))
+        broken = [number for values in ports.values() for number, key in values
+                  if key not in ports]
+        symmetric = polygons.size == 0 and not broken
+        log.debug("the project is {}symmetric".format("" if symmetric else "not "))
+        if apply:
+            geometry['symmetry'] = 'SYM' if symmetric else ''
+        return {'symmetric': symmetric, 'polygons': polygons, 'ports': broken}
+
+    def suggest_cell_size(self, max_error=0, resolution=1e-8, apply=False):
+        """
+        Proposes the number of cells for setup_box() from the polygon vertices and
+        port positions in the project. The candidate cell sizes along each axis
+        are the multiples of the greatest common divisor of the coordinates that
+        evenly divide the box. Coarser cells need less memory and fewer
+        subsections but move some edges off of their coordinates, so every useful
+        pairing of the x and y cell sizes is returned as a trade-off curve.
+
+        :param max_error: the largest distance that a vertex or port may be from
+            the grid for the best choice (float)
+        :param resolution: coordinates are rounded to multiples of this (float)
+        :param apply: call setup_box() with the best choice (boolean)
+        :return: a dictionary with the 'best' choice, the trade-off 'curve' from
+            the finest to the coarsest grid, and the smallest distance between two
+            different x and y coordinates ('min_feature'). Each choice is a
+            dictionary with the 'cell_size', 'x_cells', 'y_cells', the largest
+            distance from a coordinate to the grid ('max_error'), the number of
+            coordinates that are off the grid ('off_grid'), and an estimate of the
+            number of subsections from the number of cells along the polygon edges
+            ('subsections').
+        """
+        geometry = self['geometry']
+        coordinates = []
+        perimeter = np.zeros(2)
+        tables = [(self.polygons, lambda vertices: vertices, 1, [])]
+        for instance in self.instances:
+            spacing = np.array(instance.origin) + instance.spacing
+            tables.append((self.cells[instance.cell], instance.transform, instance.size,
+                           [spacing[np.newaxis]] if instance.size > 1 else []))
+        for table, transform, n_copies, extra in tables:
+            vertices = transform(table.vertices)
+            coordinates += [vertices] + extra
+            edges = np.abs(np.diff(vertices, axis=0))
+            edges[table.offsets[1:-1] - 1] = 0  # between two polygons
+            perimeter += edges.sum(axis=0) * n_copies
+        for port in geometry['ports'].split('POR1')[1:]:
+            values = port.splitlines()[-1].split()
+            coordinates.append(np.array([[float(values[5]), float(values[6])]]))
+        coordinates = np.concatenate(coordinates).reshape(-1, 2)
+        min_feature, candidates = zip(*[
+            grid_candidates(coordinates[:, axis], geometry[width], resolution=resolution)
+            for axis, width in enumerate(['box_width_x', 'box_width_y'])])
+        # for each allowed error use the coarsest grid along each axis
+        curve = []
+        for error in sorted(set(c[2] for axis in candidates for c in axis)):
+            x, y = [[c for c in axis if c[2] <= error][-1] for axis in candidates]
+            choice = {'cell_size': (x[0], y[0]), 'x_cells': x[1], 'y_cells': y[1],
+                      'max_error': max(x[2], y[2]), 'off_grid': x[3] + y[3],
+                      'subsections': int(np.ceil(perimeter[0] / x[0] +
+                                                 perimeter[1] / y[0]))}
+            if not curve or curve[-1]['cell_size'] != choice['cell_size']:
+                curve.append(choice)
+        allowed = [choice for choice in curve if choice['max_error'] <= max_error and
+                   choice['cell_size'][0] <= min_feature[0] and
+                   choice['cell_size'][1] <= min_feature[1]]
+        best = allowed[-1] if allowed else curve[0]
+        log.debug("{} x {} cells of size {} suggested".format(
+            best['x_cells'], best['y_cells'], best['cell_size']))
+        if apply:
+            self.setup_box(geometry['box_width_x'], geometry['box_width_y'],
+                           best['x_cells'], best['y_cells'])
+        return {'best': best, 'curve': curve, 'min_feature': min_feature}
+
+    def condition_polygons(self):
+        """
+        Prepares the polygons for meshing by snapping every vertex to the cell grid
+        set by setup_box(), removing duplicate and collinear vertices, and removing
+        sliver polygons that have no area once they are on the grid. Off grid and
+        redundant vertices make Sonnet add small subsections, so this should be
+        done after all of the polygons have been added and before the Sonnet file
+        is made. Polygons with ports are left unchanged so that the ports still
+        refer to them. The polygons in cells are conditioned on the same grid, so
+        instances should be placed on the grid with rotations of multiples of 90
+        degrees.
+
+        :return: a dictionary with the number of vertices written to the Sonnet
+            file that were moved ('snapped') and the number of vertices, edges and
+            polygons that were removed
+        """
+        geometry = self['geometry']
+        cell_size = (2 * geometry['box_width_x'] / geometry['x_cells2'],
+                     2 * geometry['box_width_y'] / geometry['y_cells2'])
+        file_ids = [int(port.split("POLY")[1].split()[0])
+                    for port in geometry['ports'].split('POR1')[1:]]
+        keep = np.isin(self.polygons['debug_id'], file_ids)
+        self.polygons, removed = condition_polygons(self.polygons, cell_size, keep=keep)
+        for name, table in self.cells.items():
+            self.cells[name], cell_removed = condition_polygons(table, cell_size)
+            n_copies = sum(instance.size for instance in self.instances
+                           if instance.cell == name)
+            for key, value in cell_removed.items():
+                removed[key] += value * n_copies
+        self.edge_index = EdgeIndex(self.polygons)
+        geometry['n_polygons'] = self._count_polygons()
+        return removed
+
+    def _count_vertices(self):
+        # the number of vertices written to the Sonnet file
+        return self.polygons.n_vertices + sum(
+            self.cells[instance.cell].n_vertices * instance.size
+            for instance in self.instances)
+
+    def _count_polygons(self):
+        # the number of polygons written to the Sonnet file
+        return len(self.polygons) + sum(len(self.cells[instance.cell]) * instance.size
+                                        for instance in self.instances)
+
+    def _instance_tables(self, chunk_size=10000):
+        # yield tables of about 'chunk_size' polygons with the copies of every cell
+        for instance in self.instances:
+            table = self.cells[instance.cell]
+            transform = instance.transform
+            shifts = instance.shifts()
+            step = max(chunk_size // max(len(table), 1), 1)
+            for start in range(0, shifts.shape[0], step):
+                yield table.placed(shifts[start:start + step],
+                                   lambda vertices: np.round(transform(vertices), 8))
 
     def add_output_file(self, *args, **kwargs):
         import warnings
@@ -1445,31 +2646,22 @@ class NetlistProject(Project):
     """
     Class for creating and manipulating a Sonnet netlist project.
     """
-    # convert the project format to the file format
+    blocks = [(b.NETLIST_PROJECT, 'sonnet'), (b.HEADER, 'sonnet'),
+              (b.DIMENSIONS, 'dimensions'), (b.FREQUENCY, 'frequency'),
+              (b.CONTROL, 'control'), (b.OPTIMIZATION, 'optimization'),
+              (b.PARAMETER_SWEEP, 'parameter_sweep'), (b.OUTPUT_FILE, 'output_file'),
+              (b.PARAMETER_NETLIST, 'parameter_netlist'), (b.CIRCUIT, 'circuit'),
+              (b.QUICK_START_GUIDE, 'quick_start_guide'),
+              (b.COMPONENT_DATA_FILES, 'component_data_files'),
+              (b.TRANSLATORS, 'translators')]
+
     def make_sonnet_file(self, file_path):
-        file_string = (b.NETLIST_PROJECT.format(**self['sonnet']) +
-                       b.HEADER.format(**self['sonnet']) +
-                       b.DIMENSIONS.format(**self['dimensions']) +
-                       b.FREQUENCY.format(**self['frequency']) +
-                       b.CONTROL.format(**self['control']) +
-                       b.OPTIMIZATION.format(**self['optimization']) +
-                       b.PARAMETER_SWEEP.format(**self['parameter_sweep']) +
-                       b.OUTPUT_FILE.format(**self['output_file']) +
-                       b.PARAMETER_NETLIST.format(**self['parameter_netlist']) +
-                       b.CIRCUIT.format(**self['circuit']) +
-                       b.QUICK_START_GUIDE.format(**self['quick_start_guide']) +
-                       b.COMPONENT_DATA_FILES.format(**self['component_data_files']) +
-                       b.TRANSLATORS.format(**self['translators']))
-        log.debug("saving netlist project to '{}'".format(file_path))
-        with open(file_path, "w") as file_handle:
-            file_handle.write(file_string)
-        self.project_file_path = file_path
-        folder = os.path.join(os.path.dirname(self.project_file_path), 'sondata')
-        if not os.path.isdir(folder):
-            os.mkdir(folder)
-        subfolder = os.path.join(folder, os.path.basename(file_path).split('.')[0])
-        if not os.path.isdir(subfolder):
-            os.mkdir(subfolder)
+        """
+        Convert the current state of this project into a Sonnet file.
+
+        :param file_path: path where the file will be saved or a writable text stream
+        """
+        self._make_sonnet_file(file_path, clean=False)
         log.debug("netlist project saved")
 
     def create_circuit(self):
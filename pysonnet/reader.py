@@ -0,0 +1,176 @@
+import os
+import re
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Keywords which start a line (or a record of several lines) that is added to a
+# section field as it is. Lines that don't start with a keyword belong to the
+# record above them. Keywords followed by only values (e.g. 'SPEED 0') are found
+# from the block templates and don't need to be listed here.
+RECORDS = {'geometry': {'SYM': 'symmetry', 'VGMODE': 'auto_height_vias',
+                        'PSB1': 'parallel_subsections', 'DRP1': 'reference_planes',
+                        'TMET': 'metals', 'BMET': 'metals', 'MET': 'metals',
+                        'DIM': 'dimensions', 'BRI': 'dielectrics', 'BRA': 'dielectrics',
+                        'VALVAR': 'variables', 'GEOVAR': 'parameters',
+                        'TECHLAY': 'technology_layers', 'EVIA1': 'edge_vias',
+                        'LORGN': 'origin', 'POR1': 'ports', 'CUPGRP': 'calibration_group',
+                        'SMD': 'components'},
+           'control': {'SIMPLE': 'analysis_type', 'STD': 'analysis_type',
+                       'ABS': 'analysis_type', 'OPTIMIZE': 'analysis_type',
+                       'VARSWP': 'analysis_type', 'EXTFILE': 'analysis_type',
+                       'FILENAME': 'analysis_type', 'EDGECHECK': 'edge_checking',
+                       'CFMAX': 'subsectioning_frequency', 'CEPSY': 'estimated_epsilon',
+                       'RES_ABS': 'abs_resolution', 'PUSH': 'hierarchy_sweep'},
+           'output_file': {'TS': 'response_data', 'DATA_BANK': 'response_data',
+                           'SC': 'response_data', 'CSV': 'response_data',
+                           'CADENCE': 'response_data', 'MDIF': 'response_data',
+                           'EBMDIF': 'response_data', 'PIMODEL': 'pi_spice', 'NCLINE': 'n_coupled_line_spice',
+                           'BBEXTRACT': 'broadband_spice', 'INDMODEL': 'inductor_model'},
+           'subdivider': {'REFPLANE': 'reference_planes', 'NAME': 'geometry_names',
+                          'LINE': 'subdivider_locations'}}
+# the lines following these keywords are added to a field until the next keyword
+CONTINUATIONS = {'geometry': {'BOX': 'layers'},
+                 'optimization': {'VARS': 'optimization_parameters'}}
+# the field for lines in a block that don't follow a keyword
+DEFAULT_FIELDS = {'frequency': 'sweeps', 'parameter_sweep': 'parameter_sweep',
+                  'optimization': 'optimization_goals', 'output_file': 'response_data',
+                  'component_data_files': 'data_files', 'translators': 'translators'}
+
+
+def read_sonnet_file(project, file_path):
+    """
+    Fill a project from a Sonnet project file. The file is read once from start to
+    finish and the polygons are added directly to the project's polygon table.
+    Blocks that pysonnet doesn't use are skipped.
+
+    :param project: the project to fill (GeometryProject)
+        It should start from the default configuration since only the values in
+        the file are changed.
+    :param file_path: path to the Sonnet project file (str)
+    """
+    log.debug("reading sonnet file '{}'".format(file_path))
+    grammars = {}
+    for template, section in project.blocks:
+        grammar = _BlockGrammar(template, section)
+        if grammar.start is not None:
+            grammars[grammar.start] = grammar
+    with open(file_path, "r") as file_handle:
+        lines = iter(file_handle)
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            keyword = line.split(None, 1)[0]
+            if line in grammars:
+                grammars[line].read(project, lines)
+            elif keyword == 'FTYP':
+                if line.split()[1] != 'SONPROJ':
+                    raise ValueError("'{}' is not a geometry project".format(file_path))
+            elif keyword == 'VER':
+                project['sonnet']['version'] = line[len(keyword):].strip()
+            elif keyword != line:
+                log.debug("skipping '{}'".format(line))
+            else:
+                log.debug("skipping the unsupported '{}' block".format(keyword))
+                for line in lines:
+                    if line.strip() == "END " + keyword:
+                        break
+    log.debug("sonnet file read")
+
+
+class _BlockGrammar:
+    # the statements of one block found from its template in blocks.py
+    def __init__(self, template, section):
+        self.section = section
+        template_lines = template.strip("\n").splitlines()
+        self.start = template_lines[0] if template_lines[0].isupper() and \
+            " " not in template_lines[0] else None
+        self.end = template_lines[-1]
+        self.fields = []  # fields holding whole lines
+        self.values = {}  # keyword: [(pattern, fields)] for lines with values
+        self.constants = set()  # lines without fields
+        self.polygons = False
+        for line in template_lines[1:-1]:
+            names = re.findall(r"{(\w+)}", line)
+            if line == "{polygons}":
+                self.polygons = True
+            elif re.fullmatch(r"{\w+}", line):
+                self.fields.append(names[0])
+            elif names:
+                self.values.setdefault(line.split()[0], []).append(
+                    (self._pattern(line), names))
+            else:
+                self.constants.add(line)
+        self.records = RECORDS.get(section, {})
+        self.continuations = CONTINUATIONS.get(section, {})
+        self.default_field = DEFAULT_FIELDS.get(section)
+
+    @staticmethod
+    def _pattern(line):
+        # a regular expression matching a template line with a group for each field
+        # where the last field may be empty and contain spaces
+        words = line.split()
+        pattern = ""
+        for index, word in enumerate(words):
+            if index == len(words) - 1 and re.fullmatch(r"{\w+}", word):
+                pattern += r"\s*(.*)"
+                break
+            if index > 0:
+                pattern += r"\s+"
+            for part in re.split(r"({\w+})", word):
+                pattern += r"(\S+?)" if re.fullmatch(r"{\w+}", part) else re.escape(part)
+        return re.compile(pattern)
+
+    def read(self, project, lines):
+        # read the block from the line after its start up to its end statement
+        section = project[self.section]
+        fields = {name: [] for name in self.fields}
+        field = self.default_field
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line == self.end:
+                break
+            keyword = line.split(None, 1)[0]
+            if self.polygons and keyword == 'NUM':
+                project.polygons.extend_from_lines(lines, stop=self.end)
+                break
+            if keyword in self.records:
+                field = self.records[keyword]
+                fields[field].append(line)
+            elif self._read_values(section, keyword, line):
+                field = self.continuations.get(keyword, self.default_field)
+            elif line in self.constants:
+                field = self.continuations.get(line, self.default_field)
+            elif field is not None:
+                fields[field].append(line)
+            else:
+                log.debug("skipping '{}' in the {} block".format(line, self.start))
+        else:
+            raise ValueError("the {} block is missing '{}'".format(self.start, self.end))
+        for name, values in fields.items():
+            section[name] = "".join(value + os.linesep for value in values)
+
+    def _read_values(self, section, keyword, line):
+        # set the fields of a statement with values and return True if it matched
+        for pattern, names in self.values.get(keyword, []):
+            match = pattern.fullmatch(line)
+            if match is None:
+                continue
+            for name, value in zip(names, match.groups()):
+                if isinstance(section.get(name), (int, float)):
+                    value = _to_number(value)
+                section[name] = value
+            return True
+        return False
+
+
+def _to_number(value):
+    # convert a string to an integer if possible and otherwise a float
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
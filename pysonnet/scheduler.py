@@ -0,0 +1,195 @@
+import os
+import queue
+import logging
+import itertools
+import threading
+from datetime import datetime
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# the states a job passes through
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+
+class Job:
+    """
+    Class for keeping track of one project run by a Scheduler. The result of the
+    run can be waited for with the job's future.
+
+    :param project: the project to run (Project)
+    :param priority: jobs with a higher priority are started first (number)
+    :param run_kwargs: the keyword arguments for the project's run() method (dict)
+    """
+    def __init__(self, project, priority=0, run_kwargs=None):
+        self.project = project
+        self.priority = priority
+        self.run_kwargs = run_kwargs or {}
+        self.future = Future()
+        self.status = 'queued'
+        self.return_code = None
+        self.report = None
+        self.submitted = datetime.now()
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return "Job(project={!r}, priority={}, status='{}')".format(
+            self.project.project_file_path, self.priority, self.status)
+
+    def cancel(self):
+        """
+        Cancel the job if it hasn't started yet.
+
+        :return: True if the job was cancelled (boolean)
+        """
+        cancelled = self.future.cancel()
+        if cancelled:
+            self.status = 'cancelled'
+            self.finished = datetime.now()
+        return cancelled
+
+    def _run(self):
+        # run the project and resolve the future with the em return code
+        if not self.future.set_running_or_notify_cancel():
+            return
+        self.status = 'running'
+        self.started = datetime.now()
+        log.debug("starting {}".format(self))
+        try:
+            self.return_code = self.project.run(**self.run_kwargs)
+        except BaseException as error:
+            self.status = 'failed'
+            self.finished = datetime.now()
+            log.error("{} raised {!r}".format(self, error))
+            self.future.set_exception(error)
+        else:
+            self.report = self.project.report
+            self.status = 'done' if self.return_code == 0 else 'failed'
+            self.finished = datetime.now()
+            log.debug("{} finished with return code {}".format(self, self.return_code))
+            self.future.set_result(self.return_code)
+
+
+class Scheduler:
+    """
+    Class for running many projects at the same time from a pool of worker threads.
+    Each worker only waits on its em process, so the number of simultaneous runs is
+    limited by the number of Sonnet licenses and cores instead of by Python.
+
+    :param licenses: number of Sonnet licenses that may be used at the same time
+        (integer). There is no license limit if it isn't given.
+    :param cores: number of cores that may be used (integer). All of the cores of
+        the computer are used if it isn't given.
+    :param cores_per_job: number of cores each em run is expected to use (integer)
+    """
+    def __init__(self, licenses=None, cores=None, cores_per_job=1):
+        message = "'{}' must be a positive integer"
+        assert licenses is None or licenses >= 1, message.format('licenses')
+        assert cores is None or cores >= 1, message.format('cores')
+        assert cores_per_job >= 1, message.format('cores_per_job')
+        self.licenses = licenses
+        self.cores = cores if cores is not None else (os.cpu_count() or 1)
+        self.cores_per_job = cores_per_job
+        self.jobs = []
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()  # keeps equal priorities first in first out
+        self._workers = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+
+    @property
+    def max_workers(self):
+        """The largest number of projects that are run at the same time."""
+        n_workers = max(self.cores // self.cores_per_job, 1)
+        if self.licenses is not None:
+            n_workers = min(n_workers, self.licenses)
+        return n_workers
+
+    def submit(self, project, priority=0, **kwargs):
+        """
+        Add a project to the queue to be run.
+
+        :param project: the project to run (Project)
+            The project shouldn't be changed until its job has finished. Use
+            project.variant() to queue several versions of one project.
+        :param priority: jobs with a higher priority are started first (number)
+            Jobs with the same priority are started in the order they were
+            submitted.
+        :param kwargs: keyword arguments for the project's run() method
+        :return: a future that resolves to the em return code
+            (concurrent.futures.Future). The job is available as future.job.
+        """
+        job = Job(project, priority=priority, run_kwargs=kwargs)
+        job.future.job = job
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("can't submit jobs after the scheduler is shut down")
+            self.jobs.append(job)
+            self._queue.put((-priority, next(self._counter), job))
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, daemon=True,
+                                          name="pysonnet-worker-{}".format(len(self._workers)))
+                self._workers.append(worker)
+                worker.start()
+        log.debug("queued {}".format(job))
+        return job.future
+
+    def map(self, projects, priority=0, **kwargs):
+        """
+        Add several projects to the queue to be run.
+
+        :param projects: the projects to run (iterable of Project)
+        :param priority: priority for all of the jobs (number)
+        :param kwargs: keyword arguments for the projects' run() methods
+        :return: a list of futures in the order of the projects
+        """
+        return [self.submit(project, priority=priority, **kwargs)
+                for project in projects]
+
+    def status(self):
+        """
+        Counts the jobs in each state.
+
+        :return: a dictionary mapping each status to a number of jobs
+        """
+        counts = dict.fromkeys(JOB_STATUSES, 0)
+        for job in self.jobs:
+            counts[job.status] += 1
+        return counts
+
+    def shutdown(self, wait=True, cancel_queued=False):
+        """
+        Stop accepting jobs and stop the workers once the queue is empty.
+
+        :param wait: wait for the running and queued jobs to finish (boolean)
+        :param cancel_queued: cancel the jobs that haven't started (boolean)
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_queued:
+                for job in self.jobs:
+                    if job.status == 'queued':
+                        job.cancel()
+            # one stop signal per worker that sorts after every job
+            for _ in self._workers:
+                self._queue.put((float('inf'), next(self._counter), None))
+            workers = list(self._workers)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _work(self):
+        # run jobs from the queue until a stop signal is found
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                break
+            job._run()
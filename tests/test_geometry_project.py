@@ -0,0 +1,699 @@
+import io
+import os
+import tracemalloc
+import numpy as np
+import pytest
+from pysonnet import GeometryProject
+from pysonnet.geometry import PolygonTable, EdgeIndex, format_vertices, crossing_intervals
+
+
+@pytest.fixture
+def project():
+    """Returns a GeometryProject with a feedline and a few squares on level 0."""
+    project = GeometryProject()
+    project.setup_box(200, 100, 400, 200)
+    project.define_metal('general', 'Al', ls=0.1)
+    project.add_dielectric('Si', 0, thickness=100, epsilon=11.9)
+    project.add_dielectric('air', 1, thickness=500)
+    project.define_technology_layer('metal', 'M1', 1, 'Al')
+    feedline = np.array([[0, 40], [200, 40], [200, 60], [0, 60]], dtype=float)
+    squares = [np.array([[x, 10], [x + 5, 10], [x + 5, 15], [x, 15]], dtype=float)
+               for x in range(10, 190, 20)]
+    project.add_polygons('metal', [feedline] + squares, level=0, material='Al')
+    project.add_polygons('metal', [squares[0] + [0, 70]], tech_layer='M1')
+    project.add_polygons('via', [squares[1] + [0, 20]], level=0, to_level=1,
+                         material='lossless')
+    project.set_options(memory='high')
+    return project
+
+
+def sonnet_text(project, tmp_path):
+    file_path = os.path.join(tmp_path, "project.son")
+    project.make_sonnet_file(file_path)
+    with open(file_path) as file_handle:
+        return file_handle.read()
+
+
+def test_polygon_table(project):
+    table = project.polygons
+    assert len(table) == 12
+    assert table.n_vertices == 12 * 5
+    np.testing.assert_array_equal(table.polygon(0)[0], table.polygon(0)[-1])
+    np.testing.assert_array_equal(table['level'][:10], 0)
+    assert table.tech_layers == ['M1']
+    assert table['tech_layer'][10] == 0
+    assert table.to_levels == ['TOLEVEL 1 RING NOCOVERS']
+    assert project['geometry']['polygons'] == ''
+    assert project['geometry']['n_polygons'] == 12
+
+
+def test_polygon_table_round_trip(project):
+    text = project.polygons.to_string()
+    table = PolygonTable.from_string(text)
+    assert table.to_string() == text
+    np.testing.assert_array_equal(table.vertices, project.polygons.vertices)
+
+
+def test_polygons_rendered(project, tmp_path):
+    text = sonnet_text(project, tmp_path)
+    assert "NUM 12\n" in text
+    assert "0 5 0 N 0 1 1 100 100 0 0 0 Y\n\n\n0.00000000 40.00000000\n" in text
+    assert 'TLAYNAM "M1" INH' in text
+    assert "VIA POLYGON\n0 5 -1 N 0 1 1 100 100 0 0 0 Y\nTOLEVEL 1 RING NOCOVERS" in text
+
+
+def test_add_port(project, tmp_path):
+    project.add_port('standard', 1, 0, 50)
+    project.add_port('standard', 2, 200, 52, resistance=50)
+    project.add_port('auto-grounded', 3, 12, 86, level='M1')
+    ports = project['geometry']['ports']
+    # the feedline gets a debug id that is shared by both ports
+    assert ports.count("POLY 120 1\n") == 2
+    assert "1 0 0 0 0 0.0 50.0" in ports
+    assert "2 50 0 0 0 200.0 50.0" in ports
+    assert "POLY 122 1\n2\n3 0 0 0 0 12.5 85.0 NONE 0" in ports
+    assert project.polygons['debug_id'][0] == 120
+    assert project.polygons['debug_id'][10] == 122
+    assert "0 5 0 N 120 1 1 100 100 0 0 0 Y" in sonnet_text(project, tmp_path)
+
+
+def test_format_vertices():
+    vertices = np.array([[0, -0.0], [1e-9, -1e-9], [-12.5, 999.999999999],
+                         [123456789.12345678, 10000], [-0.5, 3]])
+    text, line_ends = format_vertices(vertices, linesep="\n")
+    expected = ["{:.8f} {:.8f}\n".format(*vertex) for vertex in vertices]
+    assert text == "".join(expected)
+    np.testing.assert_array_equal(line_ends, np.cumsum([len(line) for line in expected]))
+
+
+def test_format_vertices_rounding():
+    rng = np.random.default_rng(0)
+    vertices = np.concatenate([
+        rng.uniform(-1e3, 1e3, (100000, 2)),
+        np.round(rng.uniform(-1e3, 1e3, (10000, 2)), 8) + 5e-9,  # near ties
+        np.round(rng.uniform(-1, 1, (10000, 2)), 8) - 5e-9,
+        rng.integers(-2**20, 2**20, (10000, 2)) * 2.0**-9,  # exact ties
+        rng.uniform(-1e10, 1e10, (1000, 2)),
+        [[5e-9, -5e-9], [1.5e-8, 2.5e-8]]])
+    text, _ = format_vertices(vertices, linesep="\n")
+    assert text == "".join("{:.8f} {:.8f}\n".format(*vertex) for vertex in vertices)
+
+
+def test_add_polygons_offsets(project):
+    vertices = np.array([[0, 0], [1, 0], [1, 1], [0, 1],
+                         [2, 0], [3, 0], [3, 1], [2, 0]], dtype=float)
+    project.add_polygons('metal', vertices, offsets=[0, 4, 8], level=0,
+                         material='lossless')
+    assert len(project.polygons) == 14
+    np.testing.assert_array_equal(project.polygons.polygon(12), vertices[[0, 1, 2, 3, 0]])
+    np.testing.assert_array_equal(project.polygons.polygon(13), vertices[4:])
+    with pytest.raises(AssertionError):
+        project.add_polygons('metal', [vertices[:2]], level=0, material='lossless')
+
+
+def brute_force_edge(table, point, allowed):
+    # the first edge midpoint with the smallest distance like a linear search
+    best = (np.inf, -1, -1)
+    for index in np.flatnonzero(allowed):
+        polygon = table.polygon(index)
+        mid_points = (polygon[1:] + polygon[:-1]) / 2
+        distance = np.linalg.norm(mid_points - point, axis=1)
+        if distance.min() < best[0]:
+            best = (distance.min(), index, np.argmin(distance))
+    return best[1:]
+
+
+def test_edge_index():
+    rng = np.random.default_rng(1)
+    table = PolygonTable()
+    index = EdgeIndex(table)
+    # abutting unit squares on a grid have many edges with the same midpoint
+    for batch in range(3):
+        corners = rng.integers(0, 20, size=(100, 2)).astype(float)
+        square = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]], dtype=float)
+        vertices = (corners[:, np.newaxis] + square).reshape(-1, 2)
+        table.append(vertices, np.arange(0, vertices.shape[0] + 1, 5),
+                     level=batch % 2)
+        points = np.vstack([rng.uniform(-1, 21, size=(30, 2)),
+                            corners[:20] + [0.5, 0]])
+        for level in (None, 0, 1):
+            polygon_ids, vertex_ids, mid_points = index.query(points, level=level)
+            allowed = (np.ones(len(table), dtype=bool) if level is None
+                       else table['level'] == level)
+            for point, polygon_id, vertex_id in zip(points, polygon_ids, vertex_ids):
+                assert (polygon_id, vertex_id) == brute_force_edge(table, point, allowed)
+
+
+def test_edge_index_added_after_query():
+    rng = np.random.default_rng(3)
+    square = np.array([[0, 0], [5, 0], [5, 5], [0, 5]], dtype=float)
+    project = GeometryProject()
+    project.setup_box(10010, 10010, 1000, 1000)
+    project.add_polygons('metal', list(rng.uniform(0, 1e4, (40000, 1, 2)) + square),
+                         level=0, material='lossless')
+    project.add_port('standard', 1, 0, 0)  # builds the tree
+    # polygons added after the tree is built are searched without rebuilding it
+    for corner in rng.uniform(0, 1e4, (100, 1, 2)):
+        project.add_polygons('metal', [corner + square], level=0, material='lossless')
+    project.add_polygons('metal', list(rng.uniform(0, 1e4, (9000, 1, 2)) + square),
+                         level=0, material='lossless')
+    x, y = rng.uniform(0, 1e4, (2, 2000))
+    tracemalloc.start()
+    try:
+        project.add_ports('standard', list(range(2, 2002)), x, y)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 100 * 2**20
+    group = project.edge_index._groups[None]
+    assert group.pending_tree is not None and group.n_tree < group.size
+    points = np.column_stack([x, y])
+    result = project.edge_index.query(points)
+    expected = EdgeIndex(project.polygons).query(points)
+    for values, expected_values in zip(result, expected):
+        np.testing.assert_array_equal(values, expected_values)
+    allowed = np.ones(len(project.polygons), dtype=bool)
+    for point, polygon_id, vertex_id in list(zip(points, *result[:2]))[:5]:
+        assert (polygon_id, vertex_id) == brute_force_edge(project.polygons, point,
+                                                           allowed)
+
+
+def test_add_ports(project):
+    sequential = GeometryProject()
+    sequential.update({key: dict(section) for key, section in project.items()})
+    sequential.polygons = project.polygons.copy()
+    sequential.edge_index = EdgeIndex(sequential.polygons)
+    rng = np.random.default_rng(2)
+    x = rng.uniform(0, 200, 20)
+    y = rng.uniform(0, 100, 20)
+    levels = [None, 0, 'M1', 1] * 5
+    types = ['standard', 'auto-grounded'] * 10
+    numbers = list(range(1, 21))
+    for index in range(20):
+        sequential.add_port(types[index], numbers[index], x[index], y[index],
+                            resistance=50, level=levels[index], length=index)
+    project.add_ports(types, numbers, x, y, resistance=50, level=levels,
+                      length=list(range(20)))
+    assert project['geometry']['ports'] == sequential['geometry']['ports']
+    np.testing.assert_array_equal(project.polygons['debug_id'],
+                                  sequential.polygons['debug_id'])
+    assert project.port_numbers == sequential.port_numbers
+
+
+def test_material_registry(project):
+    project.define_metal('general', 'Nb', ls=0.2)
+    project.define_metal('general', 'Al', ls=0.3)  # redefine in place
+    metals = project['geometry']['metals'].splitlines()
+    assert metals[0].startswith("TMET") and metals[1].startswith("BMET")
+    assert metals[2:] == ['MET "Al" 1 SUP 0 0 0 0.3', 'MET "Nb" 2 SUP 0 0 0 0.2']
+    assert project.metal_registry == {'Al': (0, 'SUP'), 'Nb': (1, 'SUP')}
+    project.define_dielectric_brick('SiO2', epsilon=4)
+    project.define_dielectric_brick('SiN', epsilon=7)
+    assert project.brick_registry == {'SiO2': 1, 'SiN': 2}
+    project.add_polygons('metal', [np.array([[0, 0], [1, 0], [1, 1]])], level=0,
+                         material='Nb')
+    project.add_polygons('dielectric brick', [np.array([[0, 0], [1, 0], [1, 1]])],
+                         level=0, material='SiN')
+    np.testing.assert_array_equal(project.polygons['material'][-2:], [1, 2])
+    project.set_box_cover('custom', top=True, name='Nb')
+    assert project['geometry']['metals'].splitlines()[0] == 'TMET Nb 2 SUP 0 0 0 0.2'
+    with pytest.raises(AssertionError):
+        project.add_polygons('metal', [np.array([[0, 0], [1, 0], [1, 1]])], level=0,
+                             material='Cu')
+
+
+def test_write_to_stream(project, tmp_path):
+    stream = io.StringIO()
+    project.make_sonnet_file(stream)
+    assert stream.getvalue() == sonnet_text(project, tmp_path)
+    assert os.path.isdir(os.path.join(tmp_path, "sondata", "project"))
+
+
+def test_render_cache(project, tmp_path):
+    text = sonnet_text(project, tmp_path)
+    misses = project.render_stats['misses']
+    assert sonnet_text(project, tmp_path) == text
+    assert project.render_stats['misses'] == misses
+    assert project.render_stats['hits'] == misses
+    # only the changed sections are formatted again
+    project.add_frequency_sweep('single', f1=1.5)
+    project.add_polygons('metal', [np.array([[0, 0], [1, 0], [1, 1]])], level=0,
+                         material='Al')
+    assert not project['control'].dirty and project['frequency'].dirty
+    text = sonnet_text(project, tmp_path)
+    assert project.render_stats['misses'] == misses + 3
+    assert "NUM 13\n" in text and "STEP 1.5" in text
+    assert isinstance(project._configuration()['frequency'], dict)
+
+
+def test_variant(project, tmp_path):
+    text = sonnet_text(project, tmp_path)
+    variant = project.variant()
+    # nothing is copied until the variant is changed
+    assert variant['geometry']['metals'] is project['geometry']['metals']
+    assert np.shares_memory(variant.polygons.vertices, project.polygons.vertices)
+    assert sonnet_text(variant, tmp_path) == text
+    assert variant.render_stats['misses'] == 0
+    variant.add_port('standard', 1, 0, 50)
+    variant.add_polygons('metal', [np.array([[0, 0], [1, 0], [1, 1]])], level=0,
+                         material='Al')
+    variant.add_frequency_sweep('single', f1=1.5)
+    assert sonnet_text(project, tmp_path) == text
+    assert project['geometry']['ports'] == '' and project.port_numbers == []
+    np.testing.assert_array_equal(project.polygons['debug_id'], 0)
+    assert len(project.polygons) == 12 and len(variant.polygons) == 13
+    assert variant.port_numbers == [1]
+    assert variant.polygons['debug_id'][0] != 0
+    assert "STEP 1.5" in sonnet_text(variant, tmp_path)
+    # the edge index of the variant only finds its own polygons
+    assert variant.edge_index.query([[1, 0.5]], level=0)[0][0] == 12
+    assert project.edge_index.query([[1, 0.5]], level=0)[0][0] != 12
+
+
+def test_load_sonnet_file(project, tmp_path):
+    project.add_port('standard', 1, 0, 50)
+    project.add_frequency_sweep('linear', f1=1, f2=2, n_points=11)
+    project.set_analysis('frequency sweep')
+    text = sonnet_text(project, tmp_path)
+    loaded = GeometryProject(os.path.join(tmp_path, "project.son"))
+    # only trailing spaces and blank lines are lost
+    def strip(string):
+        return [line.rstrip() for line in string.splitlines() if line.strip()]
+    assert strip(sonnet_text(loaded, tmp_path)) == strip(text)
+    np.testing.assert_array_equal(loaded.polygons.vertices, project.polygons.vertices)
+    assert loaded.port_numbers == [1]
+    assert loaded.metal_registry == project.metal_registry
+    assert loaded['geometry']['box_width_x'] == 200
+
+
+def test_load_sonnet_file_format(tmp_path):
+    file_path = os.path.join(tmp_path, "hand_written.son")
+    with open(file_path, "w") as file_handle:
+        file_handle.write("""FTYP SONPROJ 16 ! Sonnet Project File
+VER 16.56
+HEADER
+LIC 1234
+DAT 01/02/2020 10:11:12
+END HEADER
+DIM
+FREQ MHZ
+LNG UM
+END DIM
+GEO
+SYM
+TMET "Lossless" 0 SUP 0 0 0 0
+BMET "Lossless" 0 SUP 0 0 0 0
+MET "Cu" 1 SUP 0 0 0 0
+BOX 1 100 50 200 100 20 0
+      500 1 1 0 0 0 0 "Air"
+      10 9.8 1 0 0 0 0 "Alumina"
+NUM 2
+MET POL
+0 5 0 V 3 1 1 100 100 0 0 0 N
+0 0
+10 0
+10 10
+0 10
+0 0
+END
+BRI POL
+0 4 -1 T 4 1 1 100 100 0 0 0 Y
+1 1
+2 1
+2 2
+1 1
+END
+END GEO
+ESB
+SOMETHING
+END ESB
+FREQ
+SWEEP 100 200 10
+END FREQ
+CONTROL
+STD
+SPEED 1
+END CONTROL
+""")
+    project = GeometryProject(file_path)
+    assert project['sonnet']['version'] == '16.56'
+    assert project['sonnet']['date'] == '01/02/2020 10:11:12'
+    assert project['dimensions']['frequency'] == 'MHZ'
+    assert project['geometry']['symmetry'].strip() == 'SYM'
+    assert project['geometry']['box_width_y'] == 50
+    assert project['geometry']['layers'].splitlines()[1] == '10 9.8 1 0 0 0 0 "Alumina"'
+    assert project.metal_registry == {'Cu': (0, 'SUP')}
+    assert project['frequency']['sweeps'].strip() == 'SWEEP 100 200 10'
+    assert project['control']['speed'] == 1
+    table = project.polygons
+    assert len(table) == 2
+    np.testing.assert_array_equal(table['polygon_type'], [0, 2])
+    np.testing.assert_array_equal(table['fill_type'], [2, 1])
+    np.testing.assert_array_equal(table['debug_id'], [3, 4])
+    np.testing.assert_array_equal(table['edge_mesh'], [False, True])
+    np.testing.assert_array_equal(table.polygon(1), [[1, 1], [2, 1], [2, 2], [1, 1]])
+
+
+@pytest.mark.parametrize("extension", [".npz", ".yaml"])
+def test_save_load(project, tmp_path, extension):
+    project.add_port('standard', 1, 0, 50)
+    file_path = os.path.join(tmp_path, "saved" + extension)
+    project.save(file_path)
+    loaded = GeometryProject(file_path)
+    assert loaded.polygons.to_string() == project.polygons.to_string()
+    assert loaded.polygons.tech_layers == project.polygons.tech_layers
+    for key, section in project.items():
+        assert dict(loaded[key]) == dict(section)
+    assert sonnet_text(loaded, tmp_path) == sonnet_text(project, tmp_path)
+
+
+def test_binary_format_version(project, tmp_path):
+    file_path = os.path.join(tmp_path, "saved.npz")
+    project.save(file_path)
+    with np.load(file_path) as data:
+        arrays = dict(data)
+    assert int(arrays['format_version']) == 1
+    arrays['format_version'] = np.array(1000)
+    np.savez(file_path, **arrays)
+    with pytest.raises(ValueError):
+        GeometryProject(file_path)
+
+
+def test_add_gdstk_layers(project):
+    gdstk = pytest.importorskip("gdstk")
+    resonator = gdstk.Cell('resonator')
+    resonator.add(gdstk.rectangle((0, 0), (10, 2), layer=1))
+    resonator.add(gdstk.FlexPath([(0, 5), (10, 5), (10, 15)], 1, layer=2, datatype=1))
+    polygon = gdstk.regular_polygon((0, 0), 3, 7, layer=1)
+    polygon.repetition = gdstk.Repetition(2, 2, spacing=(20, 20))
+    resonator.add(polygon)
+    row = gdstk.Cell('row')
+    row.add(gdstk.Reference(resonator, (5, 5), rotation=0.3, magnification=1.5,
+                            x_reflection=True))
+    row.add(gdstk.Reference(resonator, (100, 0), columns=3, rows=2, spacing=(30, 40),
+                            rotation=np.pi / 2))
+    top = gdstk.Cell('top')
+    top.add(gdstk.Reference(row, (0, 0), rotation=0.1, columns=2, rows=1,
+                            spacing=(500, 0)))
+    top.add(gdstk.rectangle((-5, -5), (0, 0), layer=1, datatype=3))
+    n_polygons = len(project.polygons)
+    project.add_gdstk_layers(top, {(1, 0): {'polygon_type': 'metal', 'level': 0,
+                                            'material': 'Al'},
+                                   2: {'polygon_type': 'metal', 'tech_layer': 'M1'}})
+    table = project.polygons
+    added = [table.polygon(index) for index in range(n_polygons, len(table))]
+    expected = top.get_polygons(layer=1, datatype=0) + top.get_polygons(layer=2, datatype=1)
+    assert len(added) == len(expected) == 84
+
+    expected = [np.vstack([p.points, p.points[:1]]) for p in expected]
+
+    def key(vertices):
+        return tuple(np.round(vertices.mean(axis=0), 3)) + (vertices.shape[0],)
+    for vertices, points in zip(sorted(added, key=key), sorted(expected, key=key)):
+        np.testing.assert_allclose(vertices, points, atol=1e-8)
+    np.testing.assert_array_equal(table['tech_layer'][n_polygons:],
+                                  [-1] * 70 + [0] * 14)
+
+
+def test_add_instance(project, tmp_path):
+    explicit = project.variant()
+    square = np.array([[0, 0], [4, 0], [4, 2], [0, 2]], dtype=float)
+    triangle = np.array([[0, 0], [3, 0], [0, 3]], dtype=float)
+    project.add_polygons('metal', [square, triangle], level=0, material='Al',
+                         cell='unit')
+    project.add_instance('unit', origin=(10, 70))
+    project.add_instance('unit', origin=(100, 20), rotation=np.pi / 2,
+                         x_reflection=True, columns=3, rows=2, spacing=(10, 20))
+    # the cell is stored once however many times it is placed
+    assert len(project.polygons) == 12 and len(project.cells['unit']) == 2
+    assert project['geometry']['n_polygons'] == 12 + 2 * 7
+    reflected = [polygon * [1, -1] @ [[0, 1], [-1, 0]] for polygon in (square, triangle)]
+    explicit.add_polygons('metal', [square + [10, 70], triangle + [10, 70]], level=0,
+                          material='Al')
+    for x in range(3):
+        for y in range(2):
+            shift = [100 + 10 * x, 20 + 20 * y]
+            explicit.add_polygons('metal', [polygon + shift for polygon in reflected],
+                                  level=0, material='Al')
+    assert sonnet_text(project, tmp_path) == sonnet_text(explicit, tmp_path)
+    # cells and instances are saved in the binary format
+    file_path = os.path.join(tmp_path, "saved.npz")
+    project.save(file_path)
+    loaded = GeometryProject(file_path)
+    assert list(loaded.cells.keys()) == ['unit']
+    assert loaded.instances[1].parameters() == project.instances[1].parameters()
+    assert sonnet_text(loaded, tmp_path) == sonnet_text(explicit, tmp_path)
+    with pytest.raises(AssertionError):
+        project.add_instance('missing')
+
+
+def test_merge_polygons(project, tmp_path):
+    pytest.importorskip("gdstk")
+    # two overlapping rectangles and one that touches them form a single polygon
+    rectangles = [np.array([[0, 0], [4, 0], [4, 2], [0, 2]], dtype=float) + [x, 80]
+                  for x in (0, 2, 6)]
+    project.add_polygons('metal', rectangles, level=0, material='Al')
+    project.add_port('standard', 1, 0, 50)
+    feedline = project.polygons.polygon(0).copy()
+    debug_id = project.polygons['debug_id'][0]
+    counts = project.merge_polygons()
+    assert counts['polygons'] == (15, 13)
+    assert counts['vertices'] == (75, 65)
+    table = project.polygons
+    # the feedline has a port so it isn't merged with the squares on level 0
+    np.testing.assert_array_equal(table.polygon(0), feedline)
+    assert table['debug_id'][0] == debug_id
+    # unchanged polygons keep their order and the merged ones are added after them
+    np.testing.assert_array_equal(table['level'], [0, 1, 0] + [0] * 10)
+    assert table.tech_layers == ['M1'] and table['tech_layer'][1] == 0
+    merged = [table.polygon(index) for index in range(3, 13)
+              if table.polygon(index).min(axis=0)[1] == 80]
+    assert len(merged) == 1 and merged[0].shape == (5, 2)
+    np.testing.assert_array_equal(merged[0].max(axis=0), [10, 82])
+    assert "NUM 13\n" in sonnet_text(project, tmp_path)
+    index = project.edge_index.query([[5, 82]], level=0)[0][0]
+    np.testing.assert_array_equal(table.polygon(index), merged[0])
+
+
+def test_condition_polygons(project, tmp_path):
+    # the cells are 0.5 x 0.5
+    off_grid = np.array([[30.1, 80.2], [35, 80.1], [40.2, 80], [40.2, 85.1], [30, 84.9]])
+    sliver = np.array([[50, 80.1], [60, 80.1], [60, 80.2], [50, 80.2]])
+    duplicate = np.array([[70, 80], [70, 80], [75, 80], [75, 85], [70, 85]], dtype=float)
+    with_port = np.array([[0, 90.1], [10, 90.1], [10, 95], [0, 95]])
+    project.add_polygons('metal', [off_grid, sliver, duplicate, with_port], level=0,
+                         material='Al')
+    project.add_port('standard', 1, 0, 92)
+    removed = project.condition_polygons()
+    assert removed == {'snapped': 9, 'vertices': 7, 'edges': 6, 'polygons': 1}
+    table = project.polygons
+    assert len(table) == 15 and project['geometry']['n_polygons'] == 15
+    np.testing.assert_array_equal(table.polygon(12), [[30, 80], [40, 80], [40, 85],
+                                                      [30, 85], [30, 80]])
+    np.testing.assert_array_equal(table.polygon(13), [[70, 80], [75, 80], [75, 85],
+                                                      [70, 85], [70, 80]])
+    # the polygon with the port keeps its vertices and debug id
+    np.testing.assert_array_equal(table.polygon(14)[:-1], with_port)
+    assert table['debug_id'][14] != 0
+    assert "0 5 0 N 0 1 1 100 100 0 0 0 Y\n\n\n30.00000000 80.00000000\n" in \
+        sonnet_text(project, tmp_path)
+    # conditioning again doesn't change anything
+    assert project.condition_polygons() == {'snapped': 0, 'vertices': 0, 'edges': 0,
+                                            'polygons': 0}
+
+
+def test_suggest_cell_size(project):
+    result = project.suggest_cell_size()
+    # every coordinate is a multiple of 5 and the squares are 5 wide
+    assert result['min_feature'] == (5, 5)
+    best = result['best']
+    assert best['cell_size'] == (5, 5) and (best['x_cells'], best['y_cells']) == (40, 20)
+    assert best['max_error'] == 0 and best['off_grid'] == 0
+    curve = result['curve']
+    assert curve[0] == best
+    assert [choice['max_error'] for choice in curve] == sorted(
+        choice['max_error'] for choice in curve)
+    assert all(a['subsections'] > b['subsections'] for a, b in zip(curve, curve[1:]))
+    # a polygon off of the grid makes the y cells smaller
+    project.add_polygons('metal', [np.array([[100, 62.5], [105, 62.5], [105, 67.5],
+                                             [100, 67.5]])], level=0, material='Al')
+    result = project.suggest_cell_size(apply=True)
+    assert result['best']['cell_size'] == (5, 2.5)
+    assert project['geometry']['x_cells2'] == 80
+    assert project['geometry']['y_cells2'] == 80
+    assert result['curve'][1]['cell_size'] == (5, 5)
+    assert result['curve'][1]['max_error'] == 2.5
+    assert result['curve'][1]['off_grid'] == 5
+
+
+def test_detect_symmetry(tmp_path):
+    project = GeometryProject()
+    project.setup_box(200, 100, 400, 200)
+    project.add_dielectric('air', 1, thickness=500)
+    project.set_options(memory='high')
+    feedline = np.array([[0, 40], [200, 40], [200, 60], [0, 60]], dtype=float)
+    square = np.array([[50, 10], [55, 10], [55, 15], [50, 15]], dtype=float)
+    mirrored = (square * [1, -1] + [0, 100])[::-1]  # reversed vertex order
+    project.add_polygons('metal', [feedline, square, mirrored], level=0,
+                         material='lossless')
+    project.add_polygons('via', [square + [100, 0], mirrored + [100, 0]], level=0,
+                         to_level=1, material='lossless')
+    project.add_ports('standard', [1, 2], [0, 200], [50, 50])
+    result = project.detect_symmetry(apply=True)
+    assert result['symmetric'] and result['ports'] == []
+    assert "SYM\n" in sonnet_text(project, tmp_path)
+    # a brick only on one side and a via with a different to_level break symmetry
+    project.add_polygons('dielectric brick', [square + [20, 0]], level=0, material='air')
+    for to_level, polygon in [(1, square), (2, mirrored)]:
+        project.add_polygons('via', [polygon + [150, 0]], level=0, to_level=to_level,
+                             material='lossless')
+    project.add_port('standard', 3, 52.5, 15)
+    result = project.detect_symmetry(apply=True)
+    assert not result['symmetric']
+    np.testing.assert_array_equal(result['polygons'], [5, 6, 7])
+    assert result['ports'] == [3]
+    assert project['geometry']['symmetry'] == ''
+
+
+def test_frequency_points(project):
+    assert project.frequency_points() == (0, 0)
+    project.add_frequency_sweep('linear', f1=1, f2=2, n_points=11)
+    project.add_frequency_sweep('linear', f1=1, f2=2, f_step=0.25)
+    project.add_frequency_sweep('list', frequency_list=[3, 4.5])
+    project.add_frequency_sweep('single', f1=5)
+    project.add_frequency_sweep('abs', f1=1, f2=6)
+    assert project.frequency_points(abs_points=7) == (11 + 5 + 2 + 1 + 7, 6)
+
+
+def test_estimate(project):
+    estimate = project.estimate()
+    assert estimate['frequency_points'] == 0
+    assert estimate['max_subsection_size'] == (np.inf, np.inf)
+    n = estimate['subsections']
+    assert n > len(project.polygons)
+    assert estimate['matrix_memory'] == 16 * n ** 2
+    # a finer grid and a high frequency make more subsections
+    project.add_frequency_sweep('linear', f1=10, f2=100, n_points=10)
+    estimate = project.estimate(flops=1e9)
+    assert estimate['subsections'] > n and estimate['frequency_points'] == 10
+    assert estimate['max_frequency'] == 100
+    assert estimate['time'] == pytest.approx(10 * estimate['time_per_frequency'])
+    assert estimate['time_per_frequency'] == pytest.approx(
+        8 * estimate['subsections'] ** 3 / 3e9)
+    project.setup_box(200, 100, 800, 400)
+    fine = project.estimate()['subsections']
+    assert fine > estimate['subsections']
+    # edge meshing is removed at the lowest memory setting
+    project.set_options(memory='low')
+    assert project.estimate()['subsections'] < fine
+
+
+def test_plan_subdividers():
+    project = GeometryProject()
+    project.setup_box(400, 100, 400, 100)
+    project.set_options(memory='high')
+    feedline = np.array([[0, 45], [400, 45], [400, 55], [0, 55]], dtype=float)
+    resonator = np.array([[100, 58], [140, 58], [140, 70], [100, 70]], dtype=float)
+    stub = np.array([[300, 55], [310, 55], [310, 80], [300, 80]], dtype=float)
+    project.add_polygons('metal', [feedline, resonator, stub], level=0,
+                         material='lossless')
+    project.add_ports('standard', [1, 2], [0, 400], [50, 50])
+    result = project.plan_subdividers(n_lines=2)
+    # only positions 20 away from the ends of the straight feedline sections are used
+    allowed = [(20, 80), (160, 280), (330, 380)]
+    for position, _ in result['candidates']:
+        assert any(low <= position <= high for low, high in allowed)
+    savings = [saving for _, saving in result['candidates']]
+    assert savings == sorted(savings, reverse=True) and savings[0] > 0
+    assert len(result['lines']) == 2 and 0 < result['savings'] < 1
+    locations = project['subdivider']['subdivider_locations'].splitlines()
+    assert [float(line.split()[2]) for line in locations] == result['lines']
+    assert all(line.split()[3] == 'V' for line in locations)
+    # the lines already added are kept and the planner doesn't pick them again
+    result = project.plan_subdividers(apply=False)
+    assert not set(result['lines']) & {float(line.split()[2]) for line in locations}
+    with pytest.raises(AssertionError):
+        project.plan_subdividers(direction='horizontal')
+
+
+def test_plan_subdividers_many_lines():
+    project = GeometryProject()
+    project.setup_box(1000, 400, 1000, 400)
+    project.set_options(memory='high')
+    rng = np.random.default_rng(0)
+    polygons = []
+    for index, (x_min, x_max) in enumerate(np.sort(rng.uniform(0, 1000, (30, 2)))):
+        y = 10 + 12 * index  # overlapping lines are 2 apart
+        polygons.append(np.array([[x_min, y], [x_max, y], [x_max, y + 10],
+                                  [x_min, y + 10]]))
+    polygons.append(np.array([[600, 380], [700, 385], [700, 395], [600, 390]]))
+    project.add_polygons('metal', polygons, level=0, material='lossless')
+    result = project.plan_subdividers(min_gap=1, n_lines=2, apply=False)
+    assert result['candidates']
+    # every candidate follows the rules checked one position at a time
+    table = project.polygons
+    breakpoints = np.unique(np.concatenate([table.vertices[:, 0], [0, 1000]]))
+    for position, _ in result['candidates']:
+        ids, intervals, perpendicular = crossing_intervals(table, 0, position)
+        assert ids.size and perpendicular
+        widest = (intervals[:, 1] - intervals[:, 0]).max()
+        assert np.abs(breakpoints - position).min() >= 2 * widest
+    assert not any(600 < position < 700 for position, _ in result['candidates'])
+    # with the default gap every position crosses lines that are coupled
+    assert not project.plan_subdividers(n_lines=2, apply=False)['candidates']
+
+
+def test_validate(project, tmp_path):
+    # the technology layer polygon is on level 1 which needs another dielectric
+    assert set(project.validate().keys()) == {'invalid_level'}
+    project.add_dielectric('oxide', 2, thickness=1, epsilon=4)
+    assert project.validate() == {}
+    bow_tie = np.array([[20, 20], [30, 30], [30, 20], [20, 25]], dtype=float)
+    outside = np.array([[190, 90], [210, 90], [210, 95], [190, 95]], dtype=float)
+    line = np.array([[20, 80], [30, 80], [40, 80]], dtype=float)
+    project.add_polygons('metal', [bow_tie, outside, line], level=0, material='Al')
+    project.add_polygons('metal', [outside - [50, 0]], level=3, material='Al')
+    project.add_polygons('via', [bow_tie + [100, 0]], level=0, to_level='TOP',
+                         material='lossless')
+    project.add_polygons('via', [outside - [100, 0]], level=0, to_level=7,
+                         material='lossless')
+    project.polygons.set('material', 1, 5)
+    project.add_port('standard', 1, 0, 50)
+    project.add_port('standard', 2, 200, 50)
+    # move the second port off of its edge
+    project['geometry']['ports'] = project['geometry']['ports'].replace(
+        "200.0 50.0", "200.0 70.0")
+    problems = project.validate()
+    np.testing.assert_array_equal(problems['self_intersecting'], [12, 16])
+    np.testing.assert_array_equal(problems['outside_box'], [13])
+    np.testing.assert_array_equal(problems['zero_area'], [14])
+    np.testing.assert_array_equal(problems['invalid_level'], [15])
+    np.testing.assert_array_equal(problems['invalid_to_level'], [17])
+    np.testing.assert_array_equal(problems['invalid_material'], [1])
+    assert problems['ports_off_edge'] == [2]
+    project.add_frequency_sweep('single', f1=1)
+    with pytest.raises(ValueError, match="self_intersecting"):
+        project.run('frequency sweep', file_path=os.path.join(tmp_path, "p.son"))
+
+
+def test_plot_geometry(project):
+    pyplot = pytest.importorskip("matplotlib.pyplot")
+    project.add_port('standard', 1, 0, 50)
+    axis = project.plot_geometry()
+    # metal on levels 0 and 1 and the via on level 0
+    assert len(axis.collections) == 3 and not axis.images
+    assert sum(len(c.get_paths()) for c in axis.collections) == len(project.polygons)
+    assert axis.get_ylim() == (100, 0)
+    axis = project.plot_geometry(levels=[1])
+    assert len(axis.collections) == 1
+    # small polygons in a large project are drawn as an image
+    rng = np.random.default_rng(3)
+    square = np.array([[0, 0], [0.1, 0], [0.1, 0.1], [0, 0.1]])
+    project.add_polygons('metal', [square + corner for corner in
+                                   rng.uniform(0, 99, size=(200, 2))],
+                         level=0, material='Al')
+    _, axis = pyplot.subplots()
+    assert project.plot_geometry(axis=axis, max_polygons=100, resolution=500) is axis
+    assert len(axis.images) == 1
+    assert sum(len(c.get_paths()) for c in axis.collections) == len(project.polygons) - 200
+    pyplot.close("all")
@@ -0,0 +1,329 @@
+import os
+import sys
+import stat
+import time
+import asyncio
+import threading
+import subprocess
+import psutil
+import numpy as np
+import pytest
+from pysonnet import GeometryProject, Scheduler, ResultCache, ProgressParser
+from pysonnet import cache as cache_module
+from pysonnet.monitor import ResourceSampler
+
+# a stand-in for Sonnet's em that prints what it was called with, writes an output
+# file and can write more to standard error than fits in a pipe buffer
+EM = """#!{python}
+import os
+import sys
+import time
+print("em called with", " ".join(sys.argv[1:]), flush=True)
+base = os.path.splitext(sys.argv[-1])[0]
+with open(base + ".s1p", "w") as file_handle:
+    file_handle.write("output of " + " ".join(sys.argv[1:]))
+for index in range(int(os.environ.get("FAKE_EM_LINES", "0"))):
+    sys.stderr.write("warning {{}} {{}}\\n".format(index, "x" * 100))
+sys.stderr.flush()
+memory = bytearray(int(os.environ.get("FAKE_EM_MEMORY", "0")))
+time.sleep(float(os.environ.get("FAKE_EM_SLEEP", "0")))
+n_frequencies = int(os.environ.get("FAKE_EM_FREQUENCIES", "0"))
+for index in range(n_frequencies):
+    print("Processing frequency {{}} of {{}}: {{}}.000000 GHz".format(
+        index + 1, n_frequencies, index + 1), flush=True)
+    print("Number of subsections: 120", flush=True)
+    print("Matrix fill time: 0:00:01.5", flush=True)
+    print("Matrix solve time: 2.5 s", flush=True)
+    time.sleep(0.05)
+print("em simulation completed", flush=True)
+sys.exit(int(os.environ.get("FAKE_EM_EXIT", "0")))
+"""
+
+
+@pytest.fixture
+def sonnet_path(tmp_path):
+    """Returns a directory with a fake em program in its 'bin' folder."""
+    directory = tmp_path / "sonnet"
+    (directory / "bin").mkdir(parents=True)
+    em = directory / "bin" / "em"
+    em.write_text(EM.format(python=sys.executable))
+    em.chmod(em.stat().st_mode | stat.S_IEXEC)
+    return str(directory)
+
+
+@pytest.fixture
+def project(sonnet_path, tmp_path):
+    """Returns a GeometryProject with a frequency sweep ready to run."""
+    project = GeometryProject()
+    project.setup_box(200, 100, 400, 200)
+    project.add_dielectric('air', 0, thickness=500)
+    project.add_dielectric('Si', 1, thickness=100, epsilon=11.9)
+    project.add_polygons('metal', [np.array([[0, 40], [200, 40], [200, 60], [0, 60]],
+                                            dtype=float)], level=0, material='lossless')
+    project.add_frequency_sweep('linear', f1=1, f2=2, f_step=0.5)
+    project.set_analysis('frequency sweep')
+    project.set_options(memory='high')
+    project['sonnet']['sonnet_path'] = sonnet_path
+    project.make_sonnet_file(os.path.join(tmp_path, "project.son"))
+    return project
+
+
+def test_run(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_LINES", "5000")  # ~500 kB on standard error
+    output, errors = [], []
+    return_code = project.run(stdout=output.append, stderr=errors.append)
+    assert return_code == 0
+    assert output[0] == "em called with -v " + project.project_file_path
+    assert output[-1] == "em simulation completed"
+    assert len(errors) == 5000
+
+
+def test_run_async(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_LINES", "5000")
+    output, errors = [], []
+    return_code = asyncio.run(project.run_async(stdout=output.append,
+                                                stderr=errors.append))
+    assert return_code == 0
+    assert output[-1] == "em simulation completed"
+    assert len(errors) == 5000
+
+    monkeypatch.setenv("FAKE_EM_EXIT", "3")
+    assert asyncio.run(project.run_async(stdout=output.append)) == 3
+
+
+def test_run_async_concurrent(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_SLEEP", "0.5")
+    output = []
+
+    async def run_all():
+        return await asyncio.gather(*[project.run_async(stdout=output.append)
+                                      for _ in range(4)])
+
+    start = time.perf_counter()
+    assert asyncio.run(run_all()) == [0] * 4
+    assert time.perf_counter() - start < 4 * 0.5
+    assert output.count("em simulation completed") == 4
+
+
+def test_scheduler(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_SLEEP", "0.3")
+    scheduler = Scheduler(licenses=2, cores=8)
+    assert scheduler.max_workers == 2
+    assert Scheduler(licenses=8, cores=8, cores_per_job=4).max_workers == 2
+    futures = scheduler.map([project.variant() for _ in range(4)])
+    time.sleep(0.15)
+    assert scheduler.status()['running'] == 2
+    assert scheduler.status()['queued'] == 2
+    assert [future.result(timeout=10) for future in futures] == [0] * 4
+    assert scheduler.status()['done'] == 4
+    scheduler.shutdown()
+    with pytest.raises(RuntimeError):
+        scheduler.submit(project)
+
+
+def test_scheduler_priority(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_SLEEP", "0.2")
+    with Scheduler(licenses=1) as scheduler:
+        first = scheduler.submit(project)
+        time.sleep(0.1)  # the first job is running so the rest wait in the queue
+        low = scheduler.submit(project, priority=-1)
+        high = scheduler.submit(project, priority=5)
+        cancelled = scheduler.submit(project)
+        assert cancelled.job.cancel()
+    jobs = [first.job, low.job, high.job]
+    assert all(job.status == 'done' for job in jobs)
+    assert first.job.started < high.job.started < low.job.started
+    assert cancelled.cancelled() and cancelled.job.status == 'cancelled'
+
+
+def test_scheduler_failure(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_EXIT", "2")
+    with Scheduler(licenses=1) as scheduler:
+        future = scheduler.submit(project)
+        bad = scheduler.submit(GeometryProject())  # no sweep to run
+    assert future.result() == 2 and future.job.status == 'failed'
+    assert isinstance(bad.exception(), AssertionError)
+    assert bad.job.status == 'failed'
+
+
+def test_result_cache(project, tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    output = []
+    assert project.run(stdout=output.append, cache=cache) == 0
+    assert cache.stats == {'hits': 0, 'misses': 1, 'stores': 1, 'evictions': 0}
+    result = tmp_path / "project.s1p"
+    text = result.read_text()
+    result.unlink()
+    # rewriting the file with a new date doesn't change the key
+    project['sonnet']['date'] = '01/01/2000 00:00:00'
+    project.make_sonnet_file(str(tmp_path / "project.son"))
+    output.clear()
+    assert project.run(stdout=output.append, cache=cache) == 0
+    assert output == []  # em wasn't run
+    assert result.read_text() == text
+    assert cache.stats['hits'] == 1
+    # the outputs are renamed for a project saved under another name
+    other = tmp_path / "other"
+    other.mkdir()
+    project.make_sonnet_file(str(other / "renamed.son"))
+    assert project.run(stdout=output.append, cache=str(tmp_path / "cache")) == 0
+    assert output == []
+    assert (other / "renamed.s1p").read_text() == text
+    # other options are a different simulation
+    assert project.run(options='-t', stdout=output.append, cache=cache) == 0
+    assert output and cache.stats['misses'] == 2
+
+
+def test_result_cache_shared_folder(project, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_SLEEP", "0.3")
+    cache = ResultCache(tmp_path / "cache")
+    sibling = project.variant()
+    sibling.make_sonnet_file(str(tmp_path / "sibling.son"))
+    # both projects write their outputs into the folder while the other is running
+    with Scheduler(licenses=2, cores=2) as scheduler:
+        futures = [scheduler.submit(project, cache=cache, stdout=lambda line: None),
+                   scheduler.submit(sibling, options='-v -x', cache=cache,
+                                    stdout=lambda line: None)]
+    assert [future.result(timeout=10) for future in futures] == [0, 0]
+    assert cache.stats['stores'] == 2
+    for _, _, manifest in cache._entries():
+        assert manifest['files'] == ["$BASENAME.s1p"]
+    # restoring one project's outputs leaves the other project's files alone
+    (tmp_path / "sibling.s1p").write_text("current")
+    (tmp_path / "project.s1p").unlink()
+    output = []
+    assert project.run(stdout=output.append, cache=cache) == 0
+    assert output == [] and (tmp_path / "project.s1p").exists()
+    assert (tmp_path / "sibling.s1p").read_text() == "current"
+
+
+def test_result_cache_snapshot_race(project, tmp_path, monkeypatch):
+    cache = ResultCache(tmp_path / "cache")
+    listed = list(cache_module._output_files(project.project_file_path))
+    (tmp_path / "project.s1p").write_text("removed")
+    listed.append(str(tmp_path / "project.s1p"))
+    os.remove(listed[-1])  # another run removes a file after it was listed
+    monkeypatch.setattr(cache_module, "_output_files", lambda path: iter(listed))
+    assert "project.s1p" not in cache.snapshot(project.project_file_path)
+
+
+def test_result_cache_eviction(project, tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    keys = []
+    for options in ['-a', '-b', '-c']:
+        project.run(options=options, cache=cache, stdout=lambda line: None)
+        keys.append(cache.key(project.project_file_path, options=options))
+        os.utime(os.path.join(cache.directory, keys[-1], "manifest.json"),
+                 (len(keys), len(keys)))
+    size = cache.size()
+    assert size > 0
+    # restoring the first result makes the second the least recently used
+    assert cache.restore(keys[0], project.project_file_path)
+    cache.max_size = size * 2 // 3
+    assert cache.evict() == 1
+    assert not os.path.isdir(os.path.join(cache.directory, keys[1]))
+    assert cache.stats['evictions'] == 1
+    cache.clear()
+    assert cache.size() == 0
+
+
+def test_progress_parser():
+    events = []
+    parser = ProgressParser(events.append)
+    lines = ["EM Version 17.56", "Processing frequency 1 of 3: 500 MHz",
+             "Number of subsections: 2345", "Matrix fill time: 0:01:02.5",
+             "Matrix solve time: 250 ms", "Memory used: 12.5 MB",
+             "Processing frequency 2 of 3: 1.5 GHz, subsections: 3000, memory: 20 MB",
+             "ABS iteration 4", "EM Simulation Completed"]
+    for line in lines:
+        parser.feed(line)
+    assert [event.kind for event in events] == [
+        'frequency_started', 'subsections', 'matrix_fill', 'matrix_solve', 'memory',
+        'frequency_finished', 'frequency_started', 'subsections', 'memory',
+        'abs_iteration', 'frequency_finished', 'completed']
+    assert events[0]['frequency'] == 5e8 and events[0]['total'] == 3
+    assert events[1]['count'] == 2345
+    assert events[2]['seconds'] == 62.5
+    assert events[3]['seconds'] == 0.25
+    assert events[4]['bytes'] == int(12.5 * 2**20)
+    assert events[5]['eta'] == pytest.approx(2 * events[5]['duration'])
+    # every value on a line is reported after the frequency changes
+    assert events[6]['frequency'] == 1.5e9 and events[7]['count'] == 3000
+    assert events[8]['bytes'] == 20 * 2**20
+    assert events[9]['iteration'] == 4
+    assert [frequency for frequency, _ in parser.frequency_times] == [5e8, 1.5e9]
+
+
+def test_run_progress(project, monkeypatch):
+    monkeypatch.setenv("FAKE_EM_FREQUENCIES", "3")
+    events = []
+    project.run(stdout=lambda line: None, progress=events.append)
+    finished = [event for event in events if event.kind == 'frequency_finished']
+    assert [event['index'] for event in finished] == [1, 2, 3]
+    assert finished[-1]['eta'] == 0
+    assert events[-1].kind == 'completed'
+
+    # read the events from another thread while the project runs
+    parser = ProgressParser()
+    thread = threading.Thread(target=project.run,
+                              kwargs={'stdout': lambda line: None, 'progress': parser})
+    thread.start()
+    kinds = [event.kind for event in parser]  # ends when the run is finished
+    thread.join()
+    assert kinds.count('subsections') == 3 and kinds[-1] == 'completed'
+
+    events = []
+    asyncio.run(project.run_async(stdout=lambda line: None, progress=events.append))
+    assert sum(event.kind == 'matrix_solve' for event in events) == 3
+
+
+def test_resource_sampler_cpu():
+    busy = "import time\nend = time.time() + 2\nwhile time.time() < end: pass"
+    command = [sys.executable, "-c", "import subprocess, sys; "
+               "subprocess.run([sys.executable, '-c', {!r}])".format(busy)]
+    with subprocess.Popen(command) as process:
+        try:
+            time.sleep(0.5)  # the busy child is running
+            sampler = ResourceSampler(process.pid)
+            sample = sampler.sample()
+            assert sample['processes'] == 2
+            # the CPU use of new processes isn't reported as 0
+            assert sample['cpu_percent'] > 25
+            time.sleep(0.2)
+            assert sampler.sample()['cpu_percent'] > 25
+        finally:
+            for child in psutil.Process(process.pid).children(recursive=True):
+                child.kill()
+            process.kill()
+
+
+def test_run_report(project, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_EM_MEMORY", str(200 * 2**20))
+    monkeypatch.setenv("FAKE_EM_SLEEP", "0.5")
+    monkeypatch.setenv("FAKE_EM_FREQUENCIES", "2")
+    project.run(stdout=lambda line: None, progress=lambda event: None, monitor=0.05)
+    report = project.report
+    assert report.return_code == 0 and not report.cached
+    assert report.duration >= 0.5
+    assert report.subsections == 120
+    assert len(report.samples) >= 5
+    arrays = report.to_arrays()
+    assert np.all(np.diff(arrays['time']) > 0)
+    assert report.peak_rss == arrays['rss'].max() > 200 * 2**20
+    assert np.all(arrays['threads'] >= 1) and np.all(arrays['processes'] == 1)
+
+    # no samples are taken without an interval
+    asyncio.run(project.run_async(stdout=lambda line: None))
+    assert project.report.samples == [] and project.report.peak_rss is None
+    asyncio.run(project.run_async(stdout=lambda line: None, monitor=0.05))
+    assert project.report.peak_rss > 200 * 2**20
+
+    cache = ResultCache(tmp_path / "cache")
+    project.run(stdout=lambda line: None, cache=cache)
+    project.run(stdout=lambda line: None, cache=cache, monitor=0.05)
+    assert project.report.cached and project.report.samples == []
+
+    with Scheduler(licenses=1) as scheduler:
+        future = scheduler.submit(project, stdout=lambda line: None, monitor=0.05)
+    assert future.job.report is project.report
+    assert project.variant().report is None